@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Builder-side cost of pipeline stages.
+
+Usage: python benchmarks/builder.py [number of runs]
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mongo_aggregation import MongoAggregation  # noqa: E402
+from mongo_aggregation.FieldPathTrie import FieldPathTrie  # noqa: E402
+from mongo_aggregation.aggr_patterns import switch, switch_compare  # noqa: E402
+from mongo_aggregation.patterns import _convert_names_with_underlines_to_dots, and_, obj, or_  # noqa: E402
+
+DATE = datetime(2021, 1, 1)
+MATCH_KWARGS = {
+    'date__gte': DATE, 'date__lt': DATE, 'completed': True, 'cashbox__in': [1, 2, 3],
+    'transactions__amount__gt': 0, 'client__name__icontains': 'john',
+}
+WIDE_KWARGS = {f'field_{i}__subfield_{i}__gte': i for i in range(200)}
+HUGE_KWARGS = {f'field_{i}__subfield_{i}__gte': i for i in range(5000)}
+SWITCH_CASES = [[{'$eq': ['$status', i]}, f'status {i}'] for i in range(300)]
+SWITCH_COMPARE_CASES = [[i, f'status {i}'] for i in range(300)]
+
+
+def _actual_fields(number):
+    """Actual fields of wide documents: top level fields with nested ones."""
+    return FieldPathTrie(
+        field for i in range(number // 5) for field in
+        (f'field_{i}', f'field_{i}.a', f'field_{i}.b', f'field_{i}.c.d', f'field_{i}.c')
+    )
+
+
+ACTUAL_FIELDS = {number: _actual_fields(number) for number in (50, 500, 5000)}
+
+
+def convert_names():
+    _convert_names_with_underlines_to_dots(dict(MATCH_KWARGS), convert_operators=True)
+
+
+def convert_wide_names():
+    _convert_names_with_underlines_to_dots(dict(WIDE_KWARGS), convert_operators=True)
+
+
+def convert_huge_names():
+    _convert_names_with_underlines_to_dots(dict(HUGE_KWARGS), convert_operators=True)
+
+
+def match():
+    MongoAggregation().match(**MATCH_KWARGS)
+
+
+def sort():
+    MongoAggregation().sort('-date', cashbox__name=1)
+
+
+def project():
+    MongoAggregation().project(date=1, cashbox__name=1, transactions__amount=1)
+
+
+def add_fields():
+    MongoAggregation().add_fields(cashbox__name='$cashbox.title', total='$transactions.amount')
+
+
+def group():
+    MongoAggregation().group(group_by='cashbox,date', sum_fields='amount,transactions__amount',
+                             first_fields='client__name', counter_fields='count')
+
+
+def typical_chain():
+    MongoAggregation().match(**MATCH_KWARGS).lookup_unwind('cashbox').smart_project(
+        'date,cashbox,amount', total='$transactions.amount').group(
+        group_by='cashbox__name', sum_fields='total,amount', counter_fields='count')
+
+
+def _smart_project(number):
+    def case():
+        # Includes copying of actual fields
+        aggregation = MongoAggregation()
+        aggregation.actual_fields = ACTUAL_FIELDS[number].copy()
+        aggregation.smart_project('field_1.c.d,field_2', 'field_3.a', total='$field_4.b')
+    return case
+
+
+def switch_pattern():
+    switch(SWITCH_CASES, final_else='unknown')
+
+
+def switch_compare_pattern():
+    switch_compare('$status', SWITCH_COMPARE_CASES, final_else='unknown')
+
+
+def logical_patterns():
+    and_({'a': 1}, date__gte=DATE, client__name__icontains='john')
+    or_({'a': 1}, date__lt=DATE, cashbox__in=[1, 2])
+
+
+def obj_pattern():
+    obj('name,description', id='$code', client__name='$client.name')
+
+
+CASES = {
+    'convert_names': convert_names,
+    'convert_names_200_kwargs': convert_wide_names,
+    'convert_names_5000_kwargs': convert_huge_names,
+    'match': match,
+    'sort': sort,
+    'project': project,
+    'add_fields': add_fields,
+    'group': group,
+    'and_or': logical_patterns,
+    'obj': obj_pattern,
+    'typical_chain': typical_chain,
+    'smart_project_50_fields': _smart_project(50),
+    'smart_project_500_fields': _smart_project(500),
+    'smart_project_5000_fields': _smart_project(5000),
+    'switch_300_cases': switch_pattern,
+    'switch_compare_300_cases': switch_compare_pattern,
+}
+
+
+def run(cases=CASES, number=2000, repeat=5):
+    """Returns dictionary {case name: best time of a single call in microseconds}."""
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=repeat)) / number * 1e6
+        for name, case in cases.items()
+    }
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, microseconds in run(number=number).items():
+        print(f'{name:<30}{microseconds:>10.2f} us')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""End-to-end execution against the in-process engine.
+
+Usage: python benchmarks/execution.py [number of runs]
+"""
+
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mongo_aggregation import MongoAggregation  # noqa: E402
+from mongo_aggregation.engine import InMemoryEngine  # noqa: E402
+
+DATE = datetime(2021, 1, 1)
+
+
+def _database(actions=10000, cashboxes=50, seed=0):
+    generator = random.Random(seed)
+    return InMemoryEngine({
+        'action': [
+            {
+                '_id': i, 'date': DATE + timedelta(minutes=i), 'completed': generator.random() > 0.3,
+                'cashbox': generator.randrange(cashboxes), 'amount': generator.randrange(1, 10000) / 100,
+                'client': {'name': generator.choice(['John', 'Mary', 'Johnny', 'Ann'])},
+                'transactions': [{'amount': generator.randrange(100)} for _ in range(generator.randrange(4))],
+            }
+            for i in range(actions)
+        ],
+        'cashbox': [{'_id': i, 'name': f'Cashbox {i}'} for i in range(cashboxes)],
+    })
+
+
+DATABASE = _database()
+
+
+def match_group():
+    MongoAggregation(collection=DATABASE.action).match(completed=True, amount__gte=10).group(
+        group_by='cashbox', sum_fields='amount', counter_fields='count').aggregate(as_list=True)
+
+
+def lookup_unwind():
+    MongoAggregation(collection=DATABASE.action).match(client__name__icontains='john').lookup_unwind(
+        'cashbox').project(cashbox__name=1, amount=1).aggregate(as_list=True)
+
+
+def top_k():
+    MongoAggregation(collection=DATABASE.action).sort('-amount', '_id').limit(10).aggregate(as_list=True)
+
+
+def unwind_group():
+    MongoAggregation(collection=DATABASE.action).unwind('transactions').group(
+        group_by='client__name', sum_fields='transactions__amount').aggregate(as_list=True)
+
+
+def paginate():
+    MongoAggregation(collection=DATABASE.action).match(completed=True).sort('date').paginate(page=5, per_page=20)
+
+
+CASES = {
+    'match_group': match_group,
+    'lookup_unwind': lookup_unwind,
+    'top_k': top_k,
+    'unwind_group': unwind_group,
+    'paginate': paginate,
+}
+
+
+def run(cases=CASES, number=3, repeat=3):
+    """Returns dictionary {case name: best time of a single call in microseconds}."""
+    return {
+        name: min(timeit.repeat(case, number=number, repeat=repeat)) / number * 1e6
+        for name, case in cases.items()
+    }
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for name, microseconds in run(number=number).items():
+        print(f'{name:<30}{microseconds:>12.0f} us')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Runs benchmark suites, writes JSON results and checks them against the baseline.
+
+Usage:
+    python benchmarks/run.py                      # compare with benchmarks/baseline.json
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --save-baseline      # after intended changes or on a new machine
+    python benchmarks/run.py --suites builder --cases match,group
+
+Exits with status 1 if any case is slower than the baseline by more than the tolerance.
+The baseline keeps times relative to a calibration workload (pure python loop, dictionaries and sorting)
+measured in the same run, so it's comparable between machines. Relative times still depend on the Python
+version and the CPU family, which are recorded in the baseline and reported if they differ.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import builder  # noqa: E402
+import execution  # noqa: E402
+
+SUITES = {'builder': builder.CASES, 'execution': execution.CASES}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def calibration():
+    """Reference workload: the interpreter operations the cases consist of."""
+    documents = [{'_id': i, 'name': f'item {i}', 'amount': i % 7} for i in range(500)]
+    sorted(documents, key=lambda document: (document['amount'], document['name']))
+
+
+def environment():
+    """Returns description of the machine the timings depend on."""
+    return {
+        'python': platform.python_version(), 'implementation': platform.python_implementation(),
+        'machine': platform.machine(), 'processor': platform.processor() or platform.machine(),
+    }
+
+
+def measure(case, repeat=5):
+    """Returns the best time of a single call in microseconds. Number of calls per run is chosen automatically."""
+    timer = timeit.Timer(case)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run(suites=SUITES, cases=None, repeat=5):
+    """Returns dictionary {'suite.case': microseconds}."""
+    results = {}
+    for suite, suite_cases in suites.items():
+        for name, case in suite_cases.items():
+            if cases and name not in cases:
+                continue
+            results[f'{suite}.{name}'] = measure(case, repeat)
+    return results
+
+
+def relative(results, calibration_us):
+    """Returns the times as ratios to the calibration time."""
+    return {name: microseconds / calibration_us for name, microseconds in results.items()}
+
+
+def compare(results, baseline, tolerance):
+    """Returns list of tuples (case, baseline, result) of the cases slower than the baseline (relative times)."""
+    return [
+        (name, baseline[name], microseconds)
+        for name, microseconds in results.items()
+        if name in baseline and microseconds > baseline[name] * (1 + tolerance)
+    ]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--suites', default=','.join(SUITES), help='Comma separated suites')
+    parser.add_argument('--cases', default='', help='Comma separated cases, all by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results to the baseline')
+    arguments = parser.parse_args(arguments)
+
+    suites = {suite: SUITES[suite] for suite in arguments.suites.split(',')}
+    calibration_us = measure(calibration, arguments.repeat)
+    timings = run(suites, set(filter(None, arguments.cases.split(','))), arguments.repeat)
+    results = relative(timings, calibration_us)
+    report = dict(environment(), unit='calibration', calibration_us=calibration_us, results=results, timings_us=timings)
+    print(f'{"calibration":<40}{calibration_us:>14.2f} us')
+    for name, microseconds in timings.items():
+        print(f'{name:<40}{microseconds:>14.2f} us{results[name]:>12.4f} x')
+    if arguments.output:
+        _write(arguments.output, report)
+
+    baseline = {}
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('unit') != 'calibration':
+            # Absolute timings of the previous format are not comparable
+            baseline = {}
+    if arguments.save_baseline:
+        report['results'] = dict(baseline.get('results', {}), **results)
+        report['timings_us'] = dict(baseline.get('timings_us', {}), **timings)
+        _write(arguments.baseline, report)
+        return 0
+
+    if not baseline:
+        print(f'No baseline {arguments.baseline}, run with --save-baseline')
+        return 0
+    differences = {key: baseline.get(key) for key, value in environment().items() if baseline.get(key) != value}
+    if differences:
+        print(f'Baseline is recorded on another environment: {differences}')
+    regressions = compare(results, baseline['results'], arguments.tolerance)
+    for name, expected, ratio in regressions:
+        print(f'Regression {name}: {ratio:.4f} x calibration, baseline {expected:.4f} x '
+              f'(+{(ratio / expected - 1) * 100:.0f}%)')
+    return 1 if regressions else 0
+
+
+def _write(path, report):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+        file.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from collections.abc import MutableSet
+
+
+class _Node(object):
+    __slots__ = ('children', 'count', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        # Number of fields in the subtree including the node itself
+        self.count = 0
+        self.terminal = False
+
+
+class FieldPathTrie(MutableSet):
+    """
+    Set of dotted field paths stored as a prefix tree of path parts.
+    Parent and children queries cost O(depth) instead of a pass over all the fields.
+    Iterates fields in insertion order.
+
+    >>> fields = FieldPathTrie(['menu.elements.option', 'menu.count', 'name'])
+    >>> fields.has_descendants('menu'), fields.has_descendants('name')
+    (True, False)
+    >>> sorted(fields.parents())
+    ['menu', 'menu.elements']
+    >>> fields.add('menu')
+    >>> fields.roots()
+    ['name', 'menu']
+    """
+
+    def __init__(self, fields=()):
+        self._root = _Node()
+        self._fields = {}
+        for field in fields:
+            self.add(field)
+
+    def __contains__(self, field):
+        return field in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, list(self._fields))
+
+    def _find(self, field):
+        node = self._root
+        for part in field.split('.'):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def add(self, field):
+        if field in self._fields:
+            return
+        node = self._root
+        node.count += 1
+        for part in field.split('.'):
+            node = node.children.setdefault(part, _Node())
+            node.count += 1
+        node.terminal = True
+        self._fields[field] = None
+
+    def discard(self, field):
+        if field not in self._fields:
+            return
+        del self._fields[field]
+        node = self._root
+        node.count -= 1
+        for part in field.split('.'):
+            child = node.children[part]
+            child.count -= 1
+            if not child.count:
+                # Prune the empty branch
+                del node.children[part]
+                return
+            node = child
+        node.terminal = False
+
+    def update(self, *fields_lists):
+        for fields in fields_lists:
+            for field in fields:
+                self.add(field)
+
+    def copy(self):
+        return self.__class__(self)
+
+    def has_descendants(self, field):
+        """Checks if there are fields nested into the field."""
+        node = self._find(field)
+        return node is not None and node.count > node.terminal
+
+    def has_ancestors(self, field):
+        """Checks if there are fields containing the field."""
+        node = self._root
+        for part in field.split('.')[:-1]:
+            node = node.children.get(part)
+            if node is None:
+                return False
+            if node.terminal:
+                return True
+        return False
+
+    def count_overlapping(self, field):
+        """Returns the number of fields equal to the field, containing it or nested into it."""
+        node = self._root
+        count = 0
+        for part in field.split('.'):
+            node = node.children.get(part)
+            if node is None:
+                return count
+            count += node.terminal
+        return count + node.count - node.terminal
+
+    def descendants(self, field):
+        """Returns the fields nested into the field."""
+        node = self._find(field)
+        if node is None:
+            return []
+        return [
+            path for path in self._walk(node, field)
+            if path != field
+        ]
+
+    def parents(self):
+        """Returns all the paths having nested fields. Same as MongoAggregation.get_parents(fields, all_levels=True)."""
+        parents = []
+        stack = [(self._root, '')]
+        while stack:
+            node, path = stack.pop()
+            for part, child in node.children.items():
+                child_path = f'{path}.{part}' if path else part
+                if child.children:
+                    parents.append(child_path)
+                    stack.append((child, child_path))
+        return parents
+
+    def roots(self):
+        """Returns the fields which are not nested into other fields."""
+        return [field for field in self._fields if not self.has_ancestors(field)]
+
+    def startswith(self, prefix):
+        """Returns the fields starting with the string (not necessarily at a path part boundary)."""
+        *parents, last = prefix.split('.')
+        node = self._root
+        path = ''
+        for part in parents:
+            node = node.children.get(part)
+            if node is None:
+                return []
+            path = f'{path}.{part}' if path else part
+        fields = []
+        for part, child in node.children.items():
+            if part.startswith(last):
+                fields.extend(self._walk(child, f'{path}.{part}' if path else part))
+        return fields
+
+    def _walk(self, node, path):
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            if node.terminal:
+                yield path
+            for part, child in node.children.items():
+                stack.append((child, f'{path}.{part}'))
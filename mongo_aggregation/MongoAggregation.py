@@ -1,42 +1,546 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import inspect
 import logging
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from itertools import chain, combinations, product
+from itertools import chain
+from time import perf_counter
 
 import six
 
+from .FieldPathTrie import FieldPathTrie
+from .batching import DEFAULT_BATCH_SIZE, DEFAULT_MEMORY_BUDGET, AdaptiveBatchCursor
+from .cache import MemoryCache, collection_name, pipeline_key
+from .columns import stage_fields, to_columns
+from .engine import InMemoryCollection
+from .executor import PipelineExecutor, shared_executor
+from .facets import run_combined
+from .indexes import suggest_indexes
+from .instrumentation import InstrumentedCursor, collection_label, shape_fingerprint, timed
+from .joins import batched_lookup, batched_lookup_async
+from .keyset import decode_token, encode_token, get_path, seek_condition
+from .optimizer import (
+    can_hoist_match, count_pipeline, limit_position, merge_queries, narrow_lookups, optimize_pipeline,
+    push_down_limit,
+)
+from .partitions import (
+    add_condition, check_partitionable, hashed_conditions, merge_group_results, partial_group, range_conditions,
+    split_points,
+)
+from .raw import lazy_documents, raw_collection
+from .rollups import incremental_group, narrow_pipeline, watermark_condition
+from .templates import CompiledPipeline
 from .patterns import dollar_prefix, pop_dollar_prefix, _convert_names_with_underlines_to_dots
 
 logger = logging.getLogger(__name__)
 
 
+def _execution_options(**options):
+    """Returns the options which are set."""
+    return {name: value for name, value in options.items() if value is not None}
+
+
+def _document_size(document):
+    """Returns BSON size of the document."""
+    raw = getattr(document, 'raw', None)
+    if raw is not None:
+        return len(raw)
+    import bson
+    return len(bson.encode(document))
+
+
 class MongoAggregation(list):
 
-    def __init__(self, pipeline='', collection='', allowDiskUse=False):
+    def __init__(self, pipeline='', collection='', allowDiskUse=False, optimize=False, cache=None,
+                 instrumentation=None):
         self.collection = collection
         self.allowDiskUse = allowDiskUse
-        self.actual_fields = set()
+        self.actual_fields = FieldPathTrie()
         self.pipeline = pipeline if pipeline else []
+        self.optimization = optimize
+        self.optimization_report = []
+        self.cache = cache
+        self.instrumentation = instrumentation
+        # 'as' fields of $lookup stages narrowed to the fields read by the following stages
+        self.narrowed_lookups = set()
+        # 'as' fields of $lookup by _id with preserving $unwind which match at most one document (scalar local field)
+        self.unique_lookups = set()
+        # Joins made on the client after the pipeline is run
+        self.client_lookups = []
 
-    def aggregate(self, collection='', allowDiskUse=False, as_list=False, collation=None):
-        if collection:
+    @property
+    def actual_fields(self):
+        """Fields of the documents at the end of the pipeline."""
+        return self._actual_fields
+
+    @actual_fields.setter
+    def actual_fields(self, fields):
+        self._actual_fields = fields if isinstance(fields, FieldPathTrie) else FieldPathTrie(fields)
+
+    def optimize(self):
+        """Rewrites the pipeline in place with the rules of the optimizer module.
+        Returns the report - list of applied rewrites."""
+        self.pipeline, self.optimization_report = optimize_pipeline(self.pipeline)
+        return self.optimization_report
+
+    def _get_aggregate_call(self, pipeline=None, collection='', allowDiskUse=False, collation=None, optimize=None,
+                            raw=False, **options):
+        """Returns function without arguments which sends the pipeline to the collection.
+        Options are passed to the driver aggregate method as is.
+        With raw the collection returns RawBSONDocument.
+        Returns None if the collection is not specified."""
+        if collection or isinstance(collection, list):
             self.collection = collection
         if self.collection.__class__.__name__ == 'TopLevelDocumentMetaclass':
             self.collection = self.collection.objects
+        if isinstance(self.collection, list) and not isinstance(self.collection, MongoAggregation):
+            # List of documents is aggregated in process
+            self.collection = InMemoryCollection(self.collection)
         if allowDiskUse:
             self.allowDiskUse = allowDiskUse
         if self.collection.__class__.__name__ != 'QuerySet' and not self.collection:
             logger.error('Агрегация невозможна: не указана коллекция')
-            return
-        aggregate = partial(self.collection.aggregate, allowDiskUse=self.allowDiskUse, collation=collation)
+            return None
+        if pipeline is None:
+            pipeline = self.pipeline
+        if self.optimization if optimize is None else optimize:
+            # Send optimized copy, the pipeline itself stays as built
+            pipeline, self.optimization_report = optimize_pipeline(pipeline)
+        if self.narrowed_lookups:
+            pipeline = narrow_lookups(pipeline, [], self.narrowed_lookups)
+        target = raw_collection(self.collection) if raw else self.collection
+        aggregate = partial(target.aggregate, allowDiskUse=self.allowDiskUse, collation=collation, **options)
         if self.collection.__class__.__name__ == 'QuerySet':
-            result = aggregate(*self.pipeline)
+            aggregate = partial(aggregate, *pipeline)
         else:
-            result = aggregate(self.pipeline)
-        return list(result) if as_list else result
+            aggregate = partial(aggregate, pipeline)
+        if self.instrumentation is not None:
+            return partial(self._instrumented_call, aggregate, pipeline)
+        return aggregate
+
+    def _instrumented_call(self, aggregate, pipeline):
+        """Runs aggregate call and wraps the cursor to measure it. Asynchronous cursors are not measured."""
+        started = perf_counter()
+        result = aggregate()
+        if inspect.isawaitable(result) or not hasattr(result, '__iter__'):
+            return result
+        measurement = {
+            'event': 'aggregate', 'fingerprint': shape_fingerprint(pipeline),
+            'collection': collection_label(self.collection),
+        }
+        document_size = _document_size if self.instrumentation.measure_bytes else None
+        return InstrumentedCursor(
+            result, measurement, started, partial(self._report_execution, pipeline), document_size)
+
+    def _report_execution(self, pipeline, measurement):
+        """Logs slow execution, captures explain output and passes the measurement to the hooks."""
+        instrumentation = self.instrumentation
+        if instrumentation.explain_ms is not None and measurement['total_ms'] >= instrumentation.explain_ms:
+            measurement['explain'] = self._explain(pipeline)
+        if instrumentation.slow_ms is not None and measurement['total_ms'] >= instrumentation.slow_ms:
+            logger.warning(
+                f'Slow pipeline {measurement["fingerprint"]} on {measurement["collection"] or "collection"}: '
+                f'{measurement["total_ms"]:.1f} ms, {measurement["documents"]} documents'
+            )
+        instrumentation.emit(measurement)
+
+    def _explain(self, pipeline):
+        """Returns explain output of the pipeline or None if the collection can't explain it."""
+        collection = self.collection
+        if collection.__class__.__name__ == 'QuerySet':
+            collection = collection._collection
+        database = getattr(collection, 'database', None)
+        if isinstance(collection, InMemoryCollection) or not hasattr(database, 'command'):
+            return None
+        try:
+            return database.command(
+                'explain', {'aggregate': collection.name, 'pipeline': list(pipeline), 'cursor': {}},
+                verbosity='queryPlanner',
+            )
+        except Exception as error:
+            logger.warning(f'Explain failed: {error}')
+            return None
+
+    def aggregate(self, collection='', allowDiskUse=False, as_list=False, collation=None, optimize=None, cache=None,
+                  pipeline=None, as_columns=False, dtypes=None, structured=False, raw=False, eager_fields=None,
+                  batchSize=None, maxTimeMS=None, hint=None, comment=None, let=None, adaptive=False,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, client_lookups=True):
+        """
+        Runs the pipeline.
+        batchSize, maxTimeMS, hint, comment and let are passed to the driver.
+        :param cache: Cache backend (see cache module), by default the one passed to constructor.
+            False disables caching. Cached results are materialized,
+            so iterator over the list is returned instead of cursor.
+        :param pipeline: Pipeline to send instead of the built one
+        :param as_columns: Return dictionary {field path: numpy array} (requires numpy).
+            Columns are the fields of the final $group, $count or inclusion $project stage,
+            otherwise the leaf fields of all the documents
+        :param dtypes: Dictionary {field path: numpy dtype} for as_columns
+        :param structured: Return numpy structured array instead of dictionary of columns
+        :param raw: Return LazyDocument objects decoding fields on access (requires pymongo collection).
+            Raw results are not cached
+        :param eager_fields: Top level fields decoded at once in raw mode. True means the fields of actual_fields
+        :param adaptive: Change cursor batch size after each batch by documents size and consumer speed
+            (see batching module), batchSize is the first batch size. Cached results are not adapted
+        :param memory_budget: Maximum size of a batch in bytes for adaptive mode
+        :param client_lookups: Join client lookups, False for the queries whose documents aren't the pipeline result
+        """
+        if pipeline is None:
+            pipeline = self.pipeline
+        options = _execution_options(batchSize=batchSize, maxTimeMS=maxTimeMS, hint=hint, comment=comment, let=let)
+        aggregate = self._get_aggregate_call(
+            pipeline, collection=collection, allowDiskUse=allowDiskUse, collation=collation, optimize=optimize,
+            raw=raw, **options)
+        if not aggregate:
+            return
+        if raw and client_lookups and self.client_lookups:
+            raise ValueError('Client lookups can not be applied to raw documents.')
+        if cache is None:
+            cache = self.cache
+        if raw:
+            if eager_fields is True:
+                eager_fields = list(dict.fromkeys(field.split('.')[0] for field in self.actual_fields.roots()))
+            cursor = aggregate()
+            if adaptive:
+                cursor = AdaptiveBatchCursor(
+                    cursor, memory_budget, batchSize or DEFAULT_BATCH_SIZE, document_size=_document_size)
+            result = lazy_documents(cursor, eager_fields or (), self.collection.codec_options)
+        # Empty cache is falsy, so compare explicitly
+        elif cache is None or cache is False:
+            result = aggregate()
+            if adaptive:
+                result = AdaptiveBatchCursor(
+                    result, memory_budget, batchSize or DEFAULT_BATCH_SIZE, document_size=_document_size)
+        else:
+            key = pipeline_key(self.collection, pipeline, collation, self.allowDiskUse, let)
+            found, result = cache.get(key)
+            if not found:
+                result = list(aggregate())
+                cache.set(key, result, self.collection)
+            if not as_list:
+                result = iter(result)
+        if client_lookups:
+            result = self._joined(result)
+
+        if as_columns or structured:
+            # Client lookups add fields after the last stage
+            fields = stage_fields(pipeline[-1]) if pipeline and not (client_lookups and self.client_lookups) else None
+            return to_columns(result, fields, dtypes, structured)
+        return list(result) if as_list and not isinstance(result, list) else result
+
+    def materialize(self, into, on='_id', watermark_field=None, watermarks='watermarks', name='', out=False,
+                    collection='', allowDiskUse=False, collation=None, optimize=None):
+        """
+        Runs the pipeline with $merge into the collection, so the results stay on the server.
+        With watermark_field each run aggregates only the documents with the field greater than the highest value
+        of the previous run (the leading $match is narrowed), the highest value is saved to watermarks collection
+        after the run. Results of the final $group are combined with the stored ones: sums are added,
+        $min/$max/$push/$addToSet are merged, $avg is weighted by the number of values kept in '<field>__avg_count'.
+        The field values must grow with new documents, e.g. creation date or ObjectId.
+        Failed run may leave results merged partially, so the next run would merge them again.
+        :param into: Name of the collection of the results (in the database of the pipeline collection)
+        :param on: Fields identifying the results for $merge, the unique index on them is required
+        :param watermarks: Name of the collection of the highest values, documents {'_id': name, 'value'}
+        :param name: Name of the watermark, by default '<collection>-><into>'
+        :param out: Replace the collection with $out, the pipeline isn't narrowed
+        :return: Dictionary {'previous': watermark of the previous run, 'watermark': saved watermark,
+            'pipeline': sent pipeline or None if there are no new documents}
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({'action': [
+        ...     {'_id': 1, 'cashbox': 1, 'price': 10}, {'_id': 2, 'cashbox': 1, 'price': 20},
+        ...     {'_id': 3, 'cashbox': 2, 'price': 5}]})
+        >>> def rollup():
+        ...     return MongoAggregation(collection=engine.action).group(
+        ...         group_by='cashbox', avg_fields='price', counter_fields='count',
+        ...     ).materialize('prices', watermark_field='_id')
+        >>> rollup()['watermark'], engine.prices.documents[0]
+        (3, {'_id': 1, 'price': 15.0, 'price__avg_count': 2, 'count': 2})
+
+        The second run updates existing groups (the average is weighted) and inserts new ones:
+
+        >>> engine.action.insert_one({'_id': 4, 'cashbox': 1, 'price': 60})
+        >>> engine.action.insert_one({'_id': 5, 'cashbox': 3, 'price': 1})
+        >>> rollup()['previous'], [(total['_id'], total['price'], total['count']) for total in engine.prices.documents]
+        (3, [(1, 30.0, 3), (2, 5.0, 1), (3, 1.0, 1)])
+
+        Run without new documents sends nothing:
+
+        >>> rollup(), len(engine.prices.documents)
+        ({'previous': 5, 'watermark': 5, 'pipeline': None}, 3)
+
+        out replaces the collection with the whole result:
+
+        >>> pipeline = MongoAggregation(collection=engine.action).match(cashbox=1).project(price=1)
+        >>> pipeline.materialize('cashbox_prices', out=True)['pipeline'][-1]
+        {'$out': 'cashbox_prices'}
+        >>> engine.cashbox_prices.insert_one({'_id': 'stale'})
+        >>> pipeline.materialize('cashbox_prices', out=True)['watermark'], engine.cashbox_prices.documents
+        (None, [{'_id': 1, 'price': 10}, {'_id': 2, 'price': 20}, {'_id': 4, 'price': 60}])
+        """
+        kwargs = dict(collection=collection, allowDiskUse=allowDiskUse, collation=collation, optimize=optimize)
+        if out or not watermark_field:
+            pipeline = list(self.pipeline)
+            if out:
+                pipeline.append({'$out': into})
+            else:
+                pipeline.append({'$merge': {'into': into, 'on': on, 'whenMatched': 'replace'}})
+            aggregate = self._get_aggregate_call(pipeline, **kwargs)
+            if aggregate:
+                list(aggregate())
+            return {'previous': None, 'watermark': None, 'pipeline': pipeline}
+
+        if not self._get_aggregate_call(pipeline=[], **kwargs):
+            return
+        watermarks = self._foreign_collection(watermarks)
+        name = name or f'{collection_name(self.collection)}->{into}'
+        previous = (watermarks.find_one({'_id': name}) or {}).get('value')
+        # Upper bound keeps documents inserted during the run for the next one
+        query = self.pipeline[0]['$match'] if self.pipeline and '$match' in self.pipeline[0] else {}
+        last = next(self._get_aggregate_call([
+            {'$match': add_condition(query, watermark_condition(watermark_field, previous))},
+            {'$sort': {watermark_field: -1}}, {'$limit': 1}, {'$project': {watermark_field: 1}},
+        ], collation=collation)(), None)
+        if last is None:
+            return {'previous': previous, 'watermark': previous, 'pipeline': None}
+        current = get_path(last, watermark_field)
+
+        pipeline = narrow_pipeline(self.pipeline, watermark_condition(watermark_field, previous, current))
+        when_matched = 'merge'
+        if pipeline[-1].get('$group'):
+            stages, when_matched = incremental_group(pipeline[-1]['$group'])
+            pipeline[-1:] = stages
+        pipeline.append({'$merge': {'into': into, 'on': on, 'whenMatched': when_matched, 'whenNotMatched': 'insert'}})
+        list(self._get_aggregate_call(pipeline, **kwargs)())
+        watermarks.update_one({'_id': name}, {'$set': {'value': current, 'field': watermark_field}}, upsert=True)
+        return {'previous': previous, 'watermark': current, 'pipeline': pipeline}
+
+    def compile(self, encode_static=False):
+        """Returns CompiledPipeline - template of the pipeline with Param placeholders,
+        which are substituted by bind method without rebuilding the pipeline.
+        :param encode_static: Encode stages without parameters to BSON once (requires pymongo).
+            Encoded stages are opaque to the optimizer and to count and limit pushdown"""
+        return CompiledPipeline(self, encode_static)
+
+    def invalidate_cache(self):
+        """Removes cached results of the pipeline collection."""
+        if self.cache is not None:
+            self.cache.invalidate(self.collection)
+
+    async def aggregate_async(self, collection='', allowDiskUse=False, as_list=False, collation=None,
+                              optimize=None, pipeline=None, batchSize=None, maxTimeMS=None, hint=None, comment=None,
+                              let=None, client_lookups=True):
+        """Asynchronous version of aggregate for asyncio drivers (Motor, PyMongo async API).
+        Collection aggregate method may either return async cursor or a coroutine returning it.
+        Use pipeline argument to send another pipeline instead of the built one.
+        client_lookups=False skips the join like in aggregate.
+
+        >>> import asyncio
+        >>> from mongo_aggregation.engine import InMemoryCollection
+        >>> class AsyncCursor(object):
+        ...     def __init__(self, documents):
+        ...         self.documents = iter(documents)
+        ...     def __aiter__(self):
+        ...         return self
+        ...     async def __anext__(self):
+        ...         for document in self.documents:
+        ...             return document
+        ...         raise StopAsyncIteration
+        >>> class AsyncCollection(InMemoryCollection):
+        ...     async def aggregate(self, pipeline, **options):
+        ...         return AsyncCursor(super().aggregate(pipeline, **options))
+        >>> collection = AsyncCollection([{'_id': 1, 'amount': 10}, {'_id': 2, 'amount': 5}, {'_id': 3}])
+        >>> pipeline = MongoAggregation(collection=collection).match(amount__gte=5).sort('-amount')
+        >>> async def run():
+        ...     return (await pipeline.aggregate_async(as_list=True), await pipeline.count_async(),
+        ...             await pipeline.get_first_async(), [document['_id'] async for document in pipeline])
+        >>> asyncio.run(run())
+        ([{'_id': 1, 'amount': 10}, {'_id': 2, 'amount': 5}], 2, {'_id': 1, 'amount': 10}, [1, 2])
+
+        Client lookups read the foreign collection with async for, count_async doesn't join them:
+
+        >>> class AsyncForeignCollection(InMemoryCollection):
+        ...     queries = 0
+        ...     def find(self, *args, **kwargs):
+        ...         self.queries += 1
+        ...         return AsyncCursor(super().find(*args, **kwargs))
+        >>> cashboxes = AsyncForeignCollection([{'_id': 1, 'name': 'Main'}], 'cashbox')
+        >>> joined = MongoAggregation(collection=collection).match(amount__gte=5).sort('_id').client_lookup(
+        ...     cashboxes, '_id', 'cashbox', unwind=True, fields='name')
+        >>> async def run():
+        ...     return await joined.aggregate_async(as_list=True), await joined.count_async()
+        >>> asyncio.run(run()), cashboxes.queries
+        (([{'_id': 1, 'amount': 10, 'cashbox': {'_id': 1, 'name': 'Main'}}, {'_id': 2, 'amount': 5}], 2), 1)
+        """
+        options = _execution_options(batchSize=batchSize, maxTimeMS=maxTimeMS, hint=hint, comment=comment, let=let)
+        aggregate = self._get_aggregate_call(
+            pipeline, collection=collection, allowDiskUse=allowDiskUse, collation=collation, optimize=optimize,
+            **options)
+        if not aggregate:
+            return
+        result = aggregate()
+        if inspect.isawaitable(result):
+            result = await result
+        if client_lookups and self.client_lookups:
+            result = self._joined_async(result)
+        if as_list:
+            return [document async for document in result]
+        return result
+
+    async def __aiter__(self):
+        """Allows iterating over the aggregation result with async for."""
+        cursor = await self.aggregate_async()
+        if cursor is None:
+            return
+        async for document in cursor:
+            yield document
+
+    def iter_batches(self, batch_size=1000, max_bytes=None, **kwargs):
+        """
+        Streams the aggregation result by lists of documents.
+        Batch size is passed to the driver cursor as batchSize.
+        The generator drops its reference to a yielded batch when the next one is requested.
+        :param batch_size: Maximum number of documents in a batch
+        :param max_bytes: Maximum size of a batch in bytes (BSON size of documents).
+            The batch is emitted before the document which would exceed the size,
+            a document larger than max_bytes makes a batch alone
+        :param kwargs: aggregate arguments: collection, allowDiskUse, collation, optimize
+
+        >>> documents = [{'_id': i, 'a': 'x' * 10} for i in range(5)]
+        >>> [len(batch) for batch in MongoAggregation(collection=documents).iter_batches(3, max_bytes=70)]
+        [2, 2, 1]
+        """
+        aggregate = self._get_aggregate_call(batchSize=batch_size, **kwargs)
+        if not aggregate:
+            return
+        batch, size = [], 0
+        for document in self._joined(aggregate(), kwargs.get('raw')):
+            document_size = _document_size(document) if max_bytes else 0
+            if batch and max_bytes and size + document_size > max_bytes:
+                yield batch
+                batch, size = [], 0
+            batch.append(document)
+            size += document_size
+            if len(batch) >= batch_size:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def aggregate_parallel(self, partitions=4, key='_id', strategy='range', bounds=None, max_workers=None,
+                           collection='', allowDiskUse=False, collation=None, optimize=None):
+        """
+        Runs the pipeline by partitions in a thread pool and merges the results on the client.
+        Partitions are made by adding a condition on the key to the leading $match.
+        If the pipeline ends with $group, partial results are combined by $group operators,
+        $avg is computed as a sum/count pair.
+        :param partitions: Number of partitions
+        :param key: Field to split documents by
+        :param strategy: 'range' - split the range of key values (numbers, dates, ObjectId by generation time)
+            into equal parts, 'hash' - split by $toHashedIndexKey of the key. No index serves hashed partitions,
+            so each of them scans all the documents matching the leading $match
+        :param bounds: Tuple of the lowest and the highest key values. Fetched from the collection if not specified.
+            Documents with null or missing key are run as a separate partition.
+            If no document has the key, the pipeline is run serially
+        :param max_workers: Number of threads, by default equals to the number of partitions
+        :return: List of documents
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({'action': [
+        ...     {'_id': 1, 'd': 5, 'x': 1}, {'_id': 2, 'x': 2}, {'_id': 3, 'd': 9, 'x': 3}]})
+        >>> MongoAggregation(collection=engine.action).match(x__gte=1).aggregate_parallel(partitions=2, key='d')
+        [{'_id': 2, 'x': 2}, {'_id': 1, 'd': 5, 'x': 1}, {'_id': 3, 'd': 9, 'x': 3}]
+        >>> MongoAggregation(collection=engine.action).group(x={'$sum': '$x'}).aggregate_parallel(key='missing')
+        [{'_id': None, 'x': 6}]
+        """
+        check_partitionable(self.pipeline)
+        if not self._get_aggregate_call(collection=collection, allowDiskUse=allowDiskUse):
+            return
+        if self.pipeline and '$match' in self.pipeline[0]:
+            query, stages = self.pipeline[0]['$match'], self.pipeline[1:]
+        else:
+            query, stages = {}, self.pipeline
+
+        if strategy == 'hash':
+            conditions = hashed_conditions(key, partitions)
+        else:
+            if bounds is None:
+                bounds = self._get_key_bounds(query, key, collation)
+            if bounds is None:
+                # No document has the key, so there is nothing to split
+                return self.aggregate(as_list=True, collation=collation, optimize=optimize)
+            conditions = range_conditions(key, split_points(*bounds, partitions))
+
+        group_stage = stages[-1]['$group'] if stages and '$group' in stages[-1] else None
+        if group_stage:
+            stages = stages[:-1] + [{'$group': partial_group(group_stage)}]
+        pipelines = [[{'$match': add_condition(query, condition)}] + stages for condition in conditions]
+
+        def run(pipeline):
+            return list(self._get_aggregate_call(pipeline, collation=collation, optimize=optimize)())
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(pipelines)) as executor:
+            results = list(executor.map(run, pipelines))
+        if group_stage:
+            return list(self._joined(merge_group_results(group_stage, results)))
+        return list(self._joined(chain(*results)))
+
+    @staticmethod
+    def run_many(pipelines, max_workers=None, timeout=None, raise_errors=False, executor=None, **kwargs):
+        """
+        Runs independent pipelines concurrently (see executor module).
+        :param pipelines: MongoAggregation objects (run by aggregate with as_list) or callables without arguments,
+            e.g. partial(pipeline.count)
+        :param max_workers: Number of threads of a pool of this call, by default the shared pool
+            of executor.SHARED_MAX_WORKERS threads is used
+        :param timeout: Seconds to wait for each pipeline, a number or a list by pipelines.
+            MongoAggregation objects get the remaining time as maxTimeMS, callables are not bounded on the server
+        :param raise_errors: Raise the first error instead of returning partial results
+        :param executor: PipelineExecutor to run the pipelines
+        :param kwargs: aggregate arguments
+        :return: PipelineResults - list of results in the order of pipelines (None for failed ones)
+            with errors dictionary {pipeline index: exception}
+        """
+        if executor is None and max_workers:
+            executor = PipelineExecutor(max_workers)
+            try:
+                return executor.run(pipelines, timeout, raise_errors, **kwargs)
+            finally:
+                # Timed out pipelines are not waited for
+                executor.close(wait=False)
+        return (executor or shared_executor()).run(pipelines, timeout, raise_errors, **kwargs)
+
+    @staticmethod
+    def aggregate_combined(pipelines, **kwargs):
+        """
+        Sends pipelines of the same collection sharing leading stages as one aggregation:
+        the shared stages followed by $facet with the remaining stages of each pipeline (see facets module).
+        Falls back to separate queries if the pipelines can't be combined or the result exceeds 16 MB.
+        :param pipelines: MongoAggregation objects or facets.Count markers (result is the number of documents)
+        :param kwargs: aggregate arguments sending the pipeline, the ones changing the result shape
+            (as_columns, raw and alike) raise ValueError
+        :return: FacetResults - list of results in the order of pipelines
+        """
+        return run_combined(pipelines, **kwargs)
+
+    def _get_key_bounds(self, query, key, collation=None):
+        """Returns the lowest and the highest values of the key among documents matching the query
+        or None if no document has the key. Null values are skipped as they are sorted first."""
+        bounds = []
+        for direction in (1, -1):
+            pipeline = [
+                {'$match': add_condition(query, {key: {'$ne': None}})},
+                {'$sort': {key: direction}},
+                {'$limit': 1},
+                {'$project': {'_id': 0, 'value': dollar_prefix(key)}},
+            ]
+            document = next(iter(self._get_aggregate_call(pipeline, collation=collation)()), {})
+            if document.get('value') is None:
+                return None
+            bounds.append(document['value'])
+        return tuple(bounds)
 
     def append(self, object=None, *args):
         if not object: object = []
@@ -53,12 +557,32 @@ class MongoAggregation(list):
         self.append(object, *args)
 
     def count(self, **kwargs):
-        self.pipeline.append({'$count': 'count'})
-        count = next(self.aggregate(**kwargs), {}).get('count', 0)
-        # Revert last stage
-        self.revert_last_stage()
-        return count
-
+        """
+        Returns number of documents. Doesn't change the pipeline.
+        Trailing stages which don't change the number of documents are not sent.
+        If the pipeline is reduced to a single $match, count_documents is used
+        (estimated_document_count for the empty filter) unless the result is cached.
+        :param kwargs: aggregate arguments
+        """
+        pipeline = count_pipeline(self.pipeline, self.unique_lookups)
+        if kwargs.get('collection'):
+            self.collection = kwargs['collection']
+        cache = kwargs.get('cache')
+        if cache is None:
+            cache = self.cache
+        if (len(pipeline) <= 1 and all('$match' in stage for stage in pipeline) and (cache is None or cache is False)
+                and hasattr(self.collection, 'count_documents')):
+            query = pipeline[0]['$match'] if pipeline else {}
+            options = _execution_options(maxTimeMS=kwargs.get('maxTimeMS'), comment=kwargs.get('comment'))
+            if not query:
+                return self.collection.estimated_document_count(**options)
+            options.update(_execution_options(collation=kwargs.get('collation'), hint=kwargs.get('hint')))
+            return self.collection.count_documents(query, **options)
+        document = next(
+            self.aggregate(pipeline=pipeline + [{'$count': 'count'}], client_lookups=False, **kwargs), {})
+        return document.get('count', 0)
+
+    @timed
     def match(self, *args, **kwargs):
         if not args and not kwargs:
             return self
@@ -80,27 +604,138 @@ class MongoAggregation(list):
         ])
         return self
 
+    @timed
     def lookup_unwind(self, collection, local_field='_id', as_field='', foreign_field='_id',
-                      preserveNullAndEmptyArrays=True):
+                      preserveNullAndEmptyArrays=True, fields=None, unique=False):
+        """$lookup stage followed by $unwind.
+        :param unique: Local field is a single value, never an array. The lookup by _id with preserving $unwind
+            then keeps the number of documents, so count, get_first, paginate and limit pushdown may skip it.
+            Array local field matches a foreign document by each element and $unwind multiplies the documents
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({
+        ...     'order': [{'_id': 1, 'products': [1, 2]}, {'_id': 2, 'products': [3]}],
+        ...     'product': [{'_id': 1}, {'_id': 2}, {'_id': 3}],
+        ... })
+        >>> MongoAggregation(collection=engine.order).lookup_unwind('product', 'products', 'product').count()
+        3
+        """
         if not as_field:
             as_field = local_field
-        self.lookup(collection, local_field, as_field, foreign_field),
+        if unique:
+            self.unique_lookups.add(as_field)
+        self.lookup(collection, local_field, as_field, foreign_field, fields),
         self.unwind(as_field, preserveNullAndEmptyArrays)
         return self
 
-    def lookup(self, collection, local_field='_id', as_field='', foreign_field='_id'):
+    @timed
+    def lookup(self, collection, local_field='_id', as_field='', foreign_field='_id', fields=None):
+        """$lookup stage.
+        :param fields: Fields of the foreign documents to fetch (list or comma separated string).
+            True fetches the fields read by the following stages, they are determined when the pipeline is sent.
+            Both use the concise $lookup form with $project in pipeline which requires MongoDB 5.0"""
         if not as_field:
             as_field = local_field
-        self.pipeline.append({"$lookup": {
+        lookup = {
             'from': collection,
             'foreignField': foreign_field,
             'localField': local_field,
             'as': as_field,
-        }})
+        }
+        if fields is True:
+            self.narrowed_lookups.add(as_field)
+        elif fields:
+            fields = _convert_names_with_underlines_to_dots(list(self._str_to_list(fields)))
+            lookup['pipeline'] = [{'$project': {field: 1 for field in fields}}]
+        self.pipeline.append({"$lookup": lookup})
+        if fields and fields is not True:
+            self._add_to_actual_fields([f'{as_field}.{field}' for field in fields], ignore_if_theres_children=True)
         self._add_to_actual_fields(local_field, ignore_if_theres_children=True)
         self._add_to_actual_fields(as_field, ignore_if_theres_children=True)
         return self
 
+    def client_lookup(self, collection, local_field='_id', as_field='', foreign_field='_id', unwind=False,
+                      fields=None, batch_size=1000, cache=None):
+        """
+        Joins foreign documents on the client when aggregate is run: local field values of each batch
+        of the result are fetched by a single $in query and cached (see joins.batched_lookup).
+        Suits small reference collections, the join is made after all the pipeline stages.
+        The join is applied to the result of aggregate, iter_batches, aggregate_async, aggregate_parallel
+        and to paginate documents. count and paginate total count the pipeline documents before the join.
+        In asynchronous mode the foreign collection is read with async for (synchronous one is read in a thread).
+        :param collection: Foreign collection or its name in the database of the pipeline collection
+        :param unwind: Put a foreign document instead of the list like lookup_unwind
+        :param fields: Fields of foreign documents to fetch (list or comma separated string), all by default
+        :param batch_size: Number of documents joined by one query
+        :param cache: Cache backend of foreign documents. By default they are cached for one call only,
+            pass the same MemoryCache to keep them between calls
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({
+        ...     'action': [{'_id': 1, 'cashbox': 1}, {'_id': 2, 'cashbox': 2}, {'_id': 3, 'cashbox': 1}],
+        ...     'cashbox': [{'_id': 1, 'name': 'Main'}, {'_id': 2, 'name': 'Bar'}],
+        ... })
+        >>> pipeline = MongoAggregation(collection=engine.action).sort('_id').client_lookup(
+        ...     engine.cashbox, 'cashbox', unwind=True, fields='name')
+        >>> pipeline.paginate(page=2, per_page=2)
+        ([{'_id': 3, 'cashbox': {'_id': 1, 'name': 'Main'}}], 3)
+        >>> pipeline.count()
+        3
+        """
+        if not as_field:
+            as_field = local_field
+        if fields:
+            fields = _convert_names_with_underlines_to_dots(list(self._str_to_list(fields)))
+        self.client_lookups.append({'collection': collection, 'options': {
+            'local_field': local_field, 'foreign_field': foreign_field, 'as_field': as_field, 'unwind': unwind,
+            'fields': fields, 'batch_size': batch_size, 'cache': cache,
+        }})
+        if fields:
+            self._add_to_actual_fields([f'{as_field}.{field}' for field in fields], ignore_if_theres_children=True)
+        self._add_to_actual_fields(as_field, ignore_if_theres_children=True)
+        return self
+
+    def _foreign_collection(self, collection):
+        """Returns collection by its name in the database of the pipeline collection."""
+        if collection.__class__.__name__ == 'TopLevelDocumentMetaclass':
+            return collection._get_collection()
+        if not isinstance(collection, str):
+            return collection
+        source = self.collection
+        if source.__class__.__name__ == 'QuerySet':
+            source = source._collection
+        database = getattr(source, 'database', None)
+        if database is None:
+            raise ValueError(f'Collection {collection} can not be found without the database.')
+        return database[collection]
+
+    def _prepared_client_lookups(self):
+        """Returns pairs (foreign collection, batched_lookup options), default reference caches are kept for the run."""
+        prepared = []
+        for lookup in self.client_lookups:
+            options = dict(lookup['options'])
+            if options['cache'] is None:
+                options['cache'] = MemoryCache()
+            prepared.append((self._foreign_collection(lookup['collection']), options))
+        return prepared
+
+    def _joined(self, documents, raw=False, lookups=None):
+        """Returns the documents with client lookups joined. Only the documents of the pipeline result are passed."""
+        if not self.client_lookups:
+            return documents
+        if raw:
+            raise ValueError('Client lookups can not be applied to raw documents.')
+        for collection, options in lookups or self._prepared_client_lookups():
+            documents = batched_lookup(documents, collection, **options)
+        return documents
+
+    def _joined_async(self, cursor):
+        """Returns async iterator of the documents of asynchronous cursor with client lookups joined."""
+        for collection, options in self._prepared_client_lookups():
+            cursor = batched_lookup_async(cursor, collection, **options)
+        return cursor
+
+    @timed
     def unwind(self, field, preserveNullAndEmptyArrays=False):
         field = dollar_prefix(field)
         if preserveNullAndEmptyArrays:
@@ -110,9 +745,11 @@ class MongoAggregation(list):
         self._add_to_actual_fields(field, ignore_if_theres_children=True)
         return self
 
+    @timed
     def order_by(self, *args, **kwargs):
         return self.sort(*args, **kwargs)
 
+    @timed
     def sort(self, *args, **kwargs):
         def _prepare_str_order_rule(order_rule):
             if not isinstance(order_rule, six.string_types):
@@ -135,16 +772,39 @@ class MongoAggregation(list):
             self._add_to_actual_fields(order_rule.keys())
         return self
 
+    @timed
     def skip(self, offset=0):
         if not offset: return self
         self.pipeline.append({"$skip": offset})
         return self
 
-    def limit(self, limit=0):
+    @timed
+    def limit(self, limit=0, pushdown=False):
+        """$limit stage.
+        :param pushdown: Place the limit above trailing stages which keep the number and the order of documents
+            ($project, $addFields, $set, $lookup and unique lookup_unwind)
+
+        Array local field multiplies the documents, so the limit stays below lookup_unwind without unique:
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({
+        ...     'order': [{'_id': 1, 'products': [1, 2]}, {'_id': 2, 'products': [3]}],
+        ...     'product': [{'_id': 1}, {'_id': 2}, {'_id': 3}],
+        ... })
+        >>> pipeline = MongoAggregation(collection=engine.order).sort('_id').lookup_unwind('product', 'products')
+        >>> [(order['_id'], order['products']) for order in pipeline.limit(2, pushdown=True).aggregate()]
+        [(1, {'_id': 1}), (1, {'_id': 2})]
+        >>> pipeline.get_first()
+        {'_id': 1, 'products': {'_id': 1}}
+        """
         if not limit: return self
+        if pushdown:
+            self.pipeline = push_down_limit(self.pipeline, limit, unique_lookups=self.unique_lookups)
+            return self
         self.pipeline.append({"$limit": limit})
         return self
 
+    @timed
     def project(self, *args, **kwargs):
         kwargs = _convert_names_with_underlines_to_dots(kwargs)
         # Складываем все в args
@@ -162,17 +822,7 @@ class MongoAggregation(list):
         return self
 
     def _get_fields_without_children(self, fields):
-        parents = copy(fields)
-        for one, another in combinations(fields, 2):
-            is_children = another.startswith(f'{one}.')
-            if is_children:
-                parents.discard(another)
-                continue
-            is_children = one.startswith(f'{another}.')
-            if is_children:
-                parents.discard(one)
-                continue
-        return parents
+        return FieldPathTrie(fields).roots()
 
     @staticmethod
     def _str_to_list(variable):
@@ -180,24 +830,22 @@ class MongoAggregation(list):
 
     def _set_actual_fields(self, *fields):
         """Устанавливает список актуальных полей"""
-        self.actual_fields = set(chain(*fields))
+        self.actual_fields = FieldPathTrie(chain(*fields))
 
     def _add_to_actual_fields(self, fields, ignore_if_theres_children=True):
         """Добавляет поля в список актуальных полей"""
-        _fields = set(self._str_to_list(fields))
+        _fields = [pop_dollar_prefix(field) for field in dict.fromkeys(self._str_to_list(fields))]
         if ignore_if_theres_children:
-            _fields = [
-                field
-                for field in _fields
-                if pop_dollar_prefix(field) not in self.get_parents(self.actual_fields, all_levels=True)
-            ]
+            _fields = [field for field in _fields if not self.actual_fields.has_descendants(field)]
         for field in _fields:
-            self.actual_fields.add(pop_dollar_prefix(field))
+            self.actual_fields.add(field)
 
     @staticmethod
     def get_parents(fields, all_levels=False, upper_level=True):
         if isinstance(fields, str):
             fields = set(fields.split(','))
+        elif isinstance(fields, FieldPathTrie) and all_levels:
+            return set(fields.parents())
 
         # Самый нижний уровень
         if not all_levels and not upper_level:
@@ -215,6 +863,7 @@ class MongoAggregation(list):
                 if not all_levels: break
         return parents
 
+    @timed
     def replace_root(self, expression):
         """Replaces the input document with the specified document.
         The operation replaces all existing fields in the input document, including the _id field.
@@ -224,6 +873,7 @@ class MongoAggregation(list):
         self.pipeline.append({'$replaceRoot': {'newRoot': expression}})
         return self
 
+    @timed
     def add_fields(self, **kwargs):
         """Adds new fields to documents.
         $addFields outputs documents that contain all existing fields from the input documents and newly added fields.
@@ -235,6 +885,7 @@ class MongoAggregation(list):
         self._add_to_actual_fields(kwargs.keys())
         return self
 
+    @timed
     def set(self, **kwargs):
         """Adds new fields to documents.
         $set outputs documents that contain all existing fields from the input documents and newly added fields.
@@ -244,10 +895,11 @@ class MongoAggregation(list):
         self._add_to_actual_fields(kwargs.keys())
         return self
 
+    @timed
     def smart_project(self, include_fields='', exclude_fields='', include_all_by_default=True, *args, **kwargs):
         """Custom realization of $addFields for an older versions of MongoDB. Bases on $project stage."""
         if not include_all_by_default:
-            self.actual_fields = set()
+            self.actual_fields = FieldPathTrie()
 
         if include_fields:
             include_fields = set(include_fields.split(','))
@@ -292,11 +944,11 @@ class MongoAggregation(list):
             if not paths and self.actual_fields:
                 prolong_fields = self.actual_fields
             else:
-                prolong_fields = set([actual_field
-                                      for new_field, actual_field in product(paths, self.actual_fields)
-                                      if actual_field != new_field
-                                      and not actual_field.startswith(f'{new_field}.')
-                                      and not new_field.startswith(f'{actual_field}.')])
+                # Actual field is prolonged if there is a new path which neither equals nor contains it
+                # nor is nested into it
+                paths = FieldPathTrie(paths)
+                prolong_fields = [actual_field for actual_field in self.actual_fields
+                                  if paths.count_overlapping(actual_field) < len(paths)]
             prolong_fields = self._get_fields_without_children(prolong_fields)
             for field in prolong_fields:
                 args[-1].setdefault(field, 1)
@@ -367,6 +1019,7 @@ class MongoAggregation(list):
             args = ({},)
         return args
 
+    @timed
     def group(self, *args, **kwargs):
         """
         Стадия группировки
@@ -432,7 +1085,7 @@ class MongoAggregation(list):
 
         # Устанавливаем по дефолту $first для остальных полей
         if operator_by_default:
-            parent_fields = self.get_parents(self.actual_fields, True)
+            parent_fields = self.actual_fields.parents()
             if isinstance(stage['_id'], str):
                 _id_fields = pop_dollar_prefix(stage['_id'])
             else:
@@ -455,10 +1108,8 @@ class MongoAggregation(list):
         def get_prolonged_actual_fields_for(*fields_lists):
             prolong_fields = []
             new_fields = [self._str_to_list(fields) for fields in fields_lists if fields]
-            for actual_field, new_field in product(self.actual_fields, chain(*new_fields)):
-                if not actual_field.startswith(new_field):
-                    continue
-                prolong_fields.append(actual_field)
+            for new_field in chain(*new_fields):
+                prolong_fields.extend(self.actual_fields.startswith(new_field))
             return prolong_fields
 
         prolonged_actual_fields = get_prolonged_actual_fields_for(first_fields, push_fields, add_to_set_fields)
@@ -524,13 +1175,150 @@ class MongoAggregation(list):
         self.pipeline = self.pipeline[:-1]
 
     def get_first(self, default=None, **kwargs):
-        # Limit pipeline to 1 document
-        self.limit(1)
-        # Get first document to include statistics_today lately
-        first_doc = next(self.aggregate(**kwargs), default)
-        # Undo limit
-        self.revert_last_stage()
-        return first_doc
+        """Returns the first document. Doesn't change the pipeline.
+        The limit is placed above trailing stages which don't change the number and the order of documents."""
+        cursor = self.aggregate(pipeline=push_down_limit(self.pipeline, 1, unique_lookups=self.unique_lookups), **kwargs)
+        if cursor is None:
+            return default
+        document = next(cursor, default)
+        # Closed cursor is reported by instrumentation
+        close = getattr(cursor, 'close', None)
+        if close is not None:
+            close()
+        return document
+
+    async def _get_first_async(self, pipeline, default=None, **kwargs):
+        cursor = await self.aggregate_async(pipeline=pipeline, **kwargs)
+        if cursor is None:
+            return default
+        async for document in cursor:
+            return document
+        return default
+
+    async def get_first_async(self, default=None, **kwargs):
+        """Asynchronous version of get_first. Doesn't change the pipeline."""
+        return await self._get_first_async(
+            push_down_limit(self.pipeline, 1, unique_lookups=self.unique_lookups), default, **kwargs)
+
+    async def count_async(self, **kwargs):
+        """Asynchronous version of count. Doesn't change the pipeline."""
+        document = await self._get_first_async(
+            count_pipeline(self.pipeline, self.unique_lookups) + [{'$count': 'count'}], {}, client_lookups=False,
+            **kwargs)
+        return document.get('count', 0)
+
+    def paginate(self, page=1, per_page=20, **kwargs):
+        """
+        Returns tuple (documents of the page, total number of documents) from a single $facet query.
+        Stages after the last $sort which don't change the number of documents are run only for the page documents.
+        The page must fit the 16 MB document limit.
+        :param page: Page number starting from 1
+        :param per_page: Number of documents on the page
+        :param kwargs: aggregate arguments
+
+        lookup_unwind by an array local field multiplies the documents, so it is shared unless it is unique:
+
+        >>> from mongo_aggregation.engine import InMemoryEngine
+        >>> engine = InMemoryEngine({
+        ...     'order': [{'_id': 1, 'products': [1, 2]}, {'_id': 2, 'products': [3]}],
+        ...     'product': [{'_id': 1}, {'_id': 2}, {'_id': 3}],
+        ... })
+        >>> pipeline = MongoAggregation(collection=engine.order).sort('_id').lookup_unwind('product', 'products')
+        >>> items, total = pipeline.paginate(page=1, per_page=2)
+        >>> [(order['_id'], order['products']) for order in items], total
+        ([(1, {'_id': 1}), (1, {'_id': 2})], 3)
+        """
+        if page < 1 or per_page < 1:
+            raise ValueError('Page number and page size must be positive.')
+        shared = len(count_pipeline(self.pipeline, self.unique_lookups))
+        # Sorting is shared too, so it may use an index
+        for i in range(len(self.pipeline) - 1, shared - 1, -1):
+            if '$sort' in self.pipeline[i]:
+                shared = i + 1
+                break
+        prefix = self.pipeline[:shared]
+        items = push_down_limit(
+            self.pipeline[shared:], per_page, skip=(page - 1) * per_page, unique_lookups=self.unique_lookups)
+        pipeline = prefix + [{'$facet': {'items': items, 'total': [{'$count': 'count'}]}}]
+        result = next(iter(self.aggregate(pipeline=pipeline, client_lookups=False, **kwargs) or ()), None)
+        if not result:
+            return [], 0
+        total = result['total'][0]['count'] if result['total'] else 0
+        return list(self._joined(result['items'])), total
+
+    def seek_page(self, after=None, per_page=20, **kwargs):
+        """
+        Keyset pagination: returns tuple (documents of the page, continuation token of the next page or None).
+        Keys are taken from the last $sort stage (_id is added as a tiebreak) or _id if there is no sorting.
+        The range $match is placed right after the stages computing sort keys.
+        Documents must contain sort keys at the end of the pipeline. Null and missing keys are sorted first.
+        :param after: Continuation token returned for the previous page
+        :param per_page: Number of documents on the page
+        :param kwargs: aggregate arguments
+
+        >>> from mongo_aggregation.engine import InMemoryCollection
+        >>> collection = InMemoryCollection([{'_id': 1, 'a': 2}, {'_id': 2}, {'_id': 3, 'a': None}, {'_id': 4, 'a': 1}])
+        >>> pipeline = MongoAggregation(collection=collection).sort('a')
+        >>> items, token = pipeline.seek_page(per_page=2)
+        >>> [item['_id'] for item in items], [item['_id'] for item in pipeline.seek_page(after=token, per_page=2)[0]]
+        ([2, 3], [4, 1])
+        """
+        if per_page < 1:
+            raise ValueError('Page size must be positive.')
+        pipeline = list(self.pipeline)
+        sort_indexes = [i for i, stage in enumerate(pipeline) if '$sort' in stage]
+        if sort_indexes:
+            sort_index = sort_indexes[-1]
+            keys = dict(pipeline[sort_index]['$sort'])
+        else:
+            sort_index = len(pipeline)
+            keys = {}
+            pipeline.append({})
+        if not all(direction in (1, -1) for direction in keys.values()):
+            raise ValueError('Only ascending and descending sort keys are supported.')
+        if limit_position(pipeline, len(pipeline), self.unique_lookups) > sort_index + 1:
+            raise ValueError('Stages after the last $sort must keep the number and the order of documents.')
+        if '_id' not in keys:
+            keys['_id'] = list(keys.values())[-1] if keys else 1
+        pipeline[sort_index] = {'$sort': keys}
+
+        if after:
+            values = decode_token(after, keys)
+            condition = seek_condition(keys, values)
+            position = sort_index
+            while position and ('$sort' in pipeline[position - 1] or can_hoist_match(pipeline[position - 1], keys)):
+                position -= 1
+            if position and '$match' in pipeline[position - 1]:
+                pipeline[position - 1] = {'$match': merge_queries(pipeline[position - 1]['$match'], condition)}
+            else:
+                pipeline.insert(position, {'$match': condition})
+
+        items = self.aggregate(
+            pipeline=push_down_limit(pipeline, per_page, unique_lookups=self.unique_lookups), as_list=True,
+            **kwargs) or []
+        if len(items) < per_page:
+            return items, None
+        return items, encode_token(keys, [get_path(items[-1], key) for key in keys])
+
+    def suggest_indexes(self, collection=None):
+        """
+        Returns index suggestions for the leading $match and $sort stages by equality-sort-range rule
+        and for $lookup foreign fields (see indexes module).
+        :param collection: pymongo collection, mongoengine Document or QuerySet to compare the suggestions
+            with its indexes. The comparison adds 'covered_by' to suggestions and 'unused' indexes list
+        """
+        if collection.__class__.__name__ == 'TopLevelDocumentMetaclass':
+            collection = collection._get_collection()
+        elif collection.__class__.__name__ == 'QuerySet':
+            collection = collection._collection
+        source = collection if collection is not None else self.collection
+        if source.__class__.__name__ == 'TopLevelDocumentMetaclass':
+            name = source._get_collection_name()
+        elif source.__class__.__name__ == 'QuerySet':
+            name = source._document._get_collection_name()
+        else:
+            name = getattr(source, 'name', '')
+        return suggest_indexes(self.pipeline, name if isinstance(name, str) else '', collection)
 
     def get_count(self, **kwargs):
         return self.count(**kwargs)
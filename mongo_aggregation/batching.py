@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Cursor getMore batch size adapting to documents size and consumer speed."""
+
+from time import perf_counter
+
+DEFAULT_MEMORY_BUDGET = 16 * 1024 * 1024
+# Server default size of the first batch
+DEFAULT_BATCH_SIZE = 101
+
+
+def next_batch_size(batch_size, fetch_time, consume_time, average_size, memory_budget, min_batch, max_batch):
+    """
+    Returns batch size for the next getMore.
+    Batches grow while fetching dominates (round trips are the cost) and shrink when the consumer is much slower
+    (large batches only keep memory and may let the cursor time out). Batch never exceeds the memory budget.
+
+    >>> next_batch_size(100, fetch_time=0.5, consume_time=0.1, average_size=100, memory_budget=1000000,
+    ...                 min_batch=10, max_batch=100000)
+    200
+    >>> next_batch_size(100, fetch_time=0.5, consume_time=0.1, average_size=50000, memory_budget=1000000,
+    ...                 min_batch=10, max_batch=100000)
+    20
+    """
+    if fetch_time > consume_time:
+        batch_size *= 2
+    elif consume_time > fetch_time * 4:
+        batch_size //= 2
+    memory_limit = int(memory_budget // average_size) if average_size else max_batch
+    return max(min_batch, min(batch_size, max_batch, memory_limit))
+
+
+class AdaptiveBatchCursor(object):
+    """
+    Cursor wrapper changing the cursor batch size (CommandCursor.batch_size) after each batch of documents.
+    Size of every sample_every document is measured by document_size function,
+    without it the memory budget is not applied. Batch sizes history is kept in batch_sizes.
+    Other attributes are taken from the cursor.
+    """
+
+    def __init__(self, cursor, memory_budget=DEFAULT_MEMORY_BUDGET, batch_size=DEFAULT_BATCH_SIZE, min_batch=10,
+                 max_batch=100000, sample_every=16, document_size=None):
+        self._source = cursor
+        self._cursor = iter(cursor)
+        self.memory_budget = memory_budget
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.sample_every = sample_every
+        self._document_size = document_size
+        self.batch_size = batch_size
+        self.batch_sizes = [batch_size]
+        self._consumed = 0
+        self._sampled_documents = 0
+        self._sampled_bytes = 0
+        self._fetch_time = 0.0
+        self._consume_time = 0.0
+        self._returned_at = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = perf_counter()
+        if self._returned_at is not None:
+            self._consume_time += started - self._returned_at
+        document = next(self._cursor)
+        self._returned_at = perf_counter()
+        self._fetch_time += self._returned_at - started
+
+        if self._document_size is not None and self._consumed % self.sample_every == 0:
+            self._sampled_documents += 1
+            self._sampled_bytes += self._document_size(document)
+        self._consumed += 1
+        if self._consumed >= self.batch_size:
+            self._adapt()
+        return document
+
+    def _adapt(self):
+        batch_size = next_batch_size(
+            self.batch_size, self._fetch_time, self._consume_time,
+            self._sampled_bytes / self._sampled_documents if self._sampled_documents else 0,
+            self.memory_budget, self.min_batch, self.max_batch,
+        )
+        self._consumed = self._fetch_time = self._consume_time = 0
+        if batch_size == self.batch_size:
+            return
+        self.batch_size = batch_size
+        self.batch_sizes.append(batch_size)
+        set_batch_size = getattr(self._source, 'batch_size', None)
+        if callable(set_batch_size):
+            set_batch_size(batch_size)
+
+    def close(self):
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._source, name)
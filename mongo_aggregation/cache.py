@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Aggregation results cache backends."""
+
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import date, datetime
+
+
+def collection_name(collection):
+    """
+    Returns the full name of pymongo collection, mongoengine QuerySet or Document collection.
+
+    >>> collection_name('test.action')
+    'test.action'
+    """
+    if isinstance(collection, str):
+        return collection
+    if collection.__class__.__name__ == 'TopLevelDocumentMetaclass':
+        collection = collection.objects
+    if collection.__class__.__name__ == 'QuerySet':
+        return collection_name(collection._collection)
+    name = getattr(collection, 'full_name', None) or getattr(collection, 'name', None)
+    return name if isinstance(name, str) else repr(collection)
+
+
+def queryset_scope(collection):
+    """
+    Returns the part of mongoengine QuerySet which it puts in front of the pipeline: filter, ordering, skip and limit.
+    Returns None for other collections.
+
+    >>> class QuerySet:
+    ...     _query, _ordering, _skip, _limit = {'user': 1}, None, None, 10
+    >>> queryset_scope(QuerySet())
+    [{'user': 1}, None, None, 10]
+    >>> queryset_scope('test.action') is None
+    True
+    """
+    if collection.__class__.__name__ == 'TopLevelDocumentMetaclass':
+        collection = collection.objects
+    if collection.__class__.__name__ != 'QuerySet':
+        return None
+    return [
+        collection._query, getattr(collection, '_ordering', None),
+        getattr(collection, '_skip', None), getattr(collection, '_limit', None),
+    ]
+
+
+def collection_key(collection):
+    """
+    Returns the key which tells apart sources of the pipeline: full collection name and the QuerySet scope.
+
+    >>> class QuerySet:
+    ...     _collection = 'test.action'
+    ...     def __init__(self, query):
+    ...         self._query = query
+    >>> collection_key(QuerySet({'user': 1})) == collection_key(QuerySet({'user': 2}))
+    False
+    >>> collection_key(QuerySet({'user': 1})) == collection_key(QuerySet({'user': 1}))
+    True
+    """
+    return _canonical([collection_name(collection), queryset_scope(collection)])
+
+
+def _canonical_default(value):
+    if hasattr(value, 'raw') and hasattr(value, 'items'):
+        # Encoded stage has the key of the same stage as dictionary
+        return dict(value.items())
+    if isinstance(value, (datetime, date)):
+        return {'$date': value.isoformat()}
+    if hasattr(value, 'binary') and hasattr(value, 'generation_time'):
+        return {'$oid': str(value)}
+    return {f'${type(value).__name__}': repr(value)}
+
+
+def pipeline_key(collection, pipeline, collation=None, allowDiskUse=False, let=None):
+    """
+    Returns cache key of the pipeline. Stages keep the order of their keys as it is significant for $sort.
+    Variables of let option change the result, so they are the part of the key.
+    So is the filter of mongoengine QuerySet, which runs before the pipeline.
+
+    >>> pipeline_key('test.action', [{'$match': {'a': 1}}]) == pipeline_key('test.action', ({'$match': {'a': 1}},))
+    True
+    >>> pipeline_key('test.action', [{'$sort': {'a': 1, 'b': 1}}]) == pipeline_key('test.action', [{'$sort': {'b': 1, 'a': 1}}])
+    False
+    >>> import bson
+    >>> from bson.raw_bson import RawBSONDocument
+    >>> encoded = RawBSONDocument(bson.encode({'$match': {'a': 1}}))
+    >>> pipeline_key('test.action', [encoded]) == pipeline_key('test.action', [{'$match': {'a': 1}}])
+    True
+    >>> class QuerySet:
+    ...     _collection = 'test.action'
+    ...     def __init__(self, query):
+    ...         self._query = query
+    >>> count = [{'$count': 'n'}]
+    >>> pipeline_key(QuerySet({'user': 1}), count) == pipeline_key(QuerySet({'user': 2}), count)
+    False
+    """
+    key = [collection_name(collection), list(pipeline), collation, bool(allowDiskUse)]
+    if let:
+        key.append(let)
+    scope = queryset_scope(collection)
+    if scope is not None:
+        # QuerySet filters the collection before the pipeline
+        key.append(scope)
+    return hashlib.sha256(_canonical(key).encode('utf-8')).hexdigest()
+
+
+def _canonical(value):
+    return json.dumps(value, default=_canonical_default, separators=(',', ':'), ensure_ascii=False)
+
+
+class BaseCache(ABC):
+    """
+    Cache backend interface. Keeps hits, misses and evictions counters in stats.
+    Backends must implement get, set and invalidate.
+
+    >>> class IncompleteCache(BaseCache):
+    ...     def get(self, key):
+    ...         return False, None
+    >>> IncompleteCache()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    TypeError: Can't instantiate abstract class IncompleteCache ...
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _expires(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    @abstractmethod
+    def get(self, key):
+        """Returns tuple (found, value)."""
+
+    @abstractmethod
+    def set(self, key, value, collection=''):
+        """Stores the value of the collection results."""
+
+    @abstractmethod
+    def invalidate(self, collection=None):
+        """Removes entries of the collection or all the entries."""
+
+
+class MemoryCache(BaseCache):
+    """
+    In-process LRU cache with time to live.
+
+    >>> cache = MemoryCache(maxsize=1)
+    >>> cache.set('a', [1], 'test.action')
+    >>> cache.set('b', [2], 'test.action')
+    >>> cache.get('a'), cache.get('b')
+    ((False, None), (True, [2]))
+    >>> cache.stats
+    {'hits': 1, 'misses': 1, 'evictions': 1}
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super(MemoryCache, self).__init__(ttl, maxsize)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                self.stats['evictions'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+        # Cached value must not be changed by the consumer
+        return True, deepcopy(entry[2])
+
+    def set(self, key, value, collection=''):
+        with self._lock:
+            self._entries[key] = (collection_name(collection), self._expires(), deepcopy(value))
+            self._entries.move_to_end(key)
+            while self.maxsize and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, collection=None):
+        with self._lock:
+            if collection is None:
+                self._entries.clear()
+                return
+            name = collection_name(collection)
+            for key in [key for key, entry in self._entries.items() if entry[0] == name]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(BaseCache):
+    """
+    Local on-disk LRU cache stored in SQLite database file. Values are pickled,
+    so the file must not be writable by untrusted users.
+    When maxsize is exceeded the least recently used entries are removed.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+    >>> cache = DiskCache(path, maxsize=2)
+    >>> cache.set('a', [1], 'test.action')
+    >>> cache.set('b', [2], 'test.action')
+    >>> cache.get('a')
+    (True, [1])
+    >>> cache.set('c', [3], 'test.action')
+    >>> cache.get('a'), cache.get('b'), cache.get('c')
+    ((True, [1]), (False, None), (True, [3]))
+    """
+
+    def __init__(self, path, ttl=None, maxsize=None):
+        super(DiskCache, self).__init__(ttl, maxsize)
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, collection TEXT, expires REAL, accessed INTEGER, value BLOB)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_collection ON entries (collection)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT expires, value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] is not None and row[0] < time.time():
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.stats['evictions'] += 1
+                row = None
+            if row is None:
+                self.stats['misses'] += 1
+                return False, None
+            connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (self._access(connection), key))
+            self.stats['hits'] += 1
+        return True, pickle.loads(row[1])
+
+    @staticmethod
+    def _access(connection):
+        """Returns the next access number. Unlike time it grows with every access, so the order is exact."""
+        return connection.execute('SELECT COALESCE(MAX(accessed), 0) + 1 FROM entries').fetchone()[0]
+
+    def set(self, key, value, collection=''):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO entries (key, collection, expires, accessed, value) VALUES (?, ?, ?, ?, ?)',
+                (key, collection_name(collection), self._expires(), self._access(connection), value),
+            )
+            if not self.maxsize:
+                return
+            evicted = connection.execute(
+                'DELETE FROM entries WHERE key IN '
+                '(SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,)
+            ).rowcount
+            self.stats['evictions'] += evicted
+
+    def invalidate(self, collection=None):
+        with self._lock, self._connect() as connection:
+            if collection is None:
+                connection.execute('DELETE FROM entries')
+            else:
+                connection.execute('DELETE FROM entries WHERE collection = ?', (collection_name(collection),))
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Columnar materialization of aggregation results into NumPy arrays (requires numpy)."""
+
+from .keyset import get_path
+from .optimizer import _flatten_projection, _is_exclusion
+
+
+def document_fields(document, prefix=''):
+    """
+    Returns dotted paths of the document leaf fields.
+
+    >>> document_fields({'_id': {'cashbox': 1, 'date': 2}, 'amount': 3})
+    ['_id.cashbox', '_id.date', 'amount']
+    """
+    fields = []
+    for key, value in document.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict) and value:
+            fields.extend(document_fields(value, path))
+        else:
+            fields.append(path)
+    return fields
+
+
+def stage_fields(stage):
+    """
+    Returns leaf fields of the documents produced by $group, $count or inclusion $project stage
+    or None if the stage doesn't define the fields.
+
+    >>> stage_fields({'$group': {'_id': {'cashbox': '$cashbox'}, 'amount': {'$sum': '$amount'}}})
+    ['_id.cashbox', 'amount']
+    >>> stage_fields({'$project': {'name': 1, 'cashbox': {'id': '$cashbox', 'total': {'$sum': '$amounts'}}}})
+    ['_id', 'name', 'cashbox.id', 'cashbox.total']
+    """
+    name, specification = next(iter(stage.items()))
+    if name == '$count':
+        return [specification]
+    if name == '$group':
+        group_id = specification['_id']
+        if isinstance(group_id, dict) and group_id and not any(key.startswith('$') for key in group_id):
+            fields = [f'_id.{key}' for key in group_id]
+        else:
+            fields = ['_id']
+        return fields + [field for field in specification if field != '_id']
+    if name == '$project':
+        items = list(_flatten_projection(specification))
+        if all(_is_exclusion(value) for _, value in items):
+            return None
+        fields = [field for field, value in items if not _is_exclusion(value)]
+        return fields if '_id' in specification else ['_id'] + fields
+    return None
+
+
+def to_columns(documents, fields=None, dtypes=None, structured=False, chunk_size=65536):
+    """
+    Returns dictionary {field path: numpy array} or structured array of the documents.
+    Values are collected by chunks, so the documents are not kept after their values are taken.
+    Dtypes inferred by chunks are promoted to the common one, incompatible types give object columns.
+    :param documents: Iterable of documents, e.g. cursor
+    :param fields: Field paths, by default the leaf fields of all the documents in the order of appearance
+    :param dtypes: Dictionary {field path: numpy dtype}, types of other fields are inferred.
+        Missing values are None, so they are NaN in float columns and not allowed in integer ones
+    :param structured: Return structured array with the fields instead of dictionary
+    :param chunk_size: Number of values converted to array at once
+
+    >>> columns = to_columns([{'a': 1}, {'a': 2, 'b': {'c': 'x'}}, {'a': 2.5}], chunk_size=2)
+    >>> columns['a'], columns['b.c']
+    (array([1. , 2. , 2.5]), array([None, 'x', None], dtype=object))
+    """
+    import numpy
+
+    dtypes = dtypes or {}
+    discover = fields is None
+    fields = list(dtypes) if discover else list(fields)
+    paths = [(field, field.split('.')) for field in fields]
+
+    buffers = {field: [] for field in fields}
+    chunks = {field: [] for field in fields}
+    filled = rows = 0
+    for document in documents:
+        if discover:
+            for field in document_fields(document):
+                if field not in buffers:
+                    # Earlier documents miss the field
+                    fields.append(field)
+                    paths.append((field, field.split('.')))
+                    buffers[field], chunks[field] = [None] * (rows - filled), []
+                    _flush(numpy, {field: buffers[field]}, chunks, dtypes)
+                    buffers[field].extend([None] * filled)
+        for field, parts in paths:
+            value = document.get(parts[0]) if len(parts) == 1 else get_path(document, field)
+            buffers[field].append(value)
+        filled += 1
+        rows += 1
+        if filled == chunk_size:
+            _flush(numpy, buffers, chunks, dtypes)
+            filled = 0
+    _flush(numpy, buffers, chunks, dtypes)
+
+    columns = {}
+    for field in fields:
+        if chunks[field]:
+            columns[field] = _concatenate(numpy, chunks[field])
+        else:
+            columns[field] = numpy.array([], dtype=dtypes.get(field, 'float64'))
+    if not structured:
+        return columns
+
+    length = len(columns[fields[0]]) if fields else 0
+    array = numpy.empty(length, dtype=[(field, columns[field].dtype) for field in fields])
+    for field in fields:
+        array[field] = columns[field]
+    return array
+
+
+def _concatenate(numpy, chunks):
+    """Concatenates arrays of the chunks promoting their dtypes."""
+    if len(chunks) == 1:
+        return chunks[0]
+    try:
+        dtype = numpy.result_type(*chunks)
+    except TypeError:
+        dtype = object
+    return numpy.concatenate([chunk.astype(dtype, copy=False) for chunk in chunks])
+
+
+def _flush(numpy, buffers, chunks, dtypes):
+    """Converts buffered values to arrays."""
+    for field, values in buffers.items():
+        if values:
+            chunks[field].append(numpy.array(values, dtype=dtypes.get(field)))
+            values.clear()
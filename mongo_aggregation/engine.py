@@ -0,0 +1,1234 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""
+In-process pure Python execution of aggregation pipelines.
+Evaluates the stages and expressions produced by MongoAggregation, patterns and aggr_patterns modules,
+so small collections may be aggregated without a server. Stages are streaming generators,
+$sort followed by $limit is a heap top-k.
+
+>>> engine = InMemoryEngine({
+...     'action': [
+...         {'_id': 1, 'cashbox': 1, 'amount': 10},
+...         {'_id': 2, 'cashbox': 1, 'amount': 5},
+...         {'_id': 3, 'cashbox': 2, 'amount': 7},
+...     ],
+...     'cashbox': [{'_id': 1, 'name': 'Main'}, {'_id': 2, 'name': 'Bar'}],
+... })
+>>> list(engine.action.aggregate([
+...     {'$match': {'amount': {'$gte': 5}}},
+...     {'$group': {'_id': '$cashbox', 'total': {'$sum': '$amount'}}},
+...     {'$lookup': {'from': 'cashbox', 'localField': '_id', 'foreignField': '_id', 'as': 'cashbox'}},
+...     {'$unwind': '$cashbox'},
+...     {'$project': {'_id': 0, 'name': '$cashbox.name', 'total': 1}},
+...     {'$sort': {'total': -1}},
+... ]))
+[{'name': 'Main', 'total': 15}, {'name': 'Bar', 'total': 7}]
+"""
+
+import heapq
+import math
+import re
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from functools import cmp_to_key
+from itertools import count, islice
+
+_MISSING = object()
+# Numbers of collections without name, unlike id() they are never reused
+_UNNAMED_COLLECTIONS = count(1)
+# System variables which can't be evaluated in process
+UNSUPPORTED_VARIABLES = ('CLUSTER_TIME', 'USER_ROLES', 'SEARCH_META', 'DESCEND', 'PRUNE', 'KEEP')
+
+# BSON comparison order of types
+_TYPE_RANKS = {
+    'MinKey': 1, 'missing': 2, 'null': 3, 'number': 4, 'string': 5, 'object': 6, 'array': 7, 'binData': 8,
+    'objectId': 9, 'bool': 10, 'date': 11, 'timestamp': 12, 'regex': 13, 'MaxKey': 14,
+}
+
+
+# Types which values are their own sort keys
+_SCALAR_RANKS = {
+    int: _TYPE_RANKS['number'], float: _TYPE_RANKS['number'], str: _TYPE_RANKS['string'],
+    type(None): _TYPE_RANKS['null'], datetime: _TYPE_RANKS['date'],
+}
+
+
+def _type_name(value):
+    if value is _MISSING:
+        return 'missing'
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float, Decimal)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, (list, tuple)):
+        return 'array'
+    if isinstance(value, bytes):
+        return 'binData'
+    if isinstance(value, datetime):
+        return 'date'
+    if isinstance(value, re.Pattern):
+        return 'regex'
+    class_name = value.__class__.__name__
+    if class_name == 'ObjectId':
+        return 'objectId'
+    if class_name == 'Decimal128':
+        return 'number'
+    if class_name in ('Timestamp', 'MinKey', 'MaxKey'):
+        return class_name.lower() if class_name == 'Timestamp' else class_name
+    if class_name == 'Regex':
+        return 'regex'
+    if class_name == 'Binary':
+        return 'binData'
+    raise ValueError(f'Unsupported value type: {class_name}.')
+
+
+def _bson_type(value):
+    """Returns BSON type alias of the value like $type expression."""
+    type_name = _type_name(value)
+    if type_name == 'number':
+        if isinstance(value, float):
+            return 'double'
+        if isinstance(value, int):
+            return 'long' if value.__class__.__name__ == 'Int64' or not -2 ** 31 <= value < 2 ** 31 else 'int'
+        return 'decimal'
+    return {'MinKey': 'minKey', 'MaxKey': 'maxKey'}.get(type_name, type_name)
+
+
+def _sort_key(value):
+    """Returns comparable and hashable key of the value following BSON comparison order."""
+    rank = _SCALAR_RANKS.get(value.__class__)
+    if rank is not None:
+        return rank, value
+    type_name = _type_name(value)
+    rank = _TYPE_RANKS[type_name]
+    if type_name in ('missing', 'null', 'MinKey', 'MaxKey'):
+        return rank, 0
+    if type_name == 'number':
+        if value.__class__.__name__ == 'Decimal128':
+            value = value.to_decimal()
+        return rank, value
+    if type_name == 'object':
+        return rank, tuple((key, _sort_key(item)) for key, item in value.items())
+    if type_name == 'array':
+        return rank, tuple(_sort_key(item) for item in value)
+    if type_name == 'objectId':
+        return rank, value.binary
+    if type_name == 'bool':
+        return rank, int(value)
+    if type_name == 'timestamp':
+        return rank, (value.time, value.inc)
+    if type_name == 'regex':
+        return rank, (value.pattern, str(getattr(value, 'flags', '')))
+    if type_name == 'binData':
+        return rank, bytes(value)
+    return rank, value
+
+
+def _compare(one, another):
+    one, another = _sort_key(one), _sort_key(another)
+    return (one > another) - (one < another)
+
+
+def _is_true(value):
+    """Aggregation expressions truthiness: false, null, missing and zero are false."""
+    if value is None or value is _MISSING or value is False:
+        return False
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return value != 0
+    return True
+
+
+def _value(value):
+    return None if value is _MISSING else value
+
+
+# Paths
+
+def get_field(value, path):
+    """
+    Returns value of the field path. Arrays on the path are mapped, missing field returns _MISSING.
+
+    >>> get_field({'items': [{'price': 1}, {'price': 2}, {}]}, 'items.price')
+    [1, 2]
+    """
+    parts = path.split('.') if isinstance(path, str) else path
+    for i, part in enumerate(parts):
+        if isinstance(value, dict):
+            if part not in value:
+                return _MISSING
+            value = value[part]
+        elif isinstance(value, list):
+            values = []
+            for item in value:
+                if isinstance(item, (dict, list)):
+                    item = get_field(item, parts[i:])
+                    if item is not _MISSING:
+                        values.append(item)
+            return values
+        else:
+            return _MISSING
+    return value
+
+
+def set_field(document, path, value):
+    """
+    Returns copy of the document with the field set. Only containers on the path are copied.
+    Setting a field nested into an array sets it in every element.
+
+    >>> set_field({'a': {'b': 1}, 'c': [{'d': 1}, {'d': 2}]}, 'c.e', 0)
+    {'a': {'b': 1}, 'c': [{'d': 1, 'e': 0}, {'d': 2, 'e': 0}]}
+    """
+    parts = path.split('.') if isinstance(path, str) else path
+    if isinstance(document, list):
+        return [set_field(item, parts, value) if isinstance(item, dict) else item for item in document]
+    document = dict(document) if isinstance(document, dict) else {}
+    if len(parts) == 1:
+        document[parts[0]] = value
+        return document
+    document[parts[0]] = set_field(document.get(parts[0]), parts[1:], value)
+    return document
+
+
+def remove_field(document, path):
+    """Returns copy of the document without the field."""
+    parts = path.split('.') if isinstance(path, str) else path
+    if isinstance(document, list):
+        return [remove_field(item, parts) if isinstance(item, dict) else item for item in document]
+    if not isinstance(document, dict) or parts[0] not in document:
+        return document
+    document = dict(document)
+    if len(parts) == 1:
+        del document[parts[0]]
+    else:
+        document[parts[0]] = remove_field(document[parts[0]], parts[1:])
+    return document
+
+
+def _include_field(source, target, parts):
+    """Copies the field from source to target document for inclusion $project."""
+    key = parts[0]
+    if not isinstance(source, dict) or key not in source:
+        return
+    value = source[key]
+    if len(parts) == 1:
+        target[key] = value
+    elif isinstance(value, dict):
+        if not isinstance(target.get(key), dict):
+            target[key] = {}
+        _include_field(value, target[key], parts[1:])
+    elif isinstance(value, list):
+        existing = target.get(key) if isinstance(target.get(key), list) else None
+        elements = []
+        for item in value:
+            if isinstance(item, dict):
+                element = existing[len(elements)] if existing else {}
+                _include_field(item, element, parts[1:])
+                elements.append(element)
+        target[key] = elements
+
+
+def _flatten_specification(specification, prefix=''):
+    """Turns embedded documents of $project/$addFields specification into dotted fields."""
+    fields = {}
+    for key, value in specification.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict) and value and not any(name.startswith('$') for name in value):
+            fields.update(_flatten_specification(value, path))
+        else:
+            fields[path] = value
+    return fields
+
+
+# Query
+
+def _query_values(value, parts):
+    """Returns all the values of the path in the document for query matching, traversing arrays."""
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        if parts[0] in value:
+            return _query_values(value[parts[0]], parts[1:])
+        return [_MISSING]
+    if isinstance(value, list):
+        values = []
+        if parts[0].isdigit() and int(parts[0]) < len(value):
+            values.extend(_query_values(value[int(parts[0])], parts[1:]))
+        for item in value:
+            if isinstance(item, dict):
+                values.extend(item_value for item_value in _query_values(item, parts) if item_value is not _MISSING)
+        return values or [_MISSING]
+    return [_MISSING]
+
+
+def _expand(values):
+    """Values with array elements for query operators."""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _equals(value, expected):
+    if expected is None:
+        return value is None or value is _MISSING
+    if value is _MISSING:
+        return False
+    if isinstance(expected, (re.Pattern,)) and isinstance(value, str):
+        return bool(expected.search(value))
+    return _sort_key(value) == _sort_key(expected)
+
+
+def _same_type_compare(value, expected, operator):
+    if value is _MISSING:
+        value = None
+    if _type_name(value) != _type_name(expected):
+        return False
+    result = _compare(value, expected)
+    return {'$gt': result > 0, '$gte': result >= 0, '$lt': result < 0, '$lte': result <= 0}[operator]
+
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if pattern.__class__.__name__ == 'Regex':
+        return pattern.try_compile()
+    flags = 0
+    for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('x', re.VERBOSE), ('s', re.DOTALL)):
+        if option in (options or ''):
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _matches_operators(values, condition, variables):
+    for operator, expected in condition.items():
+        if operator == '$options':
+            continue
+        if operator == '$eq':
+            matched = any(_equals(value, expected) for value in _expand(values))
+        elif operator == '$ne':
+            matched = not any(_equals(value, expected) for value in _expand(values))
+        elif operator in ('$gt', '$gte', '$lt', '$lte'):
+            matched = any(_same_type_compare(value, expected, operator) for value in _expand(values))
+        elif operator == '$in':
+            matched = any(_equals(value, item) for value in _expand(values) for item in expected)
+        elif operator == '$nin':
+            matched = not any(_equals(value, item) for value in _expand(values) for item in expected)
+        elif operator == '$exists':
+            matched = any(value is not _MISSING for value in values) == bool(expected)
+        elif operator == '$regex':
+            pattern = _regex(expected, condition.get('$options'))
+            matched = any(isinstance(value, str) and pattern.search(value) for value in _expand(values))
+        elif operator == '$not':
+            if not isinstance(expected, dict):
+                expected = {'$regex': expected}
+            matched = not _matches_operators(values, expected, variables)
+        elif operator == '$size':
+            matched = any(isinstance(value, list) and len(value) == expected for value in values)
+        elif operator == '$all':
+            matched = any(
+                isinstance(value, list) and all(any(_equals(item, element) for item in value) for element in expected)
+                for value in values
+            )
+        elif operator == '$elemMatch':
+            matched = any(
+                isinstance(value, list) and any(_matches_element(item, expected, variables) for item in value)
+                for value in values
+            )
+        elif operator == '$mod':
+            divisor, remainder = expected
+            matched = any(
+                _type_name(value) == 'number' and int(value) % divisor == remainder for value in _expand(values)
+            )
+        elif operator == '$type':
+            types = expected if isinstance(expected, list) else [expected]
+            matched = any(
+                value is not _MISSING and (_bson_type(value) in types or 'number' in types and _type_name(value) == 'number')
+                for value in values
+            )
+        else:
+            raise ValueError(f'Unsupported query operator: {operator}.')
+        if not matched:
+            return False
+    return True
+
+
+def _matches_element(item, condition, variables):
+    if any(key.startswith('$') for key in condition) and not any(key in ('$and', '$or', '$nor') for key in condition):
+        return _matches_operators([item], condition, variables)
+    return isinstance(item, dict) and matches(item, condition, variables)
+
+
+def _is_operators(condition):
+    return isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)
+
+
+def matches(document, query, variables=None):
+    """
+    Checks if the document matches the $match query.
+
+    >>> matches({'a': [1, 5], 'b': {'c': 'John'}}, {'a': {'$gt': 3}, 'b.c': {'$regex': 'john', '$options': 'i'}})
+    True
+    """
+    for key, condition in query.items():
+        if key == '$and':
+            matched = all(matches(document, item, variables) for item in condition)
+        elif key == '$or':
+            matched = any(matches(document, item, variables) for item in condition)
+        elif key == '$nor':
+            matched = not any(matches(document, item, variables) for item in condition)
+        elif key == '$expr':
+            matched = _is_true(evaluate(condition, document, variables))
+        elif key.startswith('$'):
+            raise ValueError(f'Unsupported query operator: {key}.')
+        else:
+            values = _query_values(document, key.split('.'))
+            if _is_operators(condition):
+                matched = _matches_operators(values, condition, variables)
+            else:
+                matched = any(_equals(value, condition) for value in _expand(values))
+        if not matched:
+            return False
+    return True
+
+
+# Expressions
+
+def _arguments(arguments, document, variables):
+    if not isinstance(arguments, list):
+        arguments = [arguments]
+    return [evaluate(argument, document, variables) for argument in arguments]
+
+
+def _numbers(values):
+    return [value for value in values if _type_name(value) == 'number']
+
+
+def _add(values):
+    values = [_value(value) for value in values]
+    if any(value is None for value in values):
+        return None
+    dates = [value for value in values if isinstance(value, datetime)]
+    total = sum(value for value in values if not isinstance(value, datetime))
+    if dates:
+        return dates[0] + timedelta(milliseconds=total)
+    return total
+
+
+def _subtract(first, second):
+    first, second = _value(first), _value(second)
+    if first is None or second is None:
+        return None
+    if isinstance(first, datetime) and isinstance(second, datetime):
+        return int((first - second) / timedelta(milliseconds=1))
+    if isinstance(first, datetime):
+        return first - timedelta(milliseconds=second)
+    return first - second
+
+
+def _round(value, place, function):
+    if value is None:
+        return None
+    factor = 10 ** place
+    result = function(value * factor) / factor if place else function(value)
+    return float(result) if isinstance(value, float) else result
+
+
+def _date_to_string(date, date_format='%Y-%m-%dT%H:%M:%S.%LZ'):
+    if date is None:
+        return None
+    replacements = {
+        '%Y': f'{date.year:04d}', '%m': f'{date.month:02d}', '%d': f'{date.day:02d}',
+        '%H': f'{date.hour:02d}', '%M': f'{date.minute:02d}', '%S': f'{date.second:02d}',
+        '%L': f'{date.microsecond // 1000:03d}', '%j': f'{date.timetuple().tm_yday:03d}',
+        '%w': str(date.isoweekday() % 7 + 1), '%u': str(date.isoweekday()),
+        '%U': date.strftime('%U'), '%V': f'{date.isocalendar()[1]:02d}', '%G': str(date.isocalendar()[0]),
+        '%%': '%',
+    }
+    return re.sub('%.', lambda match: replacements.get(match.group(0), match.group(0)), date_format)
+
+
+_DATE_PARTS = {
+    '$year': lambda date: date.year,
+    '$month': lambda date: date.month,
+    '$dayOfMonth': lambda date: date.day,
+    '$hour': lambda date: date.hour,
+    '$minute': lambda date: date.minute,
+    '$second': lambda date: date.second,
+    '$millisecond': lambda date: date.microsecond // 1000,
+    '$dayOfWeek': lambda date: date.isoweekday() % 7 + 1,
+    '$dayOfYear': lambda date: date.timetuple().tm_yday,
+    '$week': lambda date: int(date.strftime('%U')),
+}
+
+
+def _cond(arguments, document, variables):
+    if isinstance(arguments, dict):
+        condition, then, otherwise = arguments['if'], arguments['then'], arguments['else']
+    else:
+        condition, then, otherwise = arguments
+    if _is_true(evaluate(condition, document, variables)):
+        return evaluate(then, document, variables)
+    return evaluate(otherwise, document, variables)
+
+
+def _switch(arguments, document, variables):
+    for branch in arguments['branches']:
+        if _is_true(evaluate(branch['case'], document, variables)):
+            return evaluate(branch['then'], document, variables)
+    if 'default' not in arguments:
+        raise ValueError('$switch has no default and no branch matched.')
+    return evaluate(arguments['default'], document, variables)
+
+
+def _if_null(arguments, document, variables):
+    for argument in arguments[:-1]:
+        value = evaluate(argument, document, variables)
+        if value is not None and value is not _MISSING:
+            return value
+    return evaluate(arguments[-1], document, variables)
+
+
+def _array_operator(operator, arguments, document, variables):
+    """$filter and $map."""
+    values = _value(evaluate(arguments['input'], document, variables))
+    if values is None:
+        return None
+    name = arguments.get('as', 'this')
+    expression = arguments['cond' if operator == '$filter' else 'in']
+    result = []
+    for value in values:
+        item_variables = dict(variables or {}, **{name: value})
+        item = evaluate(expression, document, item_variables)
+        if operator == '$map':
+            result.append(_value(item))
+        elif _is_true(item):
+            result.append(value)
+    return result
+
+
+def _reduce(arguments, document, variables):
+    values = _value(evaluate(arguments['input'], document, variables))
+    if values is None:
+        return None
+    accumulated = evaluate(arguments['initialValue'], document, variables)
+    for value in values:
+        accumulated = evaluate(arguments['in'], document, dict(variables or {}, value=accumulated, this=value))
+    return accumulated
+
+
+def _let(arguments, document, variables):
+    local_variables = dict(variables or {})
+    for name, expression in arguments['vars'].items():
+        local_variables[name] = evaluate(expression, document, variables)
+    return evaluate(arguments['in'], document, local_variables)
+
+
+def _accumulate_array(operator, values):
+    """$sum, $avg, $min, $max in expression form."""
+    if len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    if operator == '$sum':
+        return sum(_numbers(values))
+    if operator == '$avg':
+        numbers = _numbers(values)
+        return sum(numbers) / len(numbers) if numbers else None
+    values = [value for value in values if value is not None and value is not _MISSING]
+    if not values:
+        return None
+    key = cmp_to_key(_compare)
+    return min(values, key=key) if operator == '$min' else max(values, key=key)
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return _date_to_string(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _operator(operator, arguments, document, variables):
+    if operator == '$literal':
+        return arguments
+    if operator == '$cond':
+        return _cond(arguments, document, variables)
+    if operator == '$switch':
+        return _switch(arguments, document, variables)
+    if operator == '$ifNull':
+        return _if_null(arguments, document, variables)
+    if operator in ('$filter', '$map'):
+        return _array_operator(operator, arguments, document, variables)
+    if operator == '$reduce':
+        return _reduce(arguments, document, variables)
+    if operator == '$let':
+        return _let(arguments, document, variables)
+    if operator == '$and':
+        return all(_is_true(evaluate(argument, document, variables)) for argument in arguments)
+    if operator == '$or':
+        return any(_is_true(evaluate(argument, document, variables)) for argument in arguments)
+
+    if operator == '$dateToString':
+        date = _value(evaluate(arguments['date'], document, variables))
+        if date is None:
+            return _value(evaluate(arguments.get('onNull'), document, variables))
+        return _date_to_string(date, arguments.get('format', '%Y-%m-%dT%H:%M:%S.%LZ'))
+    if operator == '$mergeObjects':
+        result = {}
+        for value in _arguments(arguments, document, variables):
+            if isinstance(value, dict):
+                result.update(value)
+        return result
+
+    values = _arguments(arguments, document, variables)
+    if operator in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$cmp'):
+        # Missing field is lower than null in expressions
+        result = _compare(values[0], values[1])
+        return {
+            '$eq': result == 0, '$ne': result != 0, '$gt': result > 0, '$gte': result >= 0,
+            '$lt': result < 0, '$lte': result <= 0, '$cmp': result,
+        }[operator]
+    if operator == '$not':
+        return not _is_true(values[0])
+    if operator == '$type':
+        return _bson_type(values[0])
+    if operator == '$in':
+        return any(_compare(_value(values[0]), item) == 0 for item in values[1])
+    if operator in _DATE_PARTS:
+        date = _value(values[0])
+        return None if date is None else _DATE_PARTS[operator](date)
+    if operator in ('$sum', '$avg', '$min', '$max'):
+        return _accumulate_array(operator, values)
+
+    values = [_value(value) for value in values]
+    if operator == '$add':
+        return _add(values)
+    if operator == '$subtract':
+        return _subtract(*values)
+    if operator in ('$multiply', '$divide', '$mod', '$abs', '$trunc', '$round', '$floor', '$ceil', '$concat',
+                    '$toLower', '$toUpper', '$size', '$arrayElemAt', '$concatArrays', '$setUnion', '$isArray',
+                    '$toString', '$strLenCP', '$split', '$first', '$last', '$toInt', '$toDouble',
+                    '$toBool', '$substr', '$substrCP', '$indexOfArray', '$reverseArray', '$objectToArray',
+                    '$arrayToObject'):
+        return _simple_operator(operator, values)
+    raise ValueError(f'Unsupported expression operator: {operator}.')
+
+
+def _simple_operator(operator, values):
+    """Operators of evaluated arguments, null arguments mostly give null."""
+    if operator == '$isArray':
+        return isinstance(values[0], list)
+    if operator == '$toBool':
+        return None if values[0] is None else _is_true(values[0])
+    if operator == '$concatArrays':
+        return None if any(value is None for value in values) else [item for value in values for item in value]
+    if operator == '$setUnion':
+        result, known = [], set()
+        for item in (item for value in values if value for item in value):
+            if _sort_key(item) not in known:
+                known.add(_sort_key(item))
+                result.append(item)
+        return result
+    if any(value is None for value in values[:1]) or operator in ('$multiply', '$divide', '$concat') and None in values:
+        return None
+    first = values[0]
+    if operator == '$multiply':
+        result = 1
+        for value in values:
+            result *= value
+        return result
+    if operator == '$divide':
+        return first / values[1]
+    if operator == '$mod':
+        return math.fmod(first, values[1]) if isinstance(first, float) else first % values[1]
+    if operator == '$abs':
+        return abs(first)
+    if operator == '$trunc':
+        return _round(first, values[1] if len(values) > 1 else 0, math.trunc)
+    if operator == '$round':
+        return float(round(first, values[1] if len(values) > 1 else 0)) if isinstance(first, float) else first
+    if operator == '$floor':
+        return _round(first, 0, math.floor)
+    if operator == '$ceil':
+        return _round(first, 0, math.ceil)
+    if operator == '$concat':
+        return ''.join(values)
+    if operator == '$toLower':
+        return first.lower()
+    if operator == '$toUpper':
+        return first.upper()
+    if operator in ('$substr', '$substrCP'):
+        return first[values[1]:values[1] + values[2]] if values[2] >= 0 else first[values[1]:]
+    if operator == '$strLenCP':
+        return len(first)
+    if operator == '$split':
+        return first.split(values[1])
+    if operator == '$size':
+        return len(first)
+    if operator == '$arrayElemAt':
+        index = values[1]
+        return first[index] if -len(first) <= index < len(first) else _MISSING
+    if operator == '$first':
+        return first[0] if first else _MISSING
+    if operator == '$last':
+        return first[-1] if first else _MISSING
+    if operator == '$indexOfArray':
+        return next((i for i, item in enumerate(first) if _compare(item, values[1]) == 0), -1)
+    if operator == '$reverseArray':
+        return list(reversed(first))
+    if operator == '$objectToArray':
+        return [{'k': key, 'v': value} for key, value in first.items()]
+    if operator == '$arrayToObject':
+        return dict((item['k'], item['v']) if isinstance(item, dict) else tuple(item) for item in first)
+    if operator == '$toString':
+        return _to_string(first)
+    if operator == '$toInt':
+        return int(first)
+    if operator == '$toDouble':
+        return float(first)
+
+
+def _now():
+    """Returns current UTC time with milliseconds precision like BSON date."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def evaluate(expression, document, variables=None):
+    """
+    Evaluates aggregation expression for the document. Missing fields give _MISSING.
+
+    >>> evaluate({'$cond': [{'$gt': ['$amount', 5]}, {'$multiply': ['$amount', 2]}, 0]}, {'amount': 10})
+    20
+    >>> evaluate({'$concat': ['$name', ' ', {'$toUpper': '$code'}]}, {'name': 'Main', 'code': 'a1'})
+    'Main A1'
+    >>> evaluate({'$cond': [{'$gt': ['$amount', 5]}, '$amount', '$$REMOVE']}, {'amount': 1}) is _MISSING
+    True
+    """
+    if isinstance(expression, str):
+        if expression.startswith('$$'):
+            name, _, path = expression[2:].partition('.')
+            if name in ('ROOT', 'CURRENT'):
+                value = document
+            elif name == 'REMOVE':
+                return _MISSING
+            elif variables and name in variables:
+                value = variables[name]
+            elif name == 'NOW':
+                value = _now()
+            elif name in UNSUPPORTED_VARIABLES:
+                raise ValueError(f'Unsupported system variable: {name}.')
+            else:
+                raise ValueError(f'Undefined variable: {name}.')
+            return get_field(value, path) if path else value
+        if expression.startswith('$'):
+            return get_field(document, expression[1:])
+        return expression
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator = next(iter(expression))
+            if operator.startswith('$'):
+                return _operator(operator, expression[operator], document, variables)
+        result = {}
+        for key, value in expression.items():
+            value = evaluate(value, document, variables)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+    if isinstance(expression, list):
+        return [_value(evaluate(item, document, variables)) for item in expression]
+    return expression
+
+
+# Stages
+
+def _match(documents, query, variables):
+    for document in documents:
+        if matches(document, query, variables):
+            yield document
+
+
+def _is_inclusion(value):
+    return not isinstance(value, (dict, list, str)) and value in (1, True)
+
+
+def _is_exclusion(value):
+    return not isinstance(value, (dict, list, str)) and value in (0, False)
+
+
+def _project(documents, specification, variables):
+    specification = _flatten_specification(specification)
+    fields = {key: value for key, value in specification.items() if key != '_id'}
+    if not fields and _is_exclusion(specification.get('_id', 1)) or fields and all(
+            _is_exclusion(value) for value in fields.values()):
+        for document in documents:
+            for field in specification:
+                document = remove_field(document, field)
+            yield document
+        return
+
+    id_specification = specification.get('_id', 1)
+    for document in documents:
+        result = {}
+        if _is_inclusion(id_specification) and '_id' in document:
+            result['_id'] = document['_id']
+        for field, value in specification.items():
+            if field == '_id' and (_is_inclusion(value) or _is_exclusion(value)):
+                continue
+            if _is_inclusion(value):
+                _include_field(document, result, field.split('.'))
+                continue
+            value = evaluate(value, document, variables)
+            if value is not _MISSING:
+                result = set_field(result, field, value)
+        yield result
+
+
+def _add_fields(documents, specification, variables):
+    specification = _flatten_specification(specification)
+    for document in documents:
+        result = document
+        for field, expression in specification.items():
+            value = evaluate(expression, document, variables)
+            if value is not _MISSING:
+                result = set_field(result, field, value)
+            elif field in document:
+                result = remove_field(result, field)
+        yield result
+
+
+def _unset(documents, fields):
+    fields = [fields] if isinstance(fields, str) else fields
+    for document in documents:
+        for field in fields:
+            document = remove_field(document, field)
+        yield document
+
+
+def _unwind(documents, specification):
+    if isinstance(specification, str):
+        specification = {'path': specification}
+    path = specification['path'][1:]
+    preserve = specification.get('preserveNullAndEmptyArrays', False)
+    index_field = specification.get('includeArrayIndex')
+    for document in documents:
+        value = get_field(document, path) if '.' not in path else _get_embedded(document, path)
+        if isinstance(value, list) and value:
+            for i, item in enumerate(value):
+                result = set_field(document, path, item)
+                if index_field:
+                    result = set_field(result, index_field, i)
+                yield result
+        elif isinstance(value, list) or value is None or value is _MISSING:
+            if not preserve:
+                continue
+            if isinstance(value, list):
+                document = remove_field(document, path)
+            if index_field:
+                document = set_field(document, index_field, None)
+            yield document
+        else:
+            if index_field:
+                document = set_field(document, index_field, None)
+            yield document
+
+
+def _get_embedded(document, path):
+    """Returns the field value by embedded documents path without mapping arrays."""
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _lookup_keys(value):
+    """Equality keys of the value and its array elements."""
+    if value is _MISSING:
+        value = None
+    keys = [_sort_key(value)]
+    if isinstance(value, list):
+        keys.extend(_sort_key(item) for item in value)
+    return keys
+
+
+def _lookup(documents, specification, database, variables):
+    foreign = list(database[specification['from']].documents) if specification['from'] in database else []
+    as_field = specification['as']
+    local_field = specification.get('localField')
+    index = None
+    if local_field is not None:
+        # Hash join by foreign field values
+        index = {}
+        for position, foreign_document in enumerate(foreign):
+            for key in _lookup_keys(get_field(foreign_document, specification['foreignField'])):
+                index.setdefault(key, []).append(position)
+
+    for document in documents:
+        joined = foreign
+        if index is not None:
+            positions = set()
+            for key in _lookup_keys(get_field(document, local_field)):
+                positions.update(index.get(key, ()))
+            joined = [foreign[position] for position in sorted(positions)]
+        if 'pipeline' in specification:
+            lookup_variables = dict(variables or {})
+            for name, expression in specification.get('let', {}).items():
+                lookup_variables[name] = _value(evaluate(expression, document, variables))
+            joined = run_pipeline(joined, specification['pipeline'], database, lookup_variables)
+        yield set_field(document, as_field, [deepcopy(item) for item in joined])
+
+
+class _Accumulator(object):
+    __slots__ = ('operator', 'value', 'count', 'known')
+
+    def __init__(self, operator):
+        self.operator = operator
+        self.value = {'$sum': 0, '$push': [], '$addToSet': [], '$count': 0}.get(operator, _MISSING)
+        self.count = 0
+        self.known = set()
+
+    def add(self, value):
+        operator = self.operator
+        if operator == '$sum':
+            # Unlike the expression, the accumulator ignores arrays
+            if _type_name(value) == 'number':
+                self.value += value
+        elif operator == '$avg':
+            if _type_name(value) == 'number':
+                self.value = (0 if self.value is _MISSING else self.value) + value
+                self.count += 1
+        elif operator in ('$min', '$max'):
+            if value is None or value is _MISSING:
+                return
+            if self.value is _MISSING or (_compare(value, self.value) < 0) == (operator == '$min') and _compare(
+                    value, self.value) != 0:
+                self.value = value
+        elif operator == '$first':
+            if self.value is _MISSING:
+                self.value = _value(value)
+                self.count = 1
+        elif operator == '$last':
+            self.value = _value(value)
+        elif operator == '$push':
+            if value is not _MISSING:
+                self.value.append(value)
+        elif operator == '$addToSet':
+            if value is not _MISSING and _sort_key(value) not in self.known:
+                self.known.add(_sort_key(value))
+                self.value.append(value)
+        elif operator == '$count':
+            self.value += 1
+        else:
+            raise ValueError(f'Unsupported accumulator: {operator}.')
+
+    def result(self):
+        if self.operator == '$avg':
+            return self.value / self.count if self.count else None
+        return None if self.value is _MISSING else self.value
+
+
+def _group(documents, specification, variables):
+    accumulators = {
+        field: next(iter(accumulator.items()))
+        for field, accumulator in specification.items()
+        if field != '_id'
+    }
+    groups = {}
+    for document in documents:
+        group_id = _value(evaluate(specification['_id'], document, variables))
+        key = _sort_key(group_id)
+        if key not in groups:
+            groups[key] = (group_id, {field: _Accumulator(operator) for field, (operator, _) in accumulators.items()})
+        for field, (operator, expression) in accumulators.items():
+            groups[key][1][field].add(evaluate(expression, document, variables) if operator != '$count' else 1)
+    for group_id, group_accumulators in groups.values():
+        result = {'_id': group_id}
+        for field, accumulator in group_accumulators.items():
+            result[field] = accumulator.result()
+        yield result
+
+
+def _sort_value(document, parts, direction):
+    value = document.get(parts[0], _MISSING) if len(parts) == 1 else get_field(document, parts)
+    if isinstance(value, list) and value:
+        # Arrays are sorted by the lowest element ascending and by the highest descending
+        key = cmp_to_key(_compare)
+        value = min(value, key=key) if direction == 1 else max(value, key=key)
+    return _value(value)
+
+
+class _Descending(object):
+    """Sort key wrapper inverting the order."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _sorting_key(specification):
+    """Returns key function of the $sort stage, keys are computed once per document."""
+    keys = [(field.split('.'), direction) for field, direction in specification.items()]
+
+    def key(document):
+        values = []
+        for parts, direction in keys:
+            value = _sort_key(_sort_value(document, parts, direction))
+            values.append(value if direction == 1 else _Descending(value))
+        return tuple(values)
+    return key
+
+
+def _replace_root(documents, expression, variables):
+    for document in documents:
+        root = evaluate(expression, document, variables)
+        if not isinstance(root, dict):
+            raise ValueError(f'New root must be a document, got {_value(root)!r}.')
+        yield root
+
+
+def _count(documents, field):
+    count = sum(1 for _ in documents)
+    if count:
+        yield {field: count}
+
+
+def _merge_key(document, fields):
+    return tuple(_sort_key(_value(get_field(document, field))) for field in fields)
+
+
+def _merge(documents, specification, database, variables):
+    """Writes the documents to the collection like $merge. Runs at once, as the server does."""
+    if isinstance(specification, str):
+        specification = {'into': specification}
+    into = specification['into']
+    target = database[into if isinstance(into, str) else into['coll']]
+    on = specification.get('on', '_id')
+    on = [on] if isinstance(on, str) else list(on)
+    when_matched = specification.get('whenMatched', 'merge')
+    when_not_matched = specification.get('whenNotMatched', 'insert')
+    let = specification.get('let', {'new': '$$ROOT'})
+    # Documents are collected first, the target may be the source collection
+    documents = list(documents)
+    positions = {_merge_key(document, on): i for i, document in enumerate(target.documents)}
+    for document in documents:
+        key = _merge_key(document, on)
+        position = positions.get(key)
+        if position is None:
+            if when_not_matched == 'fail':
+                raise ValueError(f'$merge: no document in {target.name} matches {document!r}.')
+            if when_not_matched == 'insert':
+                positions[key] = len(target.documents)
+                target.documents.append(deepcopy(document))
+            continue
+        existing = target.documents[position]
+        if when_matched == 'fail':
+            raise ValueError(f'$merge: document in {target.name} already exists for {document!r}.')
+        if when_matched == 'keepExisting':
+            continue
+        if when_matched == 'replace':
+            merged = dict(deepcopy(document), _id=existing['_id']) if '_id' in existing else deepcopy(document)
+        elif when_matched == 'merge':
+            merged = dict(existing, **deepcopy(document))
+        else:
+            merge_variables = dict(variables or {})
+            for name, expression in let.items():
+                merge_variables[name] = _value(evaluate(expression, document, variables))
+            merged = next(run_pipeline([existing], when_matched, database, merge_variables))
+        target.documents[position] = merged
+    return iter(())
+
+
+def _out(documents, specification, database):
+    """Replaces the collection documents like $out."""
+    name = specification if isinstance(specification, str) else specification['coll']
+    database[name].documents[:] = [deepcopy(document) for document in documents]
+    return iter(())
+
+
+def run_pipeline(documents, pipeline, database=None, variables=None):
+    """
+    Returns generator of the pipeline results over the documents.
+    :param documents: Iterable of documents, they are not changed
+    :param pipeline: List of stages
+    :param database: Mapping of collection names to InMemoryCollection for $lookup
+    :param variables: Variables of $lookup pipeline
+    """
+    database = database if database is not None else {}
+    # $$NOW is the same for all the stages
+    variables = dict(variables or {})
+    variables.setdefault('NOW', _now())
+    documents = iter(documents)
+    stages = list(pipeline)
+    i = 0
+    while i < len(stages):
+        name, specification = next(iter(stages[i].items()))
+        if name == '$match':
+            documents = _match(documents, specification, variables)
+        elif name == '$project':
+            documents = _project(documents, specification, variables)
+        elif name in ('$addFields', '$set'):
+            documents = _add_fields(documents, specification, variables)
+        elif name == '$unset':
+            documents = _unset(documents, specification)
+        elif name == '$unwind':
+            documents = _unwind(documents, specification)
+        elif name == '$lookup':
+            documents = _lookup(documents, specification, database, variables)
+        elif name == '$group':
+            documents = _group(documents, specification, variables)
+        elif name == '$sort':
+            key = _sorting_key(specification)
+            if i + 1 < len(stages) and '$limit' in stages[i + 1]:
+                # Top-k sort keeps only the limited number of documents
+                documents = iter(heapq.nsmallest(stages[i + 1]['$limit'], documents, key=key))
+                i += 1
+            else:
+                documents = iter(sorted(documents, key=key))
+        elif name == '$skip':
+            documents = islice(documents, specification, None)
+        elif name == '$limit':
+            documents = islice(documents, specification)
+        elif name == '$count':
+            documents = _count(documents, specification)
+        elif name == '$replaceRoot':
+            documents = _replace_root(documents, specification['newRoot'], variables)
+        elif name == '$replaceWith':
+            documents = _replace_root(documents, specification, variables)
+        elif name == '$facet':
+            documents = list(documents)
+            documents = iter([{
+                field: list(run_pipeline(documents, facet_pipeline, database, variables))
+                for field, facet_pipeline in specification.items()
+            }])
+        elif name == '$merge':
+            documents = _merge(documents, specification, database, variables)
+        elif name == '$out':
+            documents = _out(documents, specification, database)
+        else:
+            raise ValueError(f'Unsupported stage: {name}.')
+        i += 1
+    return documents
+
+
+class InMemoryCollection(object):
+    """
+    Collection stand-in keeping documents in a list.
+    Implements aggregate, find, count_documents, estimated_document_count and update_one ($set and $setOnInsert)
+    like pymongo collection.
+    Collation is not supported, strings are compared by code points.
+    Collection without name gets unique one, so cached results of different lists are not mixed up.
+
+    >>> InMemoryCollection().name != InMemoryCollection().name
+    True
+    """
+
+    def __init__(self, documents=None, name='', database=None):
+        self.documents = documents if documents is not None else []
+        self.name = name or f'documents_{next(_UNNAMED_COLLECTIONS)}'
+        self.database = database if database is not None else InMemoryEngine()
+        if self.name not in self.database:
+            self.database.collections[self.name] = self
+
+    @property
+    def full_name(self):
+        return f'{self.database.name}.{self.name}'
+
+    def __repr__(self):
+        return f'InMemoryCollection({self.name!r}, {len(self.documents)} documents)'
+
+    def aggregate(self, pipeline, allowDiskUse=False, collation=None, let=None, **options):
+        documents = run_pipeline(self.documents, pipeline, self.database, let)
+        return (deepcopy(document) for document in documents)
+
+    def find(self, filter=None, projection=None):
+        pipeline = [{'$match': filter or {}}]
+        if projection:
+            pipeline.append({'$project': projection})
+        return self.aggregate(pipeline)
+
+    def find_one(self, filter=None, projection=None):
+        return next(self.find(filter, projection), None)
+
+    def count_documents(self, filter, **options):
+        return sum(1 for document in self.documents if matches(document, filter))
+
+    def estimated_document_count(self, **options):
+        return len(self.documents)
+
+    def insert_many(self, documents):
+        self.documents.extend(documents)
+
+    def insert_one(self, document):
+        self.documents.append(document)
+
+    def update_one(self, filter, update, upsert=False):
+        """Updates the first matching document by $set and $setOnInsert (on upsert) operators."""
+        position = next((i for i, document in enumerate(self.documents) if matches(document, filter)), None)
+        unsupported = update.keys() - {'$set', '$setOnInsert'}
+        if unsupported:
+            raise ValueError(f'Unsupported update operators: {", ".join(sorted(unsupported))}.')
+        if position is None:
+            if not upsert:
+                return
+            document = {key: value for key, value in filter.items() if not key.startswith('$')}
+            for path, value in update.get('$setOnInsert', {}).items():
+                document = set_field(document, path, value)
+            self.documents.append(document)
+            position = len(self.documents) - 1
+        document = self.documents[position]
+        for path, value in update.get('$set', {}).items():
+            document = set_field(document, path, value)
+        self.documents[position] = document
+
+
+class InMemoryEngine(object):
+    """
+    In-process database: collections by names, also available as attributes like in pymongo database.
+    """
+
+    def __init__(self, collections=None, name='memory'):
+        self.name = name
+        self.collections = {}
+        for collection_name, documents in (collections or {}).items():
+            self[collection_name] = documents
+
+    def __contains__(self, name):
+        return name in self.collections
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            InMemoryCollection(name=name, database=self)
+        return self.collections[name]
+
+    def __setitem__(self, name, documents):
+        if isinstance(documents, InMemoryCollection):
+            documents = documents.documents
+        self.collections[name] = InMemoryCollection(list(documents), name=name, database=self)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name):
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self.collections)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Concurrent execution of independent pipelines on a shared thread pool."""
+
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import wait as wait_futures
+from time import monotonic
+
+
+class PipelineResults(list):
+    """
+    Results in the order of the pipelines. Results of failed pipelines are None,
+    their exceptions are kept in errors dictionary {pipeline index: exception}.
+    """
+
+    def __init__(self, results=(), errors=None):
+        super(PipelineResults, self).__init__(results)
+        self.errors = errors or {}
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+class PipelineExecutor(object):
+    """
+    Runs MongoAggregation objects (aggregate with as_list) and callables (e.g. partial(pipeline.count))
+    concurrently, at most max_workers at once. The thread pool is created on the first run and kept
+    until close, so it may be shared by requests. clock is the function returning seconds for timeouts.
+
+    >>> from functools import partial
+    >>> from mongo_aggregation import MongoAggregation
+    >>> from mongo_aggregation.engine import InMemoryEngine
+    >>> engine = InMemoryEngine({'action': [{'_id': 1, 'amount': 10}, {'_id': 2, 'amount': 5}]})
+    >>> with PipelineExecutor(max_workers=2) as executor:
+    ...     results = executor.run([
+    ...         MongoAggregation(collection=engine.action).match(amount__gte=10),
+    ...         partial(MongoAggregation(collection=engine.action).count),
+    ...         MongoAggregation(collection=engine.action).project(total={'$unknown': 1}),
+    ...     ])
+    >>> results[:2], results.errors
+    ([[{'_id': 1, 'amount': 10}], 2], {2: ValueError('Unsupported expression operator: $unknown.')})
+
+    Pipelines started later get the remaining time as maxTimeMS:
+
+    >>> class Clock(object):
+    ...     now = 0
+    ...     def __call__(self):
+    ...         return self.now
+    ...     def advance(self):
+    ...         self.now += 1
+    >>> class MaxTime(object):
+    ...     def aggregate(self, as_list, maxTimeMS):
+    ...         return maxTimeMS
+    >>> clock = Clock()
+    >>> with PipelineExecutor(max_workers=1, clock=clock) as executor:
+    ...     executor.run([clock.advance, MaxTime()], timeout=[5, 5])
+    [None, 4000]
+
+    The ones not completed in time get TimeoutError:
+
+    >>> import threading
+    >>> release = threading.Event()
+    >>> with PipelineExecutor(max_workers=1) as executor:
+    ...     timed_out = executor.run([release.wait, MaxTime()], timeout=0.01)
+    ...     release.set()
+    >>> list(timed_out.errors), timed_out.errors[0]
+    ([0, 1], TimeoutError('Pipeline 0 is not completed in 0.01 seconds.'))
+    """
+
+    def __init__(self, max_workers=8, clock=monotonic):
+        self.max_workers = max_workers
+        self.clock = clock
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='mongo_aggregation')
+            return self._executor
+
+    def _call(self, pipeline, deadline, kwargs):
+        if deadline is not None:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                raise TimeoutError('Pipeline is not started in time.')
+        if hasattr(pipeline, 'aggregate'):
+            if deadline is not None:
+                # Server stops the pipeline which is not waited for anymore
+                kwargs = dict(kwargs, maxTimeMS=max(int(remaining * 1000), 1))
+            return pipeline.aggregate(as_list=True, **kwargs)
+        return pipeline()
+
+    def run(self, pipelines, timeout=None, raise_errors=False, **kwargs):
+        """
+        Runs the pipelines and returns PipelineResults in their order.
+        :param pipelines: MongoAggregation objects or callables without arguments
+        :param timeout: Seconds to wait for each pipeline from the start of the run, a number or a list by pipelines.
+            Timed out pipelines get TimeoutError. MongoAggregation objects get the time remaining when they start
+            as maxTimeMS. Callables are not bounded on the server: a timed out callable keeps its thread
+            until it returns, so pass maxTimeMS to it (e.g. partial(pipeline.count, maxTimeMS=1000))
+        :param raise_errors: Raise the first error instead of returning partial results
+        :param kwargs: aggregate arguments of MongoAggregation objects
+        """
+        pipelines = list(pipelines)
+        timeouts = list(timeout) if isinstance(timeout, (list, tuple)) else [timeout] * len(pipelines)
+        if len(timeouts) != len(pipelines):
+            raise ValueError(f'{len(timeouts)} timeouts are given for {len(pipelines)} pipelines.')
+        started = self.clock()
+        futures = [
+            self.executor.submit(
+                self._call, pipeline, None if pipeline_timeout is None else started + pipeline_timeout, kwargs)
+            for pipeline, pipeline_timeout in zip(pipelines, timeouts)
+        ]
+        results, errors = [], {}
+        for i, (future, pipeline_timeout) in enumerate(zip(futures, timeouts)):
+            remaining = None if pipeline_timeout is None else max(started + pipeline_timeout - self.clock(), 0)
+            wait_futures([future], timeout=remaining)
+            if not future.done():
+                future.cancel()
+                errors[i] = TimeoutError(f'Pipeline {i} is not completed in {pipeline_timeout} seconds.')
+            elif future.exception() is not None:
+                errors[i] = future.exception()
+            results.append(None if i in errors else future.result())
+            if raise_errors and i in errors:
+                for other in futures[i + 1:]:
+                    other.cancel()
+                raise errors[i]
+        return PipelineResults(results, errors)
+
+    def close(self, wait=True):
+        """Shuts the thread pool down. Without wait the running pipelines (e.g. timed out) are not waited for."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Number of threads of the shared pool, set it before the first run_many call
+SHARED_MAX_WORKERS = 8
+_shared_executor = None
+_shared_lock = threading.Lock()
+
+
+def shared_executor():
+    """Returns PipelineExecutor shared by run_many calls without executor.
+    It is created on the first call with SHARED_MAX_WORKERS threads and closed at exit."""
+    global _shared_executor
+    with _shared_lock:
+        if _shared_executor is None:
+            _shared_executor = PipelineExecutor(SHARED_MAX_WORKERS)
+            # Running pipelines are not waited for at exit
+            atexit.register(_shared_executor.close, wait=False)
+        return _shared_executor
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Pipelines sharing a prefix of stages are sent as one aggregation with $facet of their remaining stages."""
+
+import json
+import logging
+
+from .cache import collection_key
+from .optimizer import count_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Stages which can't be used inside $facet
+NOT_IN_FACET_STAGES = (
+    '$changeStream', '$collStats', '$facet', '$geoNear', '$indexStats', '$merge', '$out', '$planCacheStats',
+    '$search', '$searchMeta',
+)
+# Stages bounding the number of documents, facets without them could return whole documents
+REDUCING_STAGES = ('$group', '$count', '$limit', '$bucket', '$bucketAuto', '$sortByCount')
+# Server errors of the result document over the 16 MB limit
+DOCUMENT_TOO_LARGE_CODES = (10334, 17419, 4031700)
+# aggregate arguments changing the shape of the result, they can't be applied to the combined one
+POST_PROCESSING_ARGUMENTS = (
+    'as_list', 'as_columns', 'dtypes', 'structured', 'raw', 'eager_fields', 'adaptive', 'memory_budget', 'pipeline',
+    'client_lookups',
+)
+
+
+class Count(object):
+    """Marker of a pipeline which number of documents is needed, like MongoAggregation.count."""
+
+    def __init__(self, aggregation):
+        self.aggregation = aggregation
+
+    @property
+    def pipeline(self):
+        return count_pipeline(self.aggregation.pipeline, self.aggregation.unique_lookups) + [{'$count': 'count'}]
+
+
+class FacetResults(list):
+    """
+    Results in the order of the pipelines. queries is the number of completed aggregations,
+    fallbacks is dictionary {pipeline index: reason} of pipelines run separately.
+    """
+
+    def __init__(self, results=(), queries=0, fallbacks=None):
+        super(FacetResults, self).__init__(results)
+        self.queries = queries
+        self.fallbacks = fallbacks or {}
+
+
+def _canonical(stage):
+    # Order of keys is kept as it is significant for $sort
+    return json.dumps(stage, separators=(',', ':'), default=repr)
+
+
+def common_prefix_length(pipelines):
+    """
+    Returns the number of leading stages equal in all the pipelines.
+
+    >>> common_prefix_length([[{'$match': {'a': 1}}, {'$count': 'n'}], [{'$match': {'a': 1}}, {'$limit': 5}]])
+    1
+    """
+    if not pipelines:
+        return 0
+    length = min(len(pipeline) for pipeline in pipelines)
+    for i in range(length):
+        stage = _canonical(pipelines[0][i])
+        if any(_canonical(pipeline[i]) != stage for pipeline in pipelines[1:]):
+            return i
+    return length
+
+
+def suffix_problem(suffix):
+    """
+    Returns the reason why the stages can't be a facet or None.
+
+    >>> suffix_problem([{'$sort': {'a': 1}}])
+    'no stage bounding the result size ($group, $count, $limit and alike)'
+    """
+    if not suffix:
+        return 'no stages after the shared prefix'
+    for stage in suffix:
+        name = next(iter(stage))
+        if name in NOT_IN_FACET_STAGES:
+            return f'{name} stage can\'t be used in $facet'
+    if not any(next(iter(stage)) in REDUCING_STAGES for stage in suffix):
+        return 'no stage bounding the result size ($group, $count, $limit and alike)'
+    return None
+
+
+def facet_pipeline(pipelines):
+    """
+    Returns tuple (combined pipeline, facet names) for pipelines with a shared prefix
+    or (None, reason) if they can't be combined.
+
+    >>> facet_pipeline([
+    ...     [{'$match': {'a': 1}}, {'$group': {'_id': '$b'}}],
+    ...     [{'$match': {'a': 1}}, {'$count': 'count'}],
+    ... ])
+    ([{'$match': {'a': 1}}, {'$facet': {'pipeline_0': [{'$group': {'_id': '$b'}}], \
+'pipeline_1': [{'$count': 'count'}]}}], ['pipeline_0', 'pipeline_1'])
+    """
+    prefix = common_prefix_length(pipelines)
+    if not prefix:
+        return None, 'no shared prefix'
+    for stage in pipelines[0][:prefix]:
+        if next(iter(stage)) in NOT_IN_FACET_STAGES:
+            return None, f'{next(iter(stage))} stage in the shared prefix'
+    facets = {}
+    for i, pipeline in enumerate(pipelines):
+        problem = suffix_problem(pipeline[prefix:])
+        if problem:
+            return None, f'pipeline {i}: {problem}'
+        facets[f'pipeline_{i}'] = list(pipeline[prefix:])
+    return list(pipelines[0][:prefix]) + [{'$facet': facets}], list(facets)
+
+
+def _is_too_large(error):
+    return getattr(error, 'code', None) in DOCUMENT_TOO_LARGE_CODES
+
+
+def _result(query, documents):
+    if isinstance(query, Count):
+        return documents[0]['count'] if documents else 0
+    # Facet documents are the pipeline result, so client lookups are joined to them
+    return list(query._joined(documents))
+
+
+def _run_separately(query, **kwargs):
+    if isinstance(query, Count):
+        return query.aggregation.count(**kwargs)
+    return query.aggregate(as_list=True, **kwargs)
+
+
+def run_combined(queries, **kwargs):
+    """
+    Runs MongoAggregation objects (and Count markers) sharing a prefix of stages as one aggregation by collection:
+    the shared stages followed by $facet with the remaining stages of each pipeline.
+    Pipelines are run separately if they can't be combined: without the shared prefix,
+    with stages not allowed in $facet or with a facet which may return whole documents
+    (the $facet result is a single document limited to 16 MB). If the server rejects the combined result
+    as too large, the pipelines are run separately too.
+    The combined aggregation is sent as is: it isn't cached, client lookups of the queries are joined to their
+    results after it.
+    :param queries: MongoAggregation objects or Count markers
+    :param kwargs: aggregate arguments sending the pipeline: collection, allowDiskUse, collation, optimize, cache
+        (of separately run pipelines), batchSize, maxTimeMS, hint, comment and let
+    :return: FacetResults - list of results (lists of documents, numbers for Count) in the order of queries
+
+    >>> from mongo_aggregation import MongoAggregation
+    >>> from mongo_aggregation.engine import InMemoryEngine
+    >>> engine = InMemoryEngine({'action': [{'_id': 1, 'cashbox': 1, 'amount': 10}, {'_id': 2, 'cashbox': 2}]})
+    >>> completed = lambda: MongoAggregation(collection=engine.action).match(amount__gte=1)
+    >>> results = run_combined([
+    ...     completed().group(group_by='cashbox', sum_fields='amount'), Count(completed()),
+    ... ])
+    >>> list(results), results.queries
+    ([[{'_id': 1, 'amount': 10}], 1], 1)
+
+    Pipeline which may return whole documents is run separately:
+
+    >>> results = run_combined([completed().group(group_by='cashbox', sum_fields='amount'), completed().sort('_id')])
+    >>> list(results), results.queries, results.fallbacks[1]
+    ([[{'_id': 1, 'amount': 10}], [{'_id': 1, 'cashbox': 1, 'amount': 10}]], 2, \
+'pipeline 1: no stage bounding the result size ($group, $count, $limit and alike)')
+
+    So are the pipelines whose combined result is rejected by the server as too large:
+
+    >>> from mongo_aggregation.engine import InMemoryCollection
+    >>> class DocumentTooLarge(Exception):
+    ...     code = 10334
+    >>> class LimitedCollection(InMemoryCollection):
+    ...     def aggregate(self, pipeline, **options):
+    ...         if any('$facet' in stage for stage in pipeline):
+    ...             raise DocumentTooLarge('BSONObjectTooLarge')
+    ...         return super().aggregate(pipeline, **options)
+    >>> limited = LimitedCollection(engine.action.documents, 'limited')
+    >>> cashboxes = lambda: MongoAggregation(collection=limited).match(cashbox__gte=1)
+    >>> results = run_combined([cashboxes().group(group_by='cashbox'), Count(cashboxes())])
+    >>> list(results), results.queries, results.fallbacks[0]
+    ([[{'_id': 1}, {'_id': 2}], 2], 2, 'combined result exceeds the document size limit')
+
+    QuerySets of one collection are combined only if they have the same filter:
+
+    >>> class QuerySet(object):
+    ...     def __init__(self, query):
+    ...         self._collection, self._query = engine.action, query
+    ...     def aggregate(self, *pipeline, **options):
+    ...         return self._collection.aggregate([{'$match': self._query}] + list(pipeline), **options)
+    >>> by_cashbox = lambda cashbox: MongoAggregation(collection=QuerySet({'cashbox': cashbox})).match(_id__gte=1)
+    >>> results = run_combined([Count(by_cashbox(1)), Count(by_cashbox(2)), by_cashbox(2).group(group_by='cashbox')])
+    >>> list(results), results.queries
+    ([1, 1, [{'_id': 2}]], 2)
+    """
+    rejected = [name for name in POST_PROCESSING_ARGUMENTS if name in kwargs]
+    if rejected:
+        raise ValueError(f'Arguments {", ".join(rejected)} can not be applied to combined pipelines.')
+    # Empty options are not passed to the driver
+    call_kwargs = {name: value for name, value in kwargs.items() if name != 'cache' and value is not None}
+    queries = list(queries)
+    results, fallbacks, sent = [None] * len(queries), {}, 0
+    by_collection = {}
+    for i, query in enumerate(queries):
+        aggregation = query.aggregation if isinstance(query, Count) else query
+        # QuerySets of one collection with different filters are different sources
+        by_collection.setdefault(collection_key(aggregation.collection), []).append(i)
+
+    for indexes in by_collection.values():
+        separate = indexes
+        if len(indexes) > 1:
+            pipeline, names = facet_pipeline([queries[i].pipeline for i in indexes])
+            if pipeline is None:
+                reason = names
+            else:
+                first = queries[indexes[0]]
+                aggregation = first.aggregation if isinstance(first, Count) else first
+                try:
+                    aggregate = aggregation._get_aggregate_call(pipeline, **call_kwargs)
+                    document = next(iter(aggregate()), None) if aggregate else None
+                    sent += bool(aggregate)
+                    document = document or {name: [] for name in names}
+                    for i, name in zip(indexes, names):
+                        results[i] = _result(queries[i], document[name])
+                    separate = []
+                except Exception as error:
+                    if not _is_too_large(error):
+                        raise
+                    reason = 'combined result exceeds the document size limit'
+            if separate:
+                logger.info(f'Pipelines are run separately: {reason}')
+                fallbacks.update((i, reason) for i in indexes)
+        for i in separate:
+            sent += 1
+            results[i] = _run_separately(queries[i], **kwargs)
+    return FacetResults(results, sent, fallbacks)
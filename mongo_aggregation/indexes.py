@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Index suggestions for pipelines by equality-sort-range rule."""
+
+import re
+
+from .optimizer import merge_queries
+
+EQUALITY, IN, RANGE = 'equality', 'in', 'range'
+# Kinds of conditions by selectivity, the stronger kind of the field wins
+_KIND_ORDER = {RANGE: 0, IN: 1, EQUALITY: 2}
+
+
+def condition_kind(condition):
+    """
+    Returns kind of the field condition: equality, in (several values) or range.
+
+    >>> condition_kind(5), condition_kind({'$in': [1, 2]}), condition_kind({'$gte': 1, '$lt': 5})
+    ('equality', 'in', 'range')
+    """
+    if isinstance(condition, re.Pattern) or condition.__class__.__name__ == 'Regex':
+        return RANGE
+    if not isinstance(condition, dict) or not condition or not all(key.startswith('$') for key in condition):
+        return EQUALITY
+    operators = set(condition) - {'$options'}
+    if '$eq' in operators:
+        return EQUALITY
+    if operators == {'$in'}:
+        return EQUALITY if len(condition['$in']) == 1 else IN
+    return RANGE
+
+
+def leading_query(pipeline):
+    """
+    Returns tuple (query, sort) of the leading $match and $sort stages:
+    merged query and keys of the last $sort. Server moves $match above $sort, so their order doesn't matter.
+
+    >>> leading_query([{'$match': {'a': 1}}, {'$sort': {'b': 1}}, {'$match': {'c': 1}}, {'$project': {'a': 1}}])
+    ({'a': 1, 'c': 1}, {'b': 1})
+    """
+    query, sort = {}, {}
+    for stage in pipeline:
+        if '$match' in stage:
+            query = merge_queries(query, stage['$match'])
+        elif '$sort' in stage:
+            sort = dict(stage['$sort'])
+        else:
+            break
+    return query, sort
+
+
+def _query_fields(query, fields, branches, unindexable):
+    """Collects kinds of the fields conditions, $or branches and conditions which can't use indexes."""
+    for key, condition in query.items():
+        if key == '$and':
+            for item in condition:
+                _query_fields(item, fields, branches, unindexable)
+        elif key == '$or':
+            if branches:
+                unindexable.append('only the first $or condition is split to branches')
+            else:
+                branches.extend(condition)
+        elif key.startswith('$'):
+            unindexable.append(f'{key} condition can not use indexes')
+        else:
+            kind = condition_kind(condition)
+            if _KIND_ORDER[kind] > _KIND_ORDER.get(fields.get(key), -1):
+                fields[key] = kind
+
+
+def index_segments(fields, sort):
+    """
+    Returns index keys by equality-sort-range rule as segments: equality fields (any order), sort keys (in order)
+    and range fields (any order). With sorting $in conditions are placed after the sort keys
+    as they produce several sorted ranges.
+
+    >>> index_segments({'date': 'range', 'cashbox': 'equality', 'status': 'in'}, {'amount': -1})
+    [[('cashbox', 1)], [('amount', -1)], [('status', 1), ('date', 1)]]
+    >>> index_segments({'cashbox': 'equality', 'status': 'in'}, {})
+    [[('cashbox', 1), ('status', 1)], [], []]
+    """
+    equality = [field for field, kind in fields.items() if kind == EQUALITY]
+    in_fields = [field for field, kind in fields.items() if kind == IN]
+    ranges = [field for field, kind in fields.items() if kind == RANGE]
+    # Sorting by a field with equality condition is trivial
+    sort_keys = [(field, direction) for field, direction in sort.items() if field not in equality]
+    sorted_fields = {field for field, _ in sort_keys}
+    if sort_keys:
+        ranges = in_fields + ranges
+    else:
+        equality += in_fields
+    return [
+        [(field, 1) for field in equality],
+        sort_keys,
+        [(field, 1) for field in ranges if field not in sorted_fields],
+    ]
+
+
+def _reason(segments):
+    names = ('equality', 'sort', 'range')
+    return '; '.join(
+        f'{name}: {", ".join(field for field, _ in segment)}' for name, segment in zip(names, segments) if segment
+    )
+
+
+def query_suggestions(query, sort):
+    """Returns list of tuples (segments, reason, unindexable conditions) for the query and the sort."""
+    fields, branches, unindexable = {}, [], []
+    _query_fields(query, fields, branches, unindexable)
+    if not branches:
+        segments = index_segments(fields, sort)
+        return [(segments, _reason(segments), unindexable)] if any(segments) else []
+    # Each $or branch is indexed separately
+    suggestions = []
+    for branch in branches:
+        branch_fields = dict(fields)
+        branch_unindexable = list(unindexable)
+        _query_fields(branch, branch_fields, [], branch_unindexable)
+        segments = index_segments(branch_fields, sort)
+        if any(segments):
+            suggestions.append((segments, f'$or branch; {_reason(segments)}', branch_unindexable))
+    return suggestions
+
+
+def lookup_foreign_fields(pipeline):
+    """
+    Returns list of tuples (stage index, foreign collection, foreign field) of $lookup stages.
+    For pipeline $lookup the fields compared with let variables in the first $match are taken.
+
+    >>> lookup_foreign_fields([{'$lookup': {'from': 'cashbox', 'let': {'c': '$cashbox'}, 'as': 'c', 'pipeline': [
+    ...     {'$match': {'$expr': {'$and': [{'$eq': ['$_id', '$$c']}, {'$eq': ['$$c', '$owner']}]}}}]}}])
+    [(0, 'cashbox', '_id'), (0, 'cashbox', 'owner')]
+    """
+    foreign_fields = []
+    for i, stage in enumerate(pipeline):
+        lookup = stage.get('$lookup')
+        if not lookup:
+            continue
+        if 'foreignField' in lookup:
+            foreign_fields.append((i, lookup['from'], lookup['foreignField']))
+            continue
+        match = next((item['$match'] for item in lookup.get('pipeline', ()) if '$match' in item), {})
+        for field in _expr_equality_fields(match.get('$expr', {})):
+            foreign_fields.append((i, lookup['from'], field))
+    return foreign_fields
+
+
+def _expr_equality_fields(expression):
+    if not isinstance(expression, dict):
+        return []
+    if '$and' in expression:
+        return [field for item in expression['$and'] for field in _expr_equality_fields(item)]
+    arguments = expression.get('$eq')
+    if not isinstance(arguments, list) or len(arguments) != 2:
+        return []
+    fields = [argument for argument in arguments if isinstance(argument, str) and argument.startswith('$')]
+    variables = [field for field in fields if field.startswith('$$')]
+    if len(fields) != 2 or len(variables) != 1:
+        return []
+    return [field[1:] for field in fields if not field.startswith('$$')]
+
+
+def coverage(index_keys, segments):
+    """
+    Returns number of the suggested keys which the index starts with.
+    Equality and range fields may go in any order, sort keys may be reversed altogether.
+
+    >>> segments = [[('cashbox', 1)], [('amount', -1)], [('date', 1)]]
+    >>> coverage([('cashbox', 1), ('amount', 1), ('date', 1)], segments), coverage([('cashbox', 1)], segments)
+    (3, 1)
+    """
+    index_keys = list(index_keys)
+    position = matched = 0
+    reversed_sort = None
+    for i, segment in enumerate(segments):
+        if i == 1:
+            for field, direction in segment:
+                if position >= len(index_keys) or index_keys[position][0] != field:
+                    return matched
+                same = index_keys[position][1] == direction
+                if reversed_sort is None:
+                    reversed_sort = not same
+                elif reversed_sort == same:
+                    return matched
+                position += 1
+                matched += 1
+            continue
+        fields = {field for field, _ in segment}
+        while fields and position < len(index_keys) and index_keys[position][0] in fields:
+            fields.discard(index_keys[position][0])
+            position += 1
+            matched += 1
+        if fields:
+            return matched
+    return matched
+
+
+def suggest_indexes(pipeline, collection_name='', collection=None):
+    """
+    Returns dictionary of index suggestions for the pipeline:
+    'indexes' - list of {'collection', 'keys', 'reason', 'stage'} for the leading stages and $lookup stages,
+    'unindexable' - conditions which can't use indexes.
+    With pymongo collection the suggestions are compared with its index_information
+    and the foreign collections indexes: 'covered_by' is added to suggestions (name of the index starting
+    with all the keys or None), 'partially_covered_by' (index starting with the most of the keys or None)
+    and 'unused' lists indexes of the collection which are not used by the pipeline.
+
+    >>> suggest_indexes([{'$match': {'cashbox': 1, 'date': {'$gte': 0}}}, {'$sort': {'amount': -1}}], 'action')
+    {'indexes': [{'collection': 'action', 'keys': [('cashbox', 1), ('amount', -1), ('date', 1)], 'reason': \
+'equality: cashbox; sort: amount; range: date', 'stage': 0}], 'unindexable': []}
+    """
+    query, sort = leading_query(pipeline)
+    suggestions, unindexable = [], []
+    segments_list = []
+    for segments, reason, notes in query_suggestions(query, sort):
+        segments_list.append(segments)
+        suggestions.append({
+            'collection': collection_name, 'keys': [key for segment in segments for key in segment],
+            'reason': reason, 'stage': 0,
+        })
+        unindexable.extend(note for note in notes if note not in unindexable)
+    for stage, foreign_collection, field in lookup_foreign_fields(pipeline):
+        if field == '_id':
+            continue
+        segments_list.append([[(field, 1)], [], []])
+        suggestions.append({
+            'collection': foreign_collection, 'keys': [(field, 1)], 'reason': '$lookup foreign field', 'stage': stage,
+        })
+    result = {'indexes': suggestions, 'unindexable': unindexable}
+    if collection is None:
+        return result
+
+    indexes = {collection_name: collection.index_information()}
+    database = getattr(collection, 'database', None)
+    used = set()
+    for suggestion, segments in zip(suggestions, segments_list):
+        name = suggestion['collection']
+        if name not in indexes:
+            indexes[name] = database[name].index_information() if database is not None else {}
+        keys_number = len(suggestion['keys'])
+        coverages = {
+            index_name: coverage(index['key'], segments) for index_name, index in indexes[name].items()
+        }
+        suggestion['covered_by'] = next(
+            (index_name for index_name, matched in coverages.items() if matched == keys_number), None)
+        partial = max(coverages, key=coverages.get, default=None)
+        suggestion['partially_covered_by'] = (
+            partial if suggestion['covered_by'] is None and partial and coverages[partial] else None)
+        if name == collection_name:
+            used.update(index_name for index_name, matched in coverages.items() if matched)
+    result['unused'] = [name for name in indexes[collection_name] if name != '_id_' and name not in used]
+    return result
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Pipeline timing hooks: builder calls, aggregate latency and cursor iteration."""
+
+import hashlib
+import json
+import logging
+from functools import wraps
+from time import perf_counter
+
+from .cache import collection_name
+
+logger = logging.getLogger(__name__)
+
+# String values of these keys are names, not data, so they are part of the shape
+_NAME_KEYS = {'from', 'localField', 'foreignField', 'as', 'path', 'connectFromField', 'connectToField', 'into',
+              '$count', 'includeArrayIndex'}
+# Stages which numbers are part of the shape: sort direction, inclusion or exclusion
+_SPECIFICATION_STAGES = {'$sort', '$project'}
+
+
+def _shape(value, key=None, keep_numbers=False):
+    if isinstance(value, dict):
+        return {
+            item_key: _shape(item, item_key, keep_numbers or item_key in _SPECIFICATION_STAGES)
+            for item_key, item in value.items()
+        }
+    if isinstance(value, list):
+        shapes = [_shape(item, key) for item in value]
+        # Lists of literals differ only by values and length, e.g. $in values
+        return ['?'] if all(shape == '?' for shape in shapes) else shapes
+    if isinstance(value, str) and (value.startswith('$') or key in _NAME_KEYS):
+        return value
+    if keep_numbers and isinstance(value, (bool, int)):
+        return value
+    return '?'
+
+
+def shape_fingerprint(pipeline):
+    """
+    Returns stable fingerprint of the pipeline shape: stages, fields and operators without literal values.
+
+    >>> shape_fingerprint([{'$match': {'a': 1, 'b': {'$in': [1, 2]}}}]) == shape_fingerprint(
+    ...     [{'$match': {'a': 5, 'b': {'$in': [3]}}}])
+    True
+    >>> shape_fingerprint([{'$sort': {'a': 1}}]) == shape_fingerprint([{'$sort': {'a': -1}}])
+    False
+    """
+    shape = json.dumps([_shape(stage) for stage in pipeline], separators=(',', ':'), default=repr)
+    return hashlib.sha1(shape.encode('utf-8')).hexdigest()[:16]
+
+
+def collection_label(collection):
+    """Returns collection name for measurements."""
+    if not collection or isinstance(collection, list):
+        return ''
+    return collection_name(collection)
+
+
+class Instrumentation(object):
+    """
+    Measurements receiver of MongoAggregation. Hooks are called with measurement dictionaries:
+    builder calls {'event': 'build', 'method', 'duration_ms', 'fingerprint', 'collection'} and
+    executions {'event': 'aggregate', 'fingerprint', 'collection', 'latency_ms', 'first_batch_ms', 'documents',
+    'iteration_ms', 'total_ms', 'bytes'} reported when the cursor is exhausted or closed.
+    Cursors collected before that are not reported, only logged at debug level.
+    :param hooks: Callables receiving measurements
+    :param slow_ms: Executions longer than this are logged as warnings
+    :param explain_ms: Executions longer than this get explain output in 'explain' key
+    :param measure_bytes: Count bytes of decoded documents by encoding them to BSON (requires pymongo),
+        otherwise bytes are counted only for raw documents
+
+    >>> from mongo_aggregation import MongoAggregation
+    >>> from mongo_aggregation.engine import InMemoryEngine
+    >>> measurements = []
+    >>> engine = InMemoryEngine({'action': [{'_id': 1}, {'_id': 2}]})
+    >>> pipeline = MongoAggregation(collection=engine.action, instrumentation=Instrumentation([measurements.append]))
+    >>> pipeline.get_first()
+    {'_id': 1}
+    >>> cursor = pipeline.aggregate()
+    >>> next(cursor)
+    {'_id': 1}
+    >>> del cursor
+    >>> [measurement['documents'] for measurement in measurements]
+    [1]
+    """
+
+    def __init__(self, hooks=(), slow_ms=None, explain_ms=None, measure_bytes=False):
+        self.hooks = list(hooks)
+        self.slow_ms = slow_ms
+        self.explain_ms = explain_ms
+        self.measure_bytes = measure_bytes
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, measurement):
+        """Passes the measurement to the hooks. Hook errors are logged, so measurement never breaks the pipeline.
+
+        >>> def failing(measurement):
+        ...     raise RuntimeError('hook failed')
+        >>> measurements = []
+        >>> Instrumentation([failing, measurements.append]).emit({'event': 'build'})
+        >>> measurements
+        [{'event': 'build'}]
+        """
+        for hook in self.hooks:
+            try:
+                hook(measurement)
+            except Exception:
+                logger.exception(f'Instrumentation hook {hook!r} failed')
+
+
+def timed(method):
+    """Decorator of MongoAggregation builder methods reporting their duration. Nested calls are not reported."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = getattr(self, 'instrumentation', None)
+        if instrumentation is None or getattr(self, '_timing', False):
+            return method(self, *args, **kwargs)
+        self._timing = True
+        started = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = (perf_counter() - started) * 1000
+            self._timing = False
+            instrumentation.emit({
+                'event': 'build', 'method': method.__name__, 'duration_ms': duration,
+                'fingerprint': shape_fingerprint(self.pipeline), 'collection': collection_label(self.collection),
+            })
+    return wrapper
+
+
+class InstrumentedCursor(object):
+    """
+    Cursor wrapper measuring iteration. Calls on_finish with the measurement when the cursor is exhausted
+    or closed, its errors are logged and don't break the iteration. Other attributes are taken from the cursor.
+
+    >>> def on_finish(measurement):
+    ...     raise RuntimeError('explain failed')
+    >>> [document for document in InstrumentedCursor([{'_id': 1}], {}, 0, on_finish)]
+    [{'_id': 1}]
+    """
+
+    def __init__(self, cursor, measurement, started, on_finish, document_size=None):
+        self._cursor = iter(cursor)
+        self._source = cursor
+        self._started = started
+        self._on_finish = on_finish
+        self._document_size = document_size
+        self._finished = False
+        self.measurement = measurement
+        measurement.update({
+            'latency_ms': (perf_counter() - started) * 1000, 'first_batch_ms': None,
+            'documents': 0, 'iteration_ms': 0.0, 'bytes': 0,
+        })
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = perf_counter()
+        try:
+            document = next(self._cursor)
+        except StopIteration:
+            self._finish()
+            raise
+        finished = perf_counter()
+        measurement = self.measurement
+        measurement['iteration_ms'] += (finished - started) * 1000
+        if not measurement['documents']:
+            measurement['first_batch_ms'] = (finished - self._started) * 1000
+        measurement['documents'] += 1
+        raw = getattr(document, 'raw', None)
+        if raw is not None:
+            measurement['bytes'] += len(raw)
+        elif self._document_size is not None:
+            measurement['bytes'] += self._document_size(document)
+        return document
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self.measurement['total_ms'] = self.measurement['latency_ms'] + self.measurement['iteration_ms']
+        try:
+            self._on_finish(self.measurement)
+        except Exception:
+            # Exception raised while the cursor is exhausted would replace StopIteration
+            logger.exception(f'Reporting of pipeline {self.measurement.get("fingerprint")} failed')
+
+    def close(self):
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            close()
+        self._finish()
+
+    def __del__(self):
+        # Hooks and explain may run arbitrary code and I/O, which must not happen in a finalizer
+        if not getattr(self, '_finished', True):
+            logger.debug(f'Cursor of pipeline {self.measurement.get("fingerprint")} is collected before exhausted')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._source, name)
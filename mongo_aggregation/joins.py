@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Client-side joins: foreign documents are fetched by batches with a single $in query and a reference cache."""
+
+import asyncio
+import inspect
+from itertools import islice
+
+from .cache import MemoryCache, pipeline_key
+from .keyset import get_path
+
+_MISSING = object()
+
+
+def _values(value):
+    """Returns values matched by the local field value: array elements are matched separately."""
+    if value is None or value is _MISSING:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _key(value):
+    """Returns hashable key of the value."""
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _set_path(document, path, value):
+    """Sets the value, embedded documents on the path are copied as they may be shared by unwound documents."""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        embedded = document.get(part)
+        document[part] = dict(embedded) if isinstance(embedded, dict) else {}
+        document = document[part]
+    document[parts[-1]] = value
+
+
+def _remove_path(document, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def _reference_key(collection, foreign_field, value, projection):
+    pipeline = [{'$match': {foreign_field: value}}]
+    if projection:
+        pipeline.append({'$project': projection})
+    return pipeline_key(collection, pipeline)
+
+
+def _cached_references(collection, foreign_field, values, projection, cache):
+    """Returns tuple (references found in the cache, {value key: value} of the values to fetch)."""
+    references, missing = {}, {}
+    for value in values:
+        key = _key(value)
+        if key in references or key in missing:
+            continue
+        if cache is not None:
+            found, documents = cache.get(_reference_key(collection, foreign_field, value, projection))
+            if found:
+                references[key] = documents
+                continue
+        missing[key] = value
+    return references, missing
+
+
+def _fetched_references(collection, foreign_field, missing, projection, cache, documents):
+    """Returns dictionary {value key: list of foreign documents} of the fetched documents and caches it."""
+    fetched = {key: [] for key in missing}
+    for document in documents:
+        foreign_value = get_path(document, foreign_field, _MISSING)
+        # Array of the foreign document matches by each element
+        for key in dict.fromkeys(_key(value) for value in [foreign_value] + _values(foreign_value)):
+            if key in fetched:
+                fetched[key].append(document)
+    if cache is not None:
+        for key, documents in fetched.items():
+            cache.set(_reference_key(collection, foreign_field, missing[key], projection), documents, collection)
+    return fetched
+
+
+def fetch_references(collection, foreign_field, values, fields=None, cache=None):
+    """
+    Returns dictionary {value key: list of foreign documents} for the values.
+    Values missing in the cache are fetched by a single find with $in, found lists (empty too) are cached.
+
+    >>> from mongo_aggregation.engine import InMemoryCollection
+    >>> currencies = InMemoryCollection([{'_id': 1, 'code': 'USD'}, {'_id': 2, 'code': 'EUR'}], 'currency')
+    >>> fetch_references(currencies, '_id', [1, 3], fields=['code'])
+    {1: [{'_id': 1, 'code': 'USD'}], 3: []}
+    """
+    projection = {field: 1 for field in fields} if fields else None
+    references, missing = _cached_references(collection, foreign_field, values, projection, cache)
+    if not missing:
+        return references
+    documents = collection.find({foreign_field: {'$in': list(missing.values())}}, projection)
+    references.update(_fetched_references(collection, foreign_field, missing, projection, cache, documents))
+    return references
+
+
+async def fetch_references_async(collection, foreign_field, values, fields=None, cache=None):
+    """
+    Asynchronous version of fetch_references. Cursor of asyncio drivers (Motor, PyMongo async API)
+    is read with async for, synchronous collection is read in a thread not to block the event loop.
+    """
+    projection = {field: 1 for field in fields} if fields else None
+    references, missing = _cached_references(collection, foreign_field, values, projection, cache)
+    if not missing:
+        return references
+    cursor = collection.find({foreign_field: {'$in': list(missing.values())}}, projection)
+    if inspect.isawaitable(cursor):
+        cursor = await cursor
+    if hasattr(cursor, '__aiter__'):
+        documents = [document async for document in cursor]
+    else:
+        documents = await asyncio.get_running_loop().run_in_executor(None, list, cursor)
+    references.update(_fetched_references(collection, foreign_field, missing, projection, cache, documents))
+    return references
+
+
+def _local_values(batch, local_field):
+    return [value for document in batch for value in _values(get_path(document, local_field, _MISSING))]
+
+
+def _join_batch(batch, references, local_field, as_field, unwind):
+    """Yields the documents of the batch with the foreign documents joined."""
+    for document in batch:
+        joined, joined_ids = [], set()
+        for key in dict.fromkeys(map(_key, _values(get_path(document, local_field, _MISSING)))):
+            for foreign in references[key]:
+                # Array of local values may match the same foreign document several times
+                foreign_id = _key(foreign.get('_id', id(foreign)))
+                if foreign_id not in joined_ids:
+                    joined_ids.add(foreign_id)
+                    joined.append(foreign)
+        if not unwind:
+            _set_path(document, as_field, joined)
+            yield document
+        elif not joined:
+            _remove_path(document, as_field)
+            yield document
+        else:
+            for foreign in joined:
+                unwound = dict(document)
+                _set_path(unwound, as_field, foreign)
+                yield unwound
+
+
+def _reference_cache(cache):
+    if cache is None:
+        return MemoryCache()
+    return None if cache is False else cache
+
+
+def batched_lookup(documents, collection, local_field, foreign_field='_id', as_field='', unwind=False, fields=None,
+                   batch_size=1000, cache=None):
+    """
+    Joins foreign documents on the client: local field values of each batch of documents are fetched by a single
+    query and merged as the list in as_field like $lookup. Documents share the fetched foreign documents.
+    Unlike $lookup missing and null local values match nothing.
+    :param documents: Iterable of documents, e.g. a cursor. Documents are changed in place
+    :param collection: Foreign collection (pymongo collection or anything with find method)
+    :param unwind: Put a foreign document instead of the list like $unwind with preserveNullAndEmptyArrays:
+        documents without matches lose as_field, several matches produce several documents
+    :param fields: Fields of foreign documents to fetch, all by default
+    :param batch_size: Number of documents joined by one query
+    :param cache: Cache backend of foreign documents (see cache module) kept between batches and calls,
+        by default MemoryCache (1024 values) of this call only. False disables caching
+
+    >>> from mongo_aggregation.engine import InMemoryCollection
+    >>> cashboxes = InMemoryCollection([{'_id': 1, 'name': 'Main'}], 'cashbox')
+    >>> list(batched_lookup([{'cashbox': 1}, {'cashbox': 2}], cashboxes, 'cashbox', unwind=True))
+    [{'cashbox': {'_id': 1, 'name': 'Main'}}, {}]
+    """
+    as_field = as_field or local_field
+    cache = _reference_cache(cache)
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return
+        references = fetch_references(collection, foreign_field, _local_values(batch, local_field), fields, cache)
+        yield from _join_batch(batch, references, local_field, as_field, unwind)
+
+
+async def batched_lookup_async(documents, collection, local_field, foreign_field='_id', as_field='', unwind=False,
+                               fields=None, batch_size=1000, cache=None):
+    """
+    Asynchronous version of batched_lookup for async iterable of documents, e.g. a cursor of asyncio driver.
+    The foreign collection is queried by fetch_references_async.
+
+    >>> import asyncio
+    >>> from mongo_aggregation.engine import InMemoryCollection
+    >>> class AsyncCursor(object):
+    ...     def __init__(self, documents):
+    ...         self.documents = iter(documents)
+    ...     def __aiter__(self):
+    ...         return self
+    ...     async def __anext__(self):
+    ...         for document in self.documents:
+    ...             return document
+    ...         raise StopAsyncIteration
+    >>> class AsyncCollection(InMemoryCollection):
+    ...     def find(self, *args, **kwargs):
+    ...         return AsyncCursor(super().find(*args, **kwargs))
+    >>> cashboxes = AsyncCollection([{'_id': 1, 'name': 'Main'}], 'cashbox')
+    >>> async def run(collection):
+    ...     joined = batched_lookup_async(AsyncCursor([{'cashbox': 1}, {'cashbox': 2}]), collection, 'cashbox')
+    ...     return [document async for document in joined]
+    >>> asyncio.run(run(cashboxes))
+    [{'cashbox': [{'_id': 1, 'name': 'Main'}]}, {'cashbox': []}]
+    >>> asyncio.run(run(InMemoryCollection(cashboxes.documents)))
+    [{'cashbox': [{'_id': 1, 'name': 'Main'}]}, {'cashbox': []}]
+    """
+    as_field = as_field or local_field
+    cache = _reference_cache(cache)
+    batch = []
+    async for document in documents:
+        batch.append(document)
+        if len(batch) < batch_size:
+            continue
+        references = await fetch_references_async(
+            collection, foreign_field, _local_values(batch, local_field), fields, cache)
+        for joined in _join_batch(batch, references, local_field, as_field, unwind):
+            yield joined
+        batch = []
+    if batch:
+        references = await fetch_references_async(
+            collection, foreign_field, _local_values(batch, local_field), fields, cache)
+        for joined in _join_batch(batch, references, local_field, as_field, unwind):
+            yield joined
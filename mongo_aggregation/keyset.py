@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Keyset (seek) pagination helpers."""
+
+import base64
+
+
+def get_path(document, path, default=None):
+    """
+    Returns value of the dotted path in the document.
+
+    >>> get_path({'a': {'b': 1}}, 'a.b'), get_path({'a': 1}, 'a.b')
+    (1, None)
+    """
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+
+def _after(key, direction, value):
+    """Returns condition of the key values placed after the value or None if there are no such values.
+    Null and missing values are sorted first, so they are after any value in descending order."""
+    if value is None:
+        return {key: {'$ne': None}} if direction == 1 else None
+    if direction == 1:
+        return {key: {'$gt': value}}
+    return {key: {'$not': {'$gte': value}}}
+
+
+def seek_condition(keys, values):
+    """
+    Returns $match query selecting documents placed after the values in the order of sort keys.
+    Null values are handled by BSON order: they are sorted before values of other types.
+
+    >>> seek_condition({'date': -1, '_id': 1}, ['2021-01-01', 5])
+    {'$or': [{'date': {'$not': {'$gte': '2021-01-01'}}}, {'date': '2021-01-01', '_id': {'$gt': 5}}]}
+    >>> seek_condition({'date': 1, '_id': 1}, [None, 5])
+    {'$or': [{'date': {'$ne': None}}, {'date': None, '_id': {'$gt': 5}}]}
+    >>> seek_condition({'date': -1, '_id': 1}, [None, 5])
+    {'date': None, '_id': {'$gt': 5}}
+    """
+    conditions = []
+    for i, (key, direction) in enumerate(keys.items()):
+        after = _after(key, direction, values[i])
+        if after is None:
+            continue
+        condition = dict(zip(list(keys)[:i], values[:i]))
+        condition.update(after)
+        conditions.append(condition)
+    if not conditions:
+        # Nothing is placed after the values
+        return {'_id': {'$exists': False}}
+    return {'$or': conditions} if len(conditions) > 1 else conditions[0]
+
+
+def encode_token(keys, values):
+    """Returns opaque continuation token keeping sort keys and values of the last document (requires pymongo)."""
+    from bson import json_util
+    data = json_util.dumps({'k': list(keys), 'v': values}, json_options=json_util.CANONICAL_JSON_OPTIONS)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_token(token, keys):
+    """Returns sort values saved to the token. Raises ValueError if the token is malformed
+    or was made for other sort keys."""
+    from bson import json_util
+    try:
+        data = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        token_keys, values = data['k'], data['v']
+    except (ValueError, TypeError, KeyError) as error:
+        raise ValueError(f'Malformed continuation token: {error}')
+    if token_keys != list(keys) or len(values) != len(keys):
+        raise ValueError('Continuation token was made for another sort.')
+    return values
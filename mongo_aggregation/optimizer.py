@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Rule-based rewrite pass over aggregation pipelines built by MongoAggregation."""
+
+from copy import copy
+
+
+def _overlaps(one, another):
+    """Checks if two field paths refer to the same data (equal, parent or child).
+
+    >>> _overlaps('a', 'a.b'), _overlaps('a.b', 'a'), _overlaps('a', 'ab')
+    (True, True, False)
+    """
+    return one == another or one.startswith(f'{another}.') or another.startswith(f'{one}.')
+
+
+def _is_inclusion(value):
+    return not isinstance(value, (dict, list, str)) and value in (1, True)
+
+
+def _is_exclusion(value):
+    return not isinstance(value, (dict, list, str)) and value in (0, False)
+
+
+def _expression_fields(expression):
+    """Returns field paths referenced by an aggregation expression or None if it refers to the whole document.
+
+    >>> sorted(_expression_fields({'$cond': ['$a.b', '$c', '$$value']}))
+    ['a.b', 'c']
+    >>> _expression_fields({'$mergeObjects': ['$$ROOT', {'x': 1}]}) is None
+    True
+    """
+    fields = set()
+    if isinstance(expression, str):
+        if expression.startswith('$$'):
+            variable, _, path = expression[2:].partition('.')
+            if variable in ('ROOT', 'CURRENT'):
+                if not path:
+                    return None
+                fields.add(path)
+        elif expression.startswith('$'):
+            fields.add(expression[1:])
+    elif isinstance(expression, dict):
+        for key, value in expression.items():
+            if key == '$literal':
+                continue
+            value_fields = _expression_fields(value)
+            if value_fields is None:
+                return None
+            fields |= value_fields
+    elif isinstance(expression, (list, tuple)):
+        for value in expression:
+            value_fields = _expression_fields(value)
+            if value_fields is None:
+                return None
+            fields |= value_fields
+    return fields
+
+
+def _match_fields(query):
+    """Returns field paths filtered by a $match query or None if they can't be determined.
+
+    >>> sorted(_match_fields({'a': 1, '$or': [{'b.c': 2}, {'d': {'$gt': 3}}]}))
+    ['a', 'b.c', 'd']
+    >>> _match_fields({'$where': 'this.a > 1'}) is None
+    True
+    """
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for condition in value:
+                condition_fields = _match_fields(condition)
+                if condition_fields is None:
+                    return None
+                fields |= condition_fields
+        elif key == '$expr':
+            expression_fields = _expression_fields(value)
+            if expression_fields is None:
+                return None
+            fields |= expression_fields
+        elif key.startswith('$'):
+            # $where, $text and others can't be analysed
+            return None
+        else:
+            fields.add(key)
+    return fields
+
+
+def _stage_name(stage):
+    return next(iter(stage)) if isinstance(stage, dict) and len(stage) == 1 else None
+
+
+def _project_passes_field(projection, field):
+    """Checks if the field reaches the $project output unchanged."""
+    if field == '_id' or field.startswith('_id.'):
+        # _id is included by default
+        return all(_is_inclusion(value) for key, value in projection.items() if _overlaps(key, field))
+    fields = {key: value for key, value in projection.items() if key != '_id'}
+    if all(_is_exclusion(value) for value in fields.values()):
+        return not any(_overlaps(key, field) for key in fields)
+    overlapping = {key: value for key, value in fields.items() if _overlaps(key, field)}
+    return bool(overlapping) and all(
+        _is_inclusion(value) and (key == field or field.startswith(f'{key}.'))
+        for key, value in overlapping.items()
+    )
+
+
+def can_hoist_match(stage, fields):
+    """Checks if a $match on the fields may be moved above the stage."""
+    name = _stage_name(stage)
+    statement = stage.get(name) if name else None
+    if name in ('$addFields', '$set'):
+        return not any(_overlaps(key, field) for key in statement for field in fields)
+    if name == '$lookup':
+        return not any(_overlaps(statement['as'], field) for field in fields)
+    if name == '$project':
+        return all(_project_passes_field(statement, field) for field in fields)
+    return False
+
+
+def merge_queries(first, second):
+    """Combines two $match queries into one.
+
+    >>> merge_queries({'a': 1}, {'b': 2})
+    {'a': 1, 'b': 2}
+    >>> merge_queries({'a': 1}, {'a': {'$gt': 0}})
+    {'$and': [{'a': 1}, {'a': {'$gt': 0}}]}
+    """
+    if first.keys() & second.keys():
+        return {'$and': [dict(first), dict(second)]}
+    merged = dict(first)
+    merged.update(second)
+    return merged
+
+
+def _project_overrides(first, second):
+    """Checks if the second $project makes the first one redundant."""
+    if not second.keys() - {'_id'}:
+        return False
+    if not all(_is_inclusion(value) or key == '_id' and _is_exclusion(value) for key, value in second.items()):
+        return False
+    first_is_exclusion = all(_is_exclusion(value) for key, value in first.items() if key != '_id')
+    for field, value in second.items():
+        if field == '_id':
+            continue
+        if first_is_exclusion:
+            if any(_overlaps(key, field) for key in first if key != '_id'):
+                return False
+        elif not any(_is_inclusion(first_value) and (key == field or field.startswith(f'{key}.'))
+                     for key, first_value in first.items()):
+            return False
+    if not _is_exclusion(second.get('_id', 1)):
+        first_id = first.get('_id', 1)
+        if not _is_inclusion(first_id):
+            return False
+    return True
+
+
+def hoist_match(pipeline, report):
+    """Moves $match stages above $project/$addFields/$set/$lookup that don't compute filtered fields."""
+    pipeline = list(pipeline)
+    # Stages are only moved upwards, so the stage at each index is visited once
+    for index, stage in enumerate(pipeline):
+        if _stage_name(stage) != '$match':
+            continue
+        fields = _match_fields(stage['$match'])
+        if fields is None:
+            continue
+        position = index
+        while position > 0 and can_hoist_match(pipeline[position - 1], fields):
+            position -= 1
+        if position == index:
+            continue
+        pipeline.insert(position, pipeline.pop(index))
+        report.append({
+            'rule': 'hoist_match',
+            'stage': index,
+            'description': f'$match moved from position {index} to {position}',
+        })
+    return pipeline
+
+
+def merge_matches(pipeline, report):
+    """Merges adjacent $match stages into one."""
+    result = []
+    for stage in pipeline:
+        if result and _stage_name(stage) == '$match' and _stage_name(result[-1]) == '$match':
+            result[-1] = {'$match': merge_queries(result[-1]['$match'], stage['$match'])}
+            report.append({
+                'rule': 'merge_matches',
+                'stage': len(result) - 1,
+                'description': f'$match at position {len(result)} merged into previous $match',
+            })
+            continue
+        result.append(stage)
+    return result
+
+
+def drop_overridden_projects(pipeline, report):
+    """Drops $project stages which are fully overridden by the following $project."""
+    result = []
+    for stage in pipeline:
+        while (result and _stage_name(stage) == '$project' and _stage_name(result[-1]) == '$project'
+               and _project_overrides(result[-1]['$project'], stage['$project'])):
+            result.pop()
+            report.append({
+                'rule': 'drop_overridden_projects',
+                'stage': len(result),
+                'description': f'$project at position {len(result)} is overridden by the next $project',
+            })
+        result.append(stage)
+    return result
+
+
+def fold_sort_skip_limit(pipeline, report):
+    """Rewrites $sort, $skip, $limit into $sort, $limit, $skip so the server can use a top-k sort."""
+    result = list(pipeline)
+    for i in range(len(result) - 2):
+        sort, skip, limit = result[i:i + 3]
+        if (_stage_name(sort), _stage_name(skip), _stage_name(limit)) != ('$sort', '$skip', '$limit'):
+            continue
+        result[i + 1] = {'$limit': skip['$skip'] + limit['$limit']}
+        result[i + 2] = copy(skip)
+        report.append({
+            'rule': 'fold_sort_skip_limit',
+            'stage': i,
+            'description': f'$skip and $limit after $sort at position {i} swapped into top-k form',
+        })
+    return result
+
+
+def _flatten_projection(projection, prefix=''):
+    """Yields tuples (field path, value) of the specification, nested specifications are flattened."""
+    for key, value in projection.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict) and value and not any(item.startswith('$') for item in value):
+            yield from _flatten_projection(value, f'{path}.')
+        else:
+            yield path, value
+
+
+def _is_live(field, fields):
+    """Checks if the field is read by the following stages (fields None means the whole document)."""
+    return fields is None or any(_overlaps(field, live_field) for live_field in fields)
+
+
+def _without(fields, removed):
+    """Returns the fields without the removed fields and their children."""
+    return {field for field in fields if not any(field == key or field.startswith(f'{key}.') for key in removed)}
+
+
+def _union_expressions(fields, expressions):
+    """Returns the fields with the fields of the expressions or None if an expression reads the whole document."""
+    for expression in expressions:
+        expression_fields = _expression_fields(expression)
+        if expression_fields is None:
+            return None
+        fields |= expression_fields
+    return fields
+
+
+def stage_required_fields(stage, fields):
+    """
+    Returns input fields of the stage which are needed to produce the fields read by the following stages.
+    None means the whole document: as fields argument it means the following stages need the whole documents,
+    as result - the stage needs them or can't be analysed.
+
+    >>> sorted(stage_required_fields({'$addFields': {'total': {'$add': ['$a', '$b']}, 'c': '$d'}}, {'total', 'e'}))
+    ['a', 'b', 'e']
+    """
+    name = _stage_name(stage)
+    statement = stage[name] if name else None
+    if name == '$project':
+        items = list(_flatten_projection(statement))
+        if all(_is_exclusion(value) for _, value in items):
+            # Exclusion passes the rest of the document
+            return None if fields is None else _without(fields, [key for key, _ in items])
+        required = set()
+        if '_id' not in statement and _is_live('_id', fields):
+            required.add('_id')
+        for key, value in items:
+            if _is_exclusion(value) or not _is_live(key, fields):
+                continue
+            if _is_inclusion(value):
+                required.add(key)
+            elif _union_expressions(required, [value]) is None:
+                return None
+        return required
+    if name == '$group':
+        expressions = [statement['_id']] + [
+            value for key, value in statement.items() if key != '_id' and _is_live(key, fields)]
+        return _union_expressions(set(), expressions)
+    if name == '$count':
+        return set()
+    if name in ('$replaceRoot', '$replaceWith'):
+        return _union_expressions(set(), [statement['newRoot'] if name == '$replaceRoot' else statement])
+    if name in ('$skip', '$limit', '$sample'):
+        return fields
+    if fields is None:
+        return None
+    if name == '$match':
+        match_fields = _match_fields(statement)
+        return None if match_fields is None else fields | match_fields
+    if name == '$sort':
+        return fields | set(statement)
+    if name in ('$addFields', '$set'):
+        items = list(_flatten_projection(statement))
+        live = [value for key, value in items if _is_live(key, fields)]
+        return _union_expressions(_without(fields, [key for key, _ in items]), live)
+    if name == '$unset':
+        return _without(fields, [statement] if isinstance(statement, str) else statement)
+    if name == '$unwind':
+        statement = statement if isinstance(statement, dict) else {'path': statement}
+        path = statement['path'][1:]
+        fields = _without(fields, [statement['includeArrayIndex']]) if 'includeArrayIndex' in statement else fields
+        # Array itself is needed when its fields are not read
+        if not any(field.startswith(f'{path}.') for field in fields):
+            fields.add(path)
+        return fields
+    if name == '$lookup':
+        fields = _without(fields, [statement['as']])
+        if 'localField' in statement:
+            fields.add(statement['localField'])
+        return _union_expressions(fields, statement.get('let', {}).values())
+    return None
+
+
+def required_fields(pipeline):
+    """
+    Returns field paths of the input documents which the stages read or pass to the output.
+    None means the whole documents are needed: the output isn't narrowed by $project, $group and alike
+    or a stage can't be analysed.
+
+    >>> sorted(required_fields([
+    ...     {'$unwind': '$items'}, {'$group': {'_id': '$client.name', 'sum': {'$sum': '$items.amount'}}}]))
+    ['client.name', 'items.amount']
+    >>> required_fields([{'$match': {'a': 1}}]) is None
+    True
+    """
+    fields = None
+    for stage in reversed(pipeline):
+        fields = stage_required_fields(stage, None if fields is None else set(fields))
+    return fields
+
+
+def lookup_projection(pipeline, index):
+    """
+    Returns inclusion projection of the foreign documents fields which are read by the stages
+    following the $lookup at the index or None if the whole foreign documents are needed.
+
+    >>> lookup_projection([
+    ...     {'$lookup': {'from': 'product', 'localField': 'product', 'foreignField': '_id', 'as': 'product'}},
+    ...     {'$unwind': '$product'}, {'$project': {'name': '$product.name', 'price': '$product.price.value'}},
+    ... ], 0)
+    {'name': 1, 'price.value': 1}
+    """
+    as_field = pipeline[index]['$lookup']['as']
+    fields = required_fields(pipeline[index + 1:])
+    if fields is None or any(field == as_field or as_field.startswith(f'{field}.') for field in fields):
+        return None
+    paths = sorted(field[len(as_field) + 1:] for field in fields if field.startswith(f'{as_field}.'))
+    paths = [path for path in paths if not any(path.startswith(f'{parent}.') for parent in paths)]
+    # Number of joined documents still matters, so the result is never empty
+    return {path: 1 for path in paths} or {'_id': 1}
+
+
+def narrow_lookups(pipeline, report, names=None):
+    """
+    Adds $project of the fields read by the following stages to $lookup stages with localField and foreignField.
+    The result is the concise $lookup form (localField and foreignField with pipeline) which requires MongoDB 5.0,
+    so the rule is not in DEFAULT_RULES.
+    :param names: 'as' fields of the $lookup stages to narrow, all by default
+    """
+    pipeline = list(pipeline)
+    for index, stage in enumerate(pipeline):
+        if _stage_name(stage) != '$lookup':
+            continue
+        lookup = stage['$lookup']
+        if 'localField' not in lookup or 'pipeline' in lookup or names is not None and lookup['as'] not in names:
+            continue
+        projection = lookup_projection(pipeline, index)
+        if projection is None:
+            continue
+        pipeline[index] = {'$lookup': dict(lookup, pipeline=[{'$project': projection}])}
+        report.append({
+            'rule': 'narrow_lookups',
+            'stage': index,
+            'description': f'$lookup at position {index} fetches only {", ".join(projection)}',
+        })
+    return pipeline
+
+
+# Stages which copy documents or their parts, the narrower documents are the cheaper they are
+_WIDE_STAGES = ('$unwind', '$lookup', '$group', '$graphLookup', '$facet', '$bucket', '$bucketAuto')
+
+
+def _roots(fields):
+    """Returns the fields without the children of other fields."""
+    return [field for field in sorted(fields) if not any(field.startswith(f'{parent}.') for parent in fields)]
+
+
+def push_down_projection(pipeline, report):
+    """
+    Inserts $project of the fields read by the following stages after the leading $match and $sort stages
+    if $unwind, $lookup, $group or alike follow, so they copy narrow documents.
+    Paths of $unwind stages are kept whole as the number of the unwound documents depends on them.
+
+    >>> push_down_projection([
+    ...     {'$match': {'a': 1}}, {'$unwind': '$items'}, {'$group': {'_id': '$b', 'sum': {'$sum': '$items.amount'}}},
+    ... ], [])[1]
+    {'$project': {'_id': 0, 'b': 1, 'items': 1}}
+    """
+    position = 0
+    while position < len(pipeline) and _stage_name(pipeline[position]) in ('$match', '$sort'):
+        position += 1
+    if position == len(pipeline) or _stage_name(pipeline[position]) == '$project':
+        return pipeline
+    if not any(_stage_name(stage) in _WIDE_STAGES for stage in pipeline[position:]):
+        return pipeline
+    fields = required_fields(pipeline[position:])
+    if fields is None:
+        return pipeline
+    for stage in pipeline[position:]:
+        if _stage_name(stage) == '$unwind':
+            path = stage['$unwind']['path'] if isinstance(stage['$unwind'], dict) else stage['$unwind']
+            fields.add(path[1:])
+    roots = _roots(fields)
+    projection = {} if '_id' in roots or not roots else {'_id': 0}
+    projection.update((field, 1) for field in roots or ['_id'])
+    report.append({
+        'rule': 'push_down_projection',
+        'stage': position,
+        'description': f'$project of {", ".join(roots) or "_id"} inserted at position {position}',
+    })
+    return list(pipeline[:position]) + [{'$project': projection}] + list(pipeline[position:])
+
+
+def drop_dead_fields(pipeline, report):
+    """
+    Removes fields of $addFields and $set stages which the following stages don't read,
+    the stages without fields are dropped.
+
+    >>> drop_dead_fields([{'$addFields': {'a': '$x', 'b': '$y'}}, {'$group': {'_id': '$a'}}], [])
+    [{'$addFields': {'a': '$x'}}, {'$group': {'_id': '$a'}}]
+    """
+    result = list(pipeline)
+    # From the end, so removed fields make the earlier stages dead too
+    for index in range(len(result) - 1, -1, -1):
+        stage = result[index]
+        name = _stage_name(stage)
+        if name not in ('$addFields', '$set'):
+            continue
+        fields = required_fields(result[index + 1:])
+        if fields is None:
+            continue
+        statement = {
+            key: value for key, value in stage[name].items()
+            if any(_is_live(path, fields) for path, _ in _flatten_projection({key: value}))
+        }
+        if len(statement) == len(stage[name]):
+            continue
+        dead = ', '.join(key for key in stage[name] if key not in statement)
+        if statement:
+            result[index] = {name: statement}
+        else:
+            del result[index]
+            dead += ' (stage dropped)'
+        report.append({
+            'rule': 'drop_dead_fields',
+            'stage': index,
+            'description': f'{dead} of {name} at position {index} are not read',
+        })
+    return result
+
+
+# Stages which never change the number of documents
+COUNT_PRESERVING_STAGES = ('$sort', '$project', '$addFields', '$set', '$lookup')
+# Stages which keep both the number and the order of documents
+LIMIT_PUSHDOWN_STAGES = ('$project', '$addFields', '$set', '$lookup')
+
+
+def _is_unique_lookup_unwind(lookup, unwind, unique_lookups=()):
+    """Checks if $unwind of the $lookup result keeps the number of documents:
+    the lookup is made by the unique _id, the documents without the match are preserved
+    and the local field is known to be a single value (as field is in unique_lookups).
+    Array local field matches a foreign document by each element, so $unwind multiplies the documents."""
+    if _stage_name(lookup) != '$lookup' or _stage_name(unwind) != '$unwind':
+        return False
+    lookup, unwind = lookup['$lookup'], unwind['$unwind']
+    if lookup.get('as') not in unique_lookups:
+        return False
+    if not isinstance(unwind, dict) or not unwind.get('preserveNullAndEmptyArrays'):
+        return False
+    # Projection of the foreign documents keeps their number
+    projections = all(_stage_name(stage) == '$project' for stage in lookup.get('pipeline', ()))
+    return lookup.get('foreignField') == '_id' and projections and unwind['path'] == f'${lookup["as"]}'
+
+
+def count_pipeline(pipeline, unique_lookups=()):
+    """
+    Returns the pipeline without trailing stages which don't change the number of documents:
+    $sort, $project, $addFields, $set, $lookup and $lookup by _id followed by preserving $unwind
+    if its as field is in unique_lookups (the local field is not an array).
+
+    >>> pipeline = [
+    ...     {'$match': {'a': 1}},
+    ...     {'$lookup': {'from': 'b', 'localField': 'b', 'foreignField': '_id', 'as': 'b'}},
+    ...     {'$unwind': {'path': '$b', 'preserveNullAndEmptyArrays': True}},
+    ...     {'$sort': {'a': 1}},
+    ... ]
+    >>> count_pipeline(pipeline, unique_lookups={'b'})
+    [{'$match': {'a': 1}}]
+    >>> len(count_pipeline(pipeline))
+    3
+    """
+    end = len(pipeline)
+    while end:
+        if _stage_name(pipeline[end - 1]) in COUNT_PRESERVING_STAGES:
+            end -= 1
+        elif end > 1 and _is_unique_lookup_unwind(pipeline[end - 2], pipeline[end - 1], unique_lookups):
+            end -= 2
+        else:
+            break
+    return list(pipeline[:end])
+
+
+def limit_position(pipeline, end, unique_lookups=()):
+    """Returns the earliest position the $limit placed at end may be moved to."""
+    while end:
+        if _stage_name(pipeline[end - 1]) in LIMIT_PUSHDOWN_STAGES:
+            end -= 1
+        elif end > 1 and _is_unique_lookup_unwind(pipeline[end - 2], pipeline[end - 1], unique_lookups):
+            end -= 2
+        else:
+            break
+    return end
+
+
+def push_down_limit(pipeline, limit, skip=0, unique_lookups=()):
+    """
+    Returns the pipeline limited to the number of documents, optionally skipping some documents first.
+    $skip and $limit are placed above trailing stages which keep both the number and the order of documents,
+    so they are run for the limited documents only. $lookup with $unwind is passed if it's in unique_lookups.
+
+    >>> push_down_limit([
+    ...     {'$match': {'a': 1}},
+    ...     {'$lookup': {'from': 'b', 'localField': 'b', 'foreignField': '_id', 'as': 'b'}},
+    ...     {'$unwind': {'path': '$b', 'preserveNullAndEmptyArrays': True}},
+    ...     {'$set': {'c': '$b.c'}},
+    ... ], 1, unique_lookups={'b'})[:2]
+    [{'$match': {'a': 1}}, {'$limit': 1}]
+    """
+    position = limit_position(pipeline, len(pipeline), unique_lookups)
+    stages = [{'$skip': skip}, {'$limit': limit}] if skip else [{'$limit': limit}]
+    return list(pipeline[:position]) + stages + list(pipeline[position:])
+
+
+def push_down_limits(pipeline, report):
+    """Moves $limit stages above stages which keep both the number and the order of documents."""
+    pipeline = list(pipeline)
+    for index, stage in enumerate(pipeline):
+        if _stage_name(stage) != '$limit':
+            continue
+        position = limit_position(pipeline, index)
+        if position == index:
+            continue
+        pipeline.insert(position, pipeline.pop(index))
+        report.append({
+            'rule': 'push_down_limits',
+            'stage': index,
+            'description': f'$limit moved from position {index} to {position}',
+        })
+    return pipeline
+
+
+DEFAULT_RULES = (
+    hoist_match, merge_matches, drop_overridden_projects, fold_sort_skip_limit, push_down_limits, drop_dead_fields,
+    push_down_projection,
+)
+
+
+def optimize_pipeline(pipeline, rules=DEFAULT_RULES):
+    """
+    Rewrites the pipeline with the rules until nothing changes.
+    Source pipeline and its stages are not modified.
+    Pipelines with encoded stages (RawBSONDocument, see templates) are returned as is.
+    :param pipeline: List of stages
+    :param rules: Rewrite functions, each one takes pipeline and report and returns new pipeline
+    :return: Tuple of optimized pipeline and a report - list of applied rewrites
+
+    >>> pipeline = [
+    ...     {'$project': {'a': 1, 'b': 1}}, {'$match': {'a': 1}}, {'$match': {'b': 2}}, {'$project': {'a': 1}},
+    ... ]
+    >>> optimized, report = optimize_pipeline(pipeline)
+    >>> optimized
+    [{'$match': {'a': 1, 'b': 2}}, {'$project': {'a': 1}}]
+    >>> [rewrite['rule'] for rewrite in report]
+    ['hoist_match', 'hoist_match', 'merge_matches', 'drop_overridden_projects']
+    """
+    report = []
+    pipeline = list(pipeline)
+    encoded = [i for i, stage in enumerate(pipeline) if not isinstance(stage, dict)]
+    if encoded:
+        report.append({
+            'rule': 'skip_encoded',
+            'stage': encoded[0],
+            'description': f'stage at position {encoded[0]} is encoded, the pipeline is not optimized',
+        })
+        return pipeline, report
+    while True:
+        applied = len(report)
+        for rule in rules:
+            pipeline = rule(pipeline, report)
+        if len(report) == applied:
+            return pipeline, report
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Splitting of a pipeline into disjoint partitions and merging of their $group results."""
+
+from datetime import datetime
+
+from .engine import _sort_key
+
+MERGEABLE_OPERATORS = ('$sum', '$min', '$max', '$first', '$last', '$push', '$addToSet', '$avg')
+# Stages whose result depends on the whole set of documents, so it can't be computed by parts
+NOT_PARTITIONABLE_STAGES = (
+    '$group', '$count', '$limit', '$skip', '$sort', '$sample', '$facet', '$bucket', '$bucketAuto', '$sortByCount',
+    '$out', '$merge', '$setWindowFields', '$densify', '$fill',
+)
+AVG_COUNT_SUFFIX = '__avg_count'
+
+
+def _range_type(value):
+    if hasattr(value, 'generation_time') and hasattr(type(value), 'from_datetime'):
+        return 'ObjectId'
+    if isinstance(value, datetime):
+        return 'date'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 'number'
+    return type(value).__name__
+
+
+def split_points(lower, upper, partitions):
+    """
+    Returns partitions - 1 points splitting the range of values into equal parts.
+    Supports numbers, datetimes and ObjectId (split by generation time), both bounds must be of the same type.
+    Key of mixed types has bounds of different types as the server orders values by BSON type first.
+
+    >>> split_points(0, 100, 4)
+    [25, 50, 75]
+    >>> split_points(datetime(2021, 1, 1), datetime(2021, 1, 3), 2)
+    [datetime.datetime(2021, 1, 2, 0, 0)]
+    >>> split_points(0, 'z', 2)
+    Traceback (most recent call last):
+    ...
+    ValueError: Range partitioning requires numbers, dates or ObjectId bounds of the same type, got number and str. Pass bounds or use hashed one.
+    """
+    lower_type, upper_type = _range_type(lower), _range_type(upper)
+    if lower_type != upper_type or lower_type not in ('number', 'date', 'ObjectId'):
+        raise ValueError(
+            f'Range partitioning requires numbers, dates or ObjectId bounds of the same type, '
+            f'got {lower_type} and {upper_type}. Pass bounds or use hashed one.'
+        )
+    if lower_type == 'ObjectId':
+        points = split_points(
+            lower.generation_time.replace(tzinfo=None), upper.generation_time.replace(tzinfo=None), partitions)
+        return [type(lower).from_datetime(point) for point in points]
+    step = (upper - lower) / partitions
+    points = []
+    for i in range(1, partitions):
+        point = lower + step * i
+        if isinstance(lower, int) and isinstance(upper, int):
+            point = int(point)
+        if point not in points and lower < point <= upper:
+            points.append(point)
+    return points
+
+
+def range_conditions(key, points):
+    """
+    Returns conditions of disjoint ranges covering all the values of the key.
+    Documents with null or missing key are a separate partition,
+    the first range also takes values of other types.
+
+    >>> range_conditions('_id', [10, 20])[:2]
+    [{'_id': None}, {'_id': {'$not': {'$gte': 10}, '$ne': None}}]
+    """
+    if not points:
+        return [{}]
+    conditions = [{key: None}, {key: {'$not': {'$gte': points[0]}, '$ne': None}}]
+    for lower, upper in zip(points, points[1:]):
+        conditions.append({key: {'$gte': lower, '$lt': upper}})
+    conditions.append({key: {'$gte': points[-1]}})
+    return conditions
+
+
+def hashed_conditions(key, partitions):
+    """
+    Returns conditions splitting documents into buckets by the hash of the key.
+    Requires $toHashedIndexKey support on the server. No index serves $expr with the hash,
+    so each partition scans all the documents matching the rest of the query: N partitions make N scans.
+    Use it only if the leading $match is selective by itself, otherwise prefer range partitioning of an indexed key.
+
+    >>> hashed_conditions('code', 2)[1]
+    {'$expr': {'$eq': [{'$abs': {'$mod': [{'$toHashedIndexKey': '$code'}, 2]}}, 1]}}
+    """
+    return [
+        {'$expr': {'$eq': [{'$abs': {'$mod': [{'$toHashedIndexKey': f'${key}'}, partitions]}}, i]}}
+        for i in range(partitions)
+    ]
+
+
+def add_condition(query, condition):
+    """Adds a condition to the $match query without losing existing conditions on the same keys."""
+    if not condition:
+        return dict(query)
+    if query.keys() & condition.keys():
+        return {'$and': [dict(query), condition]}
+    query = dict(query)
+    query.update(condition)
+    return query
+
+
+def check_partitionable(pipeline):
+    """Raises ValueError if the pipeline result can't be merged from partitions results."""
+    for i, stage in enumerate(pipeline):
+        name = next(iter(stage))
+        if name == '$group' and i == len(pipeline) - 1:
+            continue
+        if name in NOT_PARTITIONABLE_STAGES:
+            raise ValueError(f'Pipeline with {name} stage at position {i} can\'t be run by partitions.')
+
+
+def _numeric(expression):
+    return {'$in': [{'$type': expression}, ['double', 'int', 'long', 'decimal']]}
+
+
+def partial_group(stage):
+    """
+    Returns $group stage for partitions: $avg is replaced with sum and count of numeric values.
+
+    >>> partial_group({'_id': '$type', 'price': {'$avg': '$price'}})
+    {'_id': '$type', 'price': {'$sum': '$price'}, 'price__avg_count': {'$sum': {'$cond': [{'$in': [{'$type': '$price'}, ['double', 'int', 'long', 'decimal']]}, 1, 0]}}}
+    """
+    partial = {}
+    for field, accumulator in stage.items():
+        if field == '_id':
+            partial[field] = accumulator
+            continue
+        operator, expression = _get_accumulator(field, accumulator)
+        if operator == '$avg':
+            partial[field] = {'$sum': expression}
+            partial[field + AVG_COUNT_SUFFIX] = {'$sum': {'$cond': [_numeric(expression), 1, 0]}}
+            continue
+        partial[field] = accumulator
+    return partial
+
+
+def _get_accumulator(field, accumulator):
+    if not isinstance(accumulator, dict) or len(accumulator) != 1:
+        raise ValueError(f'Unsupported accumulator of {field} field: {accumulator}.')
+    operator, expression = next(iter(accumulator.items()))
+    if operator not in MERGEABLE_OPERATORS:
+        raise ValueError(f'Results of {operator} accumulator of {field} field can\'t be merged.')
+    return operator, expression
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple((key, _hashable(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def _merge_value(operator, merged, value):
+    if operator == '$sum':
+        return (merged or 0) + (value or 0)
+    if operator in ('$min', '$max'):
+        if merged is None:
+            return value
+        if value is None:
+            return merged
+        # Values of different types are compared by BSON type order like on the server
+        return min(merged, value, key=_sort_key) if operator == '$min' else max(merged, value, key=_sort_key)
+    if operator == '$first':
+        return merged
+    if operator == '$last':
+        return value
+    if operator == '$push':
+        return merged + value
+    if operator == '$addToSet':
+        known = {_hashable(item) for item in merged}
+        return merged + [item for item in value if _hashable(item) not in known]
+
+
+def merge_group_results(stage, partitions_results):
+    """
+    Merges results of partial_group stage run by partitions into results of the stage.
+    Partitions must be ordered the same way as documents, otherwise $first and $last are undefined.
+
+    >>> stage = {'_id': '$type', 'total': {'$sum': '$price'}, 'avg': {'$avg': '$price'}, 'tags': {'$addToSet': '$tag'}}
+    >>> merge_group_results(stage, [
+    ...     [{'_id': 'a', 'total': 10, 'avg': 10, 'avg__avg_count': 2, 'tags': ['x']}],
+    ...     [{'_id': 'a', 'total': 5, 'avg': 5, 'avg__avg_count': 1, 'tags': ['x', 'y']}, {'_id': 'b', 'total': 0,
+    ...       'avg': 0, 'avg__avg_count': 0, 'tags': []}],
+    ... ])
+    [{'_id': 'a', 'total': 15, 'avg': 5.0, 'tags': ['x', 'y']}, {'_id': 'b', 'total': 0, 'avg': None, 'tags': []}]
+    >>> merge_group_results({'_id': None, 'low': {'$min': '$v'}, 'high': {'$max': '$v'}}, [
+    ...     [{'_id': None, 'low': 'b', 'high': 'b'}], [{'_id': None, 'low': 3, 'high': 3}],
+    ...     [{'_id': None, 'low': None, 'high': None}],
+    ... ])
+    [{'_id': None, 'low': 3, 'high': 'b'}]
+    """
+    operators = {
+        field: _get_accumulator(field, accumulator)[0]
+        for field, accumulator in stage.items()
+        if field != '_id'
+    }
+    merged = {}
+    for results in partitions_results:
+        for document in results:
+            key = _hashable(document.get('_id'))
+            if key not in merged:
+                merged[key] = dict(document)
+                continue
+            merged_document = merged[key]
+            for field, operator in operators.items():
+                if operator == '$avg':
+                    merged_document[field] = _merge_value('$sum', merged_document.get(field), document.get(field))
+                    count_field = field + AVG_COUNT_SUFFIX
+                    merged_document[count_field] = merged_document.get(count_field, 0) + document.get(count_field, 0)
+                    continue
+                merged_document[field] = _merge_value(operator, merged_document.get(field), document.get(field))
+
+    for document in merged.values():
+        for field, operator in operators.items():
+            if operator != '$avg':
+                continue
+            count = document.pop(field + AVG_COUNT_SUFFIX, 0)
+            document[field] = document.get(field) / count if count else None
+    return list(merged.values())
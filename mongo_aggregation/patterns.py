@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
-from copy import copy
+from functools import lru_cache
 
 import six
 
@@ -147,32 +147,68 @@ def field_exists(field):
     ]}
 
 
+_QUERY_OPERATORS = {
+    operator: dollar_prefix(operator)
+    for operator in ('eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin', 'push')
+}
+# Regex operators with ignore case flag
+_REGEX_OPERATORS = {'regex': False, 'iregex': True, 'icontains': True, 'contains': True}
+
+
+@lru_cache(maxsize=4096)
+def _parse_name(name, convert_operators=False):
+    """
+    Returns tuple (field name with dots, operator suffix or None).
+
+    >>> _parse_name('date__gte', convert_operators=True)
+    ('date', 'gte')
+    >>> _parse_name('item__name'), _parse_name('__raw__')
+    (('item.name', None), ('__raw__', None))
+    """
+    if '__' not in name or name.startswith('__') or name.endswith('__'):
+        return name, None
+    replacement = name.replace('__', '.')
+    if convert_operators:
+        field, _, operator = replacement.rpartition('.')
+        if operator in _QUERY_OPERATORS or operator in _REGEX_OPERATORS:
+            return field, operator
+    return replacement, None
+
+
 def _convert_names_with_underlines_to_dots(args, convert_operators=False):
-    """Проверяем обращение к полям объекта с помощью __ в словаре"""
-    for i, arg in enumerate(copy(args)):
-        if '__' not in arg:
-            continue
-        elif arg.startswith('__') or arg.endswith('__'):
+    """
+    Проверяем обращение к полям объекта с помощью __ в словаре.
+    Returns new list or dictionary, names keep their order.
+
+    >>> _convert_names_with_underlines_to_dots({'date__gte': 1, 'date__lt': 2, 'item__name': 'a'}, True)
+    {'date': {'$gte': 1, '$lt': 2}, 'item.name': 'a'}
+    >>> _convert_names_with_underlines_to_dots(['item__name', 'count'])
+    ['item.name', 'count']
+    """
+    if isinstance(args, (list, tuple)):
+        return [_parse_name(arg)[0] for arg in args]
+
+    converted = {}
+    # Conditions created here, which may be updated without changing the source values
+    conditions = set()
+    for name, value in args.items():
+        field, operator = _parse_name(name, convert_operators)
+        if operator is None:
+            if field in conditions and isinstance(value, dict):
+                value = dict(value, **converted[field])
+            else:
+                conditions.discard(field)
+            converted[field] = value
             continue
-        replacement = arg.replace('__', '.')
-        if isinstance(args, list):
-            args.pop(i)
-            args.insert(i, replacement)
+        if field not in conditions:
+            condition = converted.get(field)
+            converted[field] = dict(condition) if condition is not None else {}
+            conditions.add(field)
+        if operator in _REGEX_OPERATORS:
+            converted[field].update(regex(value, i=_REGEX_OPERATORS[operator]))
         else:
-            if convert_operators:
-                potential_operator = replacement[replacement.rfind('.')+1:]
-                field = replacement[:replacement.rfind('.')]
-                if potential_operator in ['eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin', 'push']:
-                    args.setdefault(field, {})
-                    args[field][dollar_prefix(potential_operator)] = args.pop(arg)
-                    continue
-                elif potential_operator in ['regex', 'iregex', 'icontains', 'contains']:
-                    ignore_case = potential_operator.startswith('i')
-                    args.setdefault(field, {})
-                    args[field].update(regex(args.pop(arg), i=ignore_case))
-                    continue
-            args[replacement] = args.pop(arg)
-    return args
+            converted[field][_QUERY_OPERATORS[operator]] = value
+    return converted
 
 
 def obj(*args, **kwargs):
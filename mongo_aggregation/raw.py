@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Lazy documents decoding BSON fields on access (requires pymongo)."""
+
+import struct
+from collections.abc import Mapping
+
+_int32 = struct.Struct('<i').unpack_from
+
+# Sizes of BSON values by element type
+_FIXED_SIZES = {
+    0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0,
+}
+_STRING_TYPES = (0x02, 0x0D, 0x0E)
+_SIZED_TYPES = (0x03, 0x04, 0x0F)
+_EMBEDDED_DOCUMENT = 0x03
+
+
+def _value_size(raw, element_type, start):
+    if element_type in _FIXED_SIZES:
+        return _FIXED_SIZES[element_type]
+    if element_type in _STRING_TYPES:
+        return 4 + _int32(raw, start)[0]
+    if element_type in _SIZED_TYPES:
+        return _int32(raw, start)[0]
+    if element_type == 0x05:
+        return 5 + _int32(raw, start)[0]
+    if element_type == 0x0B:
+        pattern_end = raw.index(b'\x00', start)
+        return raw.index(b'\x00', pattern_end + 1) + 1 - start
+    if element_type == 0x0C:
+        return 4 + _int32(raw, start)[0] + 12
+    raise ValueError(f'Unknown BSON element type: {element_type:#x}.')
+
+
+def scan_elements(raw, position=4, stop_key=None):
+    """
+    Returns tuple (dictionary {key: (element start, element end, element type, value start)}, next position)
+    of the top level elements of BSON document starting from the position. Values are not decoded.
+    Scanning stops after stop_key element.
+
+    >>> scan_elements(b'\\x15\\x00\\x00\\x00\\x10a\\x00\\x01\\x00\\x00\\x00\\x02b\\x00\\x02\\x00\\x00\\x00x\\x00\\x00')
+    ({'a': (4, 11, 16, 7), 'b': (11, 20, 2, 14)}, 20)
+    """
+    elements = {}
+    end = len(raw) - 1
+    index = raw.index
+    while position < end:
+        element_type = raw[position]
+        key_end = index(b'\x00', position + 1)
+        value_start = key_end + 1
+        size = _FIXED_SIZES.get(element_type)
+        value_end = value_start + (size if size is not None else _value_size(raw, element_type, value_start))
+        key = raw[position + 1:key_end].decode('utf-8')
+        elements[key] = (position, value_end, element_type, value_start)
+        position = value_end
+        if key == stop_key:
+            break
+    return elements, position
+
+
+class LazyDocument(Mapping):
+    """
+    Read-only document over BSON bytes. Top level elements are indexed without decoding on first access,
+    values are decoded one by one when they are accessed. Embedded documents are lazy too.
+    Bytes are available as raw attribute, e.g. to forward them to other services.
+    """
+    __slots__ = ('raw', 'codec_options', '_elements', '_position', '_decoded')
+
+    def __init__(self, raw, eager_fields=(), codec_options=None):
+        self.raw = raw
+        self.codec_options = codec_options
+        self._elements = {}
+        # Elements are indexed up to the accessed one
+        self._position = 4
+        self._decoded = {}
+        for field in eager_fields:
+            if field in self:
+                self[field]
+
+    def _find(self, key):
+        """Returns element location or None."""
+        if key not in self._elements and self._position < len(self.raw) - 1:
+            elements, self._position = scan_elements(self.raw, self._position, key)
+            self._elements.update(elements)
+        return self._elements.get(key)
+
+    @property
+    def elements(self):
+        if self._position < len(self.raw) - 1:
+            elements, self._position = scan_elements(self.raw, self._position)
+            self._elements.update(elements)
+        return self._elements
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+        element = self._find(key)
+        if element is None:
+            raise KeyError(key)
+        element_start, element_end, element_type, value_start = element
+        if element_type == _EMBEDDED_DOCUMENT:
+            value = LazyDocument(self.raw[value_start:element_end], codec_options=self.codec_options)
+        else:
+            value = self._decode_element(self.raw[element_start:element_end])[key]
+        self._decoded[key] = value
+        return value
+
+    def _decode_element(self, element):
+        import bson
+        document = struct.pack('<i', len(element) + 5) + element + b'\x00'
+        if self.codec_options is None:
+            return bson.decode(document)
+        return bson.decode(document, self.codec_options)
+
+    def __contains__(self, key):
+        return key in self._decoded or self._find(key) is not None
+
+    def __iter__(self):
+        return iter(self.elements)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __repr__(self):
+        return f'LazyDocument({self.to_dict()!r})'
+
+    def to_dict(self):
+        """Returns the document decoded to dictionary, embedded documents included."""
+        return {
+            key: value.to_dict() if isinstance(value, LazyDocument) else value
+            for key, value in self.items()
+        }
+
+
+def raw_collection(collection):
+    """Returns the same pymongo collection returning RawBSONDocument."""
+    from bson.raw_bson import RawBSONDocument
+    if not hasattr(collection, 'with_options'):
+        raise ValueError('Raw mode requires pymongo collection.')
+    codec_options = collection.codec_options.with_options(document_class=RawBSONDocument)
+    return collection.with_options(codec_options=codec_options)
+
+
+def lazy_documents(cursor, eager_fields=(), codec_options=None):
+    """Wraps RawBSONDocument results to LazyDocument."""
+    for document in cursor:
+        yield LazyDocument(document.raw, eager_fields, codec_options)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""
+Incremental materialized rollups: $merge of new documents results into stored $group results.
+
+>>> from mongo_aggregation import MongoAggregation
+>>> from mongo_aggregation.engine import InMemoryEngine
+>>> engine = InMemoryEngine({'action': [{'_id': 1, 'cashbox': 1, 'amount': 10}, {'_id': 2, 'cashbox': 1, 'amount': 5}]})
+>>> def rollup():
+...     return MongoAggregation(collection=engine.action).group(group_by='cashbox', sum_fields='amount').materialize(
+...         'cashbox_totals', watermark_field='_id')
+>>> rollup()['watermark']
+2
+>>> engine.action.insert_one({'_id': 3, 'cashbox': 1, 'amount': 7})
+>>> rollup()['previous'], engine.cashbox_totals.documents
+(2, [{'_id': 1, 'amount': 22}])
+"""
+
+from .partitions import AVG_COUNT_SUFFIX, _get_accumulator, add_condition, partial_group
+
+
+def watermark_condition(field, previous=None, current=None):
+    """
+    Returns $match condition of the documents after the previous watermark up to the current one.
+
+    >>> watermark_condition('date', 1, 5)
+    {'date': {'$gt': 1, '$lte': 5}}
+    """
+    condition = {}
+    if previous is not None:
+        condition['$gt'] = previous
+    if current is not None:
+        condition['$lte'] = current
+    return {field: condition} if condition else {}
+
+
+def narrow_pipeline(pipeline, condition):
+    """
+    Returns the pipeline with the condition added to the leading $match.
+
+    >>> narrow_pipeline([{'$match': {'a': 1}}, {'$group': {'_id': '$a'}}], {'date': {'$gt': 1}})
+    [{'$match': {'a': 1, 'date': {'$gt': 1}}}, {'$group': {'_id': '$a'}}]
+    """
+    if not condition:
+        return list(pipeline)
+    if pipeline and '$match' in pipeline[0]:
+        return [{'$match': add_condition(pipeline[0]['$match'], condition)}] + list(pipeline[1:])
+    return [{'$match': condition}] + list(pipeline)
+
+
+def _combined(operator, field):
+    """Returns expression combining the stored value with the value of the new results ($$new)."""
+    stored, new = f'${field}', f'$$new.{field}'
+    if operator == '$sum':
+        return {'$add': [{'$ifNull': [stored, 0]}, {'$ifNull': [new, 0]}]}
+    if operator in ('$min', '$max'):
+        return {operator: [stored, new]}
+    if operator == '$first':
+        return {'$ifNull': [stored, new]}
+    if operator == '$last':
+        return new
+    if operator == '$push':
+        return {'$concatArrays': [{'$ifNull': [stored, []]}, {'$ifNull': [new, []]}]}
+    if operator == '$addToSet':
+        return {'$setUnion': [{'$ifNull': [stored, []]}, {'$ifNull': [new, []]}]}
+    # $avg is weighted by the numbers of values
+    stored_count, new_count = f'${field}{AVG_COUNT_SUFFIX}', f'$$new.{field}{AVG_COUNT_SUFFIX}'
+    count = {'$add': [{'$ifNull': [stored_count, 0]}, {'$ifNull': [new_count, 0]}]}
+    total = {'$add': [
+        {'$multiply': [{'$ifNull': [stored, 0]}, {'$ifNull': [stored_count, 0]}]},
+        {'$multiply': [{'$ifNull': [new, 0]}, {'$ifNull': [new_count, 0]}]},
+    ]}
+    return {'$cond': [{'$gt': [count, 0]}, {'$divide': [total, count]}, None]}
+
+
+def incremental_group(stage):
+    """
+    Returns tuple (stages, whenMatched pipeline) for incremental $group results:
+    stages replace the $group (numbers of $avg values are kept in '<field>__avg_count' fields)
+    and the pipeline combines stored results with the results of new documents.
+    $first keeps the stored value and $last takes the new one, so new documents must follow the stored ones.
+
+    >>> incremental_group({'_id': '$cashbox', 'amount': {'$sum': '$amount'}, 'last': {'$max': '$date'}})
+    ([{'$group': {'_id': '$cashbox', 'amount': {'$sum': '$amount'}, 'last': {'$max': '$date'}}}], \
+[{'$set': {'amount': {'$add': [{'$ifNull': ['$amount', 0]}, {'$ifNull': ['$$new.amount', 0]}]}, \
+'last': {'$max': ['$last', '$$new.last']}}}])
+    """
+    combined, averages = {}, {}
+    for field, accumulator in stage.items():
+        if field == '_id':
+            continue
+        operator, _ = _get_accumulator(field, accumulator)
+        combined[field] = _combined(operator, field)
+        if operator == '$avg':
+            count_field = field + AVG_COUNT_SUFFIX
+            combined[count_field] = _combined('$sum', count_field)
+            averages[field] = {'$cond': [
+                {'$gt': [f'${count_field}', 0]}, {'$divide': [f'${field}', f'${count_field}']}, None]}
+    stages = [{'$group': partial_group(stage)}]
+    if averages:
+        stages.append({'$set': averages})
+    return stages, [{'$set': combined}]
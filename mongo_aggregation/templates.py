@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Compiled pipelines with named parameters bound per run."""
+
+_MISSING = object()
+
+
+class Param(object):
+    """
+    Named placeholder of a value in the pipeline.
+
+    >>> Param('start')
+    Param('start')
+    """
+    __slots__ = ('name', 'default')
+
+    def __init__(self, name, default=_MISSING):
+        self.name = name
+        self.default = default
+
+    def __repr__(self):
+        if self.default is _MISSING:
+            return f'Param({self.name!r})'
+        return f'Param({self.name!r}, default={self.default!r})'
+
+
+def _find_params(value, path=()):
+    """Yields tuples (path, Param) of all the parameters in the value."""
+    if isinstance(value, Param):
+        yield path, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _find_params(item, path + (key,))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            yield from _find_params(item, path + (i,))
+
+
+def _copy_stage(value):
+    """Returns copy of dictionaries and lists of the stage, other values are shared."""
+    if isinstance(value, dict):
+        return {key: _copy_stage(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_stage(item) for item in value]
+    return value
+
+
+def _bind_stage(stage, params, values):
+    """Returns copy of the stage with bound parameters."""
+    root = _copy_stage(stage)
+    for path, param in params:
+        node = root
+        for key in path[:-1]:
+            node = node[key]
+        node[path[-1]] = values[param.name]
+    return root
+
+
+class CompiledPipeline(object):
+    """
+    Pipeline built once and bound with parameters per run. Each bound pipeline gets copies of the stages,
+    so changes of one don't affect the template.
+    With encode_static stages without parameters are encoded to BSON once (requires pymongo).
+    Encoded stages are read-only and opaque: the optimizer skips pipelines with them, lookup(fields=True)
+    doesn't narrow them, count, get_first, paginate and limit(pushdown) don't strip or move stages over them.
+
+    >>> from mongo_aggregation import MongoAggregation
+    >>> pipeline = MongoAggregation().match(completed=True, date__gte=Param('start')).limit(Param('limit', 10))
+    >>> template = pipeline.compile()
+    >>> template.params
+    ['start', 'limit']
+    >>> bound = template.bind(start=1)
+    >>> bound.pipeline
+    [{'$match': {'completed': True, 'date': {'$gte': 1}}}, {'$limit': 10}]
+    >>> bound.pipeline[0]['$match']['code'] = 'A1'
+    >>> template.bind(start=2).pipeline[0]
+    {'$match': {'completed': True, 'date': {'$gte': 2}}}
+    """
+
+    def __init__(self, aggregation, encode_static=False):
+        self.aggregation_class = aggregation.__class__
+        self.collection = aggregation.collection
+        self.allowDiskUse = aggregation.allowDiskUse
+        self.optimization = aggregation.optimization
+        self.cache = aggregation.cache
+        self.instrumentation = aggregation.instrumentation
+        self.narrowed_lookups = set(aggregation.narrowed_lookups)
+        self.unique_lookups = set(aggregation.unique_lookups)
+        self.client_lookups = list(aggregation.client_lookups)
+        self.actual_fields = aggregation.actual_fields.copy()
+        self.stages = []
+        self.defaults = {}
+        for stage in aggregation.pipeline:
+            params = list(_find_params(stage))
+            for _, param in params:
+                if self.defaults.get(param.name, _MISSING) is _MISSING:
+                    self.defaults[param.name] = param.default
+            if not params and encode_static:
+                self.stages.append((self._encode(stage), None))
+            else:
+                self.stages.append((stage, params))
+
+    @staticmethod
+    def _encode(stage):
+        import bson
+        from bson.raw_bson import RawBSONDocument
+        return RawBSONDocument(bson.encode(stage))
+
+    @property
+    def params(self):
+        return list(self.defaults)
+
+    def bind(self, **params):
+        """Returns MongoAggregation with the parameters substituted."""
+        unknown = params.keys() - self.defaults.keys()
+        if unknown:
+            raise KeyError(f'Unknown parameters: {", ".join(sorted(unknown))}.')
+        values = dict(self.defaults)
+        values.update(params)
+        missing = [name for name, value in values.items() if value is _MISSING]
+        if missing:
+            raise KeyError(f'Parameters are not bound: {", ".join(missing)}.')
+
+        # Encoded stages are immutable, so they are shared
+        pipeline = [stage if stage_params is None else _bind_stage(stage, stage_params, values)
+                    for stage, stage_params in self.stages]
+        aggregation = self.aggregation_class(
+            pipeline=pipeline, collection=self.collection, allowDiskUse=self.allowDiskUse,
+            optimize=self.optimization, cache=self.cache, instrumentation=self.instrumentation,
+        )
+        aggregation.actual_fields = self.actual_fields.copy()
+        aggregation.narrowed_lookups = set(self.narrowed_lookups)
+        aggregation.unique_lookups = set(self.unique_lookups)
+        aggregation.client_lookups = list(self.client_lookups)
+        return aggregation